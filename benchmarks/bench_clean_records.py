@@ -0,0 +1,109 @@
+"""
+Micro-benchmark for datalogger record cleaning.
+
+Compares the original per-value cleaning loop from get_data against the
+precompiled column plan in src.data_logger on a synthetic table shaped like
+the LINEAR_CORN node tables. Run it on the Raspberry Pi to get Pi-class numbers:
+
+    python benchmarks/bench_clean_records.py --records 10000 --repeat 5
+"""
+import os
+import sys
+import math
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# src imports the CR1000 and RAK811 drivers; the fakes let this run off the Pi
+from fakes import install_fakes
+install_fakes(0)
+
+from src.data_logger import clean_records, build_column_plan
+
+SENSOR_FIELDS = [
+    "IRT5023A1xx24", "IRT5020A3xx24", "IRT5018A3xx24",
+    "TDR5023A10624", "TDR5023A11824", "TDR5023A13024", "TDR5023A14224",
+    "TDR5026A20624", "TDR5026A21824", "TDR5026A23024",
+    "TDR5027A40624", "TDR5027A41824", "TDR5027A43024",
+    "DEN5023A1xx24",
+]
+
+
+def make_records(count, nan_ratio=0.02, seed=42):
+    rng = random.Random(seed)
+    start = datetime(2024, 7, 1)
+    raw_fields = ["b'BatV'", "b'PanelTempC'"] + [f"b'{name}_Avg'" for name in SENSOR_FIELDS]
+    records = []
+    for i in range(count):
+        record = {"Datetime": start + timedelta(minutes=2 * i), "RecNbr": i}
+        for field in raw_fields:
+            record[field] = float("nan") if rng.random() < nan_ratio else rng.uniform(0, 40)
+        records.append(record)
+    return records
+
+
+def legacy_clean(table_data):
+    # Verbatim copy of the cleaning loop get_data used before the column plan
+    cleaned_data = []
+    for label in table_data:
+        dict_entry = {}
+        for key, value in label.items():
+            key = key.replace("b'", "").replace("'", "")
+
+            if key == "Datetime":
+                key = "TIMESTAMP"
+            elif key != "RecNbr" and key.endswith("_Avg"):
+                key = key[:-4]
+
+            dict_entry[key] = value
+
+            try:
+                if math.isnan(value):
+                    dict_entry[key] = -9999
+            except TypeError:
+                continue
+
+        cleaned_data.append(dict_entry)
+    return cleaned_data
+
+
+def planned_clean(table_data):
+    raw_keys = list(table_data[0].keys())
+    plan = build_column_plan(raw_keys, numeric_keys=set(raw_keys) - {"Datetime"})
+    return list(clean_records(table_data, plan))
+
+
+def best_of(func, records, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(records)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    if legacy_clean(records) != planned_clean(records):
+        raise SystemExit("Column plan output differs from the legacy cleaning loop")
+
+    legacy = best_of(legacy_clean, records, args.repeat)
+    planned = best_of(planned_clean, records, args.repeat)
+    columns = len(records[0])
+
+    print(f"{args.records} records x {columns} columns, best of {args.repeat}")
+    print(f"  legacy per-value loop : {legacy * 1000:8.1f} ms  ({args.records / legacy:10.0f} records/s)")
+    print(f"  precompiled plan      : {planned * 1000:8.1f} ms  ({args.records / planned:10.0f} records/s)")
+    print(f"  speedup               : {legacy / planned:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Throughput benchmark for the shared lora_payload codec.
+
+Times encode, decode and the forwarder's decode step for a full node's
+record. The forwarder step is the MQTT envelope json.loads, then base64,
+decode, expand_uplink and DeltaDecoder.rebuild. The codec's round-trip
+properties are checked by tests/test_codec_roundtrip.py.
+
+    python benchmarks/bench_codec.py --seconds 1
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lora_payload import (
+    PayloadCodec,
+    DeltaDecoder,
+    SensorRegistry,
+    encode_json,
+    expand_uplink,
+)
+
+
+def throughput(label, func, seconds):
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        for _ in range(100):
+            func()
+        count += 100
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+    rate = count / (now - start)
+    print(f"{label:<44} {rate:>12,.0f} msg/s {1e6 / rate:>9.1f} us/msg")
+
+
+def benchmark(registry, seconds):
+    codec = PayloadCodec(registry)
+    rng = random.Random(0)
+    # A full node's record, like the largest node in sensor_mapping.yaml sends
+    by_node = {}
+    for sensor in registry:
+        by_node.setdefault((sensor["field"], sensor["node"]), []).append(sensor)
+    sensors = max(by_node.values(), key=len)
+    reading = {sensor["hash"]: round(rng.uniform(0.05, 40.0), 4) for sensor in sensors}
+    reading["time"] = "20240704133000"
+    reading["BatV"] = 12.83
+    batch = {"batch": [dict(reading, time=f"202407041{3 + i // 2}{(i % 2) * 30:02d}00") for i in range(4)]}
+
+    binary = codec.encode(reading)
+    batch_binary = codec.encode(batch)
+    legacy = encode_json(reading)
+
+    def envelope(payload):
+        return json.dumps({
+            "deviceName": "LINEAR_CORN_C",
+            "devEUI": "0000000000000000",
+            "time": "2024-07-04T13:30:00Z",
+            "data": base64.b64encode(payload).decode("ascii"),
+        }).encode("utf-8")
+
+    decoder = DeltaDecoder()
+
+    def forwarder_step(raw):
+        message = json.loads(raw.decode("utf-8"))
+        decoded = codec.decode(base64.b64decode(message["data"]))
+        return [decoder.rebuild(message["deviceName"], row) for row in expand_uplink(decoded)]
+
+    print(f"\n{len(sensors)} sensors per record; binary reading {len(binary)} B, "
+          f"batch of 4 {len(batch_binary)} B, JSON {len(legacy)} B\n")
+    throughput("encode reading (binary)", lambda: codec.encode(reading), seconds)
+    throughput("decode reading (binary)", lambda: codec.decode(binary), seconds)
+    throughput("encode batch of 4 (binary)", lambda: codec.encode(batch), seconds)
+    throughput("decode batch of 4 (binary)", lambda: codec.decode(batch_binary), seconds)
+    throughput("encode reading (JSON)", lambda: encode_json(reading), seconds)
+    throughput("decode reading (JSON)", lambda: codec.decode(legacy), seconds)
+    for label, payload in (("binary", binary), ("batch of 4", batch_binary), ("JSON", legacy)):
+        raw = envelope(payload)
+        throughput(f"forwarder decode step ({label})", lambda raw=raw: forwarder_step(raw), seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=1.0, help="Time per throughput measurement")
+    args = parser.parse_args()
+
+    with open(os.path.join(ROOT, "config", "sensor_mapping.yaml"), "r") as f:
+        registry = SensorRegistry(yaml.safe_load(f))
+    benchmark(registry, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Benchmark of the edge collection cycle without a CR1000 or RAK811 attached.
+
+Runs the same stages as main.main() against the fakes in benchmarks/fakes.py
+and reports wall time and CPU time per stage, plus peak RSS, for each cycle:
+
+    python benchmarks/bench_cycle.py --cycles 10 --latency-scale 0
+    python benchmarks/bench_cycle.py --cycles 5 --latency-scale 1 --json bench_output.txt
+
+Latency scale 0 measures only the Pi-side cost (parsing, SQLite, payload
+building); 1 adds the estimated serial/UART delays. The first cycle backfills
+--backfill-hours of history; later cycles collect one --interval of records.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import contextlib
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import install_fakes, node_sensor_ids, FakeCR1000, FakeRak811
+
+STAGES = ["connect", "list_tables", "get_data", "db_insert", "payload_build", "send"]
+
+
+class StageTimer:
+    def __init__(self):
+        self.results = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.results[name] = {
+                "wall_ms": (time.perf_counter() - wall) * 1000,
+                "cpu_ms": (time.process_time() - cpu) * 1000,
+            }
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_cycle(src, session, lora_session, config, sensor_metadata, reconnect):
+    timer = StageTimer()
+    db_name = config["database"]["name"]
+    datalogger_config = config["datalogger"]
+
+    if reconnect:
+        session.close()
+        lora_session.close()
+
+    with timer.stage("connect"):
+        logger_time = session.ensure_connected()
+
+    with timer.stage("list_tables"):
+        table_names = session.get_tables()
+        column_plan = session.get_column_plan(table_names[0])
+
+    with timer.stage("get_data"):
+        src.setup_watermark_table(db_name)
+        backfill = src.needs_backfill(
+            table_names[0], db_name, logger_time, datalogger_config.get("backfill_threshold_minutes", 60)
+        )
+        if backfill:
+            # Backfill interleaves reads and inserts, so its inserts are counted here
+            stats = src.backfill_data(
+                session.datalogger,
+                table_names[0],
+                db_name,
+                logger_time,
+                chunk_minutes=datalogger_config.get("backfill_chunk_minutes", 360),
+                max_chunk_records=datalogger_config.get("backfill_max_chunk_records", 500),
+                column_plan=column_plan,
+            )
+            table_data = []
+            latest_data = stats["latest_record"]
+            records = stats["records"]
+        else:
+            table_data = src.get_new_data(session.datalogger, table_names[0], db_name, logger_time, column_plan)
+            latest_data = table_data[-1] if table_data else None
+            records = len(table_data)
+
+    with timer.stage("db_insert"):
+        if table_data:
+            src.setup_database(latest_data.keys(), db_name, table_data)
+            src.insert_data_to_db(table_data, db_name)
+            src.advance_watermark(table_names[0], table_data, db_name)
+        src.update_rollups(db_name, config.get("retention"))
+
+    packets_before = len(FakeRak811.packets)
+    with timer.stage("payload_build"):
+        chunks = src.build_lora_chunks(latest_data, sensor_metadata, config.get("clip_floats", False)) if latest_data else []
+
+    with timer.stage("send"):
+        if latest_data:
+            src.send_lora_data(
+                latest_data,
+                config,
+                sensor_metadata,
+                clip_floats=config.get("clip_floats", False),
+                lora_manager=lora_session,
+            )
+
+    return {
+        "records": records,
+        "backfill": backfill,
+        "packets": len(FakeRak811.packets) - packets_before,
+        "payload_chunks": len(chunks),
+        "stages": timer.results,
+        "wall_ms": sum(stage["wall_ms"] for stage in timer.results.values()),
+        "cpu_ms": sum(stage["cpu_ms"] for stage in timer.results.values()),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def print_report(results):
+    header = f"{'cycle':>5} {'records':>7} {'pkts':>4} " + " ".join(f"{stage:>13}" for stage in STAGES)
+    header += f" {'wall ms':>9} {'cpu ms':>9} {'rss MB':>7}"
+    print(header)
+    for i, result in enumerate(results, 1):
+        stages = " ".join(f"{result['stages'][stage]['wall_ms']:13.1f}" for stage in STAGES)
+        print(
+            f"{i:>5} {result['records']:>7} {result['packets']:>4} {stages} "
+            f"{result['wall_ms']:9.1f} {result['cpu_ms']:9.1f} {result['peak_rss_mb']:7.1f}"
+        )
+
+    steady = results[1:] or results
+    print(f"\nSteady-state mean over {len(steady)} cycles (stage wall ms / cpu ms):")
+    for stage in STAGES:
+        wall = sum(result["stages"][stage]["wall_ms"] for result in steady) / len(steady)
+        cpu = sum(result["stages"][stage]["cpu_ms"] for result in steady) / len(steady)
+        print(f"  {stage:<14}{wall:10.1f} {cpu:10.1f}")
+    print(f"  {'total':<14}{sum(r['wall_ms'] for r in steady) / len(steady):10.1f} "
+          f"{sum(r['cpu_ms'] for r in steady) / len(steady):10.1f}")
+    print(f"Peak RSS: {max(result['peak_rss_mb'] for result in results):.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cycles", type=int, default=10)
+    parser.add_argument("--interval", type=int, default=30, help="Simulated minutes between cycles")
+    parser.add_argument("--backfill-hours", type=float, default=48)
+    parser.add_argument("--latency-scale", type=float, default=0.0)
+    parser.add_argument("--reconnect", action="store_true", help="Close the datalogger and LoRa sessions every cycle")
+    parser.add_argument("--batch", type=int, default=0, help="Batch this many cycles per uplink (0: config.yaml setting)")
+    parser.add_argument("--node", default=None, help="Node id (default: node_id from config.yaml)")
+    parser.add_argument("--json", dest="json_path", help="Also write raw results as JSON to this path")
+    parser.add_argument("--verbose", action="store_true", help="Keep INFO/DEBUG logging enabled")
+    args = parser.parse_args()
+
+    install_fakes(args.latency_scale)
+    os.chdir(ROOT)
+    import src
+
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    config = src.load_config()
+    node_id = args.node or config["node_id"]
+    work_dir = tempfile.mkdtemp(prefix="bench_cycle_")
+    config["database"]["name"] = os.path.join(work_dir, f"{node_id}.db")
+    # The inter-packet spacing is airtime policy, not processing cost
+    config["schedule"]["transmission_window"] = 0
+    config["schedule"]["min_interval"] = 0
+    if args.batch:
+        config["batch"] = {"enabled": True, "records_per_uplink": args.batch}
+
+    sensor_metadata = src.load_sensor_registry(config["sensor_metadata"])
+    FakeCR1000.configure(
+        node_sensor_ids(os.path.join(ROOT, config["sensor_metadata"]), node_id),
+        clock_start=datetime(2024, 7, 1, 12, 0),
+    )
+    session = src.DataloggerSession(dict(config["datalogger"], port=work_dir))
+    lora_session = src.create_lora_session(config, sensor_metadata)
+
+    results = []
+    # Loggers created mid-run bind to the current stdout, so keep the same sink for the whole run
+    devnull = open(os.devnull, "w")
+    try:
+        with contextlib.redirect_stdout(devnull):
+            for cycle in range(args.cycles):
+                FakeCR1000.advance_clock(args.backfill_hours * 60 if cycle == 0 else args.interval)
+                results.append(run_cycle(src, session, lora_session, config, sensor_metadata, args.reconnect))
+    finally:
+        devnull.close()
+        session.close()
+        lora_session.close()
+        src.close_databases()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"Node {node_id}: {len(FakeCR1000.sensor_ids)} sensors, latency scale {args.latency_scale}, "
+          f"{'reconnect every cycle' if args.reconnect else 'persistent session'}\n")
+    print_report(results)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"args": vars(args), "cycles": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
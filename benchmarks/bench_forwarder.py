@@ -0,0 +1,228 @@
+"""
+Throughput benchmark for the forwarder's MQTT-to-Pub/Sub path.
+
+Loads mqtt-forwarder-vm/emqx_to_pubsub.py with the fakes from fakes.py in place
+of google.cloud.pubsub_v1 and paho, and feeds it binary uplinks built with the
+node's codec for the nodes in sensor_mapping.yaml. Every run reports uplinks and
+sensor values per second until all publishes have completed, plus how many
+PublisherClients and publish RPCs were needed. "ingest s" is the time spent in
+the MQTT receive callback alone, which is what holds up paho's network thread.
+
+"legacy" processes each uplink inside the callback with a copy of the original
+publish_to_pubsub: a new PublisherClient per sensor value and a blocking
+future.result(), with the original one-message-per-value format. "shared" is
+the current on_message, worker pool and shared publisher, with the default
+message format. "slow-sink" is the same with publish RPCs 50x slower, a small
+publisher flow-control limit and a small queue, so the queue fills and uplinks
+are rejected, and spooled, while the callback stays fast. "outage" fails every
+publish RPC while the uplinks are processed, so everything lands in the on-disk
+spool, then restores the sink and times the replay ("replay s"). "duplicates"
+delivers every uplink twice, as two gateways would; "dup hits" counts the
+copies dropped before publishing. "per-row" is "shared" with
+PUBSUB_MESSAGE_FORMAT = 'row', one message per (dataset, table, timestamp) row
+instead of one per sensor value. --scale multiplies the Pub/Sub latency
+estimates in fakes.py.
+
+    python benchmarks/bench_forwarder.py --uplinks 40 --scale 0.2
+"""
+import os
+import sys
+import json
+import time
+import threading
+import base64
+import shutil
+import logging
+import argparse
+import tempfile
+import importlib.util
+from datetime import datetime, timedelta
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fakes
+from fakes import install_forwarder_fakes, FakeMQTTClient, FakeMQTTMessage, FakePublisherClient
+from lora_payload import PayloadCodec, SensorRegistry
+
+
+def load_forwarder(home):
+    # The forwarder logs to fixed paths under the VM user's home; a root handler
+    # turns its logging.basicConfig into a no-op and HOME points ~ at a temp dir
+    logging.getLogger().addHandler(logging.NullHandler())
+    os.environ["HOME"] = home
+    shutil.copy(os.path.join(ROOT, "config", "sensor_mapping.yaml"), os.path.join(home, "sensor_mapping.yaml"))
+    spec = importlib.util.spec_from_file_location(
+        "emqx_to_pubsub", os.path.join(ROOT, "mqtt-forwarder-vm", "emqx_to_pubsub.py")
+    )
+    forwarder = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(forwarder)
+    return forwarder
+
+
+def build_uplinks(registry, count):
+    # Round-robin over the mapped nodes, one record per node every 30 minutes
+    codec = PayloadCodec(registry)
+    nodes = sorted({(sensor["field"], sensor["node"]) for sensor in registry})
+    start = datetime(2024, 7, 1)
+    uplinks = []
+    values = 0
+    for i in range(count):
+        field, node = nodes[i % len(nodes)]
+        record_time = start + timedelta(minutes=30 * (i // len(nodes)))
+        chunk = {sensor["hash"]: 0.25 + 0.001 * i for sensor in registry.node_sensors(field, node)}
+        chunk["time"] = record_time.strftime("%Y%m%d%H%M%S")
+        chunk["BatV"] = 12.8
+        values += len(chunk) - 2  # time and BatV
+        envelope = {
+            "deviceName": f"{field}_{node}",
+            "devEUI": f"{i % len(nodes):016x}",
+            "time": record_time.isoformat() + "Z",
+            "data": base64.b64encode(codec.encode(chunk)).decode("ascii"),
+        }
+        uplinks.append(FakeMQTTMessage("device/data/uplink", json.dumps(envelope).encode("utf-8")))
+    return uplinks, values
+
+
+def legacy_publish_to_pubsub(forwarder):
+    # Copy of publish_to_pubsub before the shared publisher, minus the retry sleep
+    def publish_to_pubsub(data, retry_count=0):
+        publisher = forwarder.pubsub_v1.PublisherClient()
+        topic_path = publisher.topic_path(forwarder.PROJECT_ID, forwarder.TOPIC_ID)
+        future = publisher.publish(topic_path, data=json.dumps(data).encode("utf-8"))
+        future.result()
+    return publish_to_pubsub
+
+
+def replay(forwarder, client, workers):
+    # Waits for the failing publishes to reach the spool, restores the sink and
+    # runs the replay loop until the spool is empty and everything is published
+    publisher = forwarder._publisher
+    while publisher is not None and publisher.stats["pending"]:
+        time.sleep(0.01)
+    FakePublisherClient.fail_rpcs = 0
+    spool = forwarder.get_spool()
+    stop = threading.Event()
+    start = time.perf_counter()
+    thread = threading.Thread(target=forwarder.replay_spool, args=(client, stop), daemon=True)
+    thread.start()
+    while spool.has_data.is_set() or (workers is not None and workers.depth()):
+        time.sleep(0.01)
+    workers.join()
+    publisher = forwarder._publisher
+    while publisher is not None and publisher.stats["pending"]:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    thread.join()
+    return elapsed
+
+
+def run(forwarder, mode, uplinks, values):
+    FakePublisherClient.reset()
+    forwarder._publisher = None
+    forwarder._workers = None
+    forwarder._spool = None
+    forwarder.DEDUP_CACHE = forwarder.DedupCache(forwarder.DEDUP_TTL_HOURS * 3600, forwarder.DEDUP_MAX_ENTRIES)
+    saved = {name: getattr(forwarder, name) for name in
+             ("publish_to_pubsub", "PUBSUB_FLOW_MAX_MESSAGES", "MESSAGE_QUEUE_SIZE", "SPOOL_DIR", "RETRY_DELAY",
+              "PUBSUB_MESSAGE_FORMAT")}
+    forwarder.SPOOL_DIR = tempfile.mkdtemp(prefix="spool_", dir=os.environ["HOME"])
+    forwarder.RETRY_DELAY = 0.05
+    rpc_latency = fakes.PUBSUB_LATENCY["publish_rpc"]
+    if mode == "legacy":
+        forwarder.publish_to_pubsub = legacy_publish_to_pubsub(forwarder)
+        forwarder.PUBSUB_MESSAGE_FORMAT = "value"
+    elif mode == "slow-sink":
+        fakes.PUBSUB_LATENCY["publish_rpc"] = rpc_latency * 50
+        forwarder.PUBSUB_FLOW_MAX_MESSAGES = 50
+        forwarder.MESSAGE_QUEUE_SIZE = 8
+    elif mode == "outage":
+        FakePublisherClient.fail_rpcs = 10 ** 9
+    elif mode == "per-row":
+        forwarder.PUBSUB_MESSAGE_FORMAT = "row"
+    elif mode == "duplicates":
+        uplinks = [message for message in uplinks for _ in range(2)]
+    client = FakeMQTTClient()
+    replay_seconds = 0.0
+
+    start = time.perf_counter()
+    try:
+        for message in uplinks:
+            if mode == "legacy":
+                forwarder.process_message(message, client)
+            else:
+                forwarder.on_message(client, None, message)
+        ingest = time.perf_counter() - start
+        workers = forwarder._workers
+        if workers is not None:
+            workers.join()
+        if mode in ("slow-sink", "outage"):
+            replay_seconds = replay(forwarder, client, workers)
+        if workers is not None:
+            workers.stop()
+        if forwarder._publisher is not None:
+            forwarder._publisher.stop()
+        spool = forwarder._spool
+        if spool is not None:
+            spool.close()
+    finally:
+        for name, value in saved.items():
+            setattr(forwarder, name, value)
+        fakes.PUBSUB_LATENCY["publish_rpc"] = rpc_latency
+    elapsed = time.perf_counter() - start
+
+    stats = workers.stats if mode != "legacy" else {}
+    return {
+        "mode": mode,
+        "seconds": elapsed,
+        "ingest_seconds": ingest,
+        "replay_seconds": replay_seconds,
+        "spooled": spool.stats["appended"] if spool is not None else 0,
+        "dedup_hits": forwarder.DEDUP_CACHE.stats["hits"],
+        "max_depth": stats.get("max_depth", 0),
+        "rejected": stats.get("rejected", 0),
+        "uplinks_per_s": len(uplinks) / elapsed,
+        "values_per_s": values / elapsed,
+        "published": len(FakePublisherClient.published),
+        "published_bytes": sum(len(data) for data in FakePublisherClient.published),
+        "clients": FakePublisherClient.instances,
+        "rpcs": FakePublisherClient.rpcs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uplinks", type=int, default=40)
+    parser.add_argument("--scale", type=float, default=0.2, help="Multiplier for the Pub/Sub latency estimates")
+    modes = ["legacy", "shared", "per-row", "slow-sink", "outage", "duplicates"]
+    parser.add_argument("--modes", nargs="+", default=modes, choices=modes)
+    args = parser.parse_args()
+
+    install_forwarder_fakes(args.scale)
+    home = tempfile.mkdtemp(prefix="bench_forwarder_")
+    try:
+        forwarder = load_forwarder(home)
+        with open(os.path.join(home, "sensor_mapping.yaml"), "r") as f:
+            registry = SensorRegistry(yaml.safe_load(f))
+        uplinks, values = build_uplinks(registry, args.uplinks)
+
+        print(f"{args.uplinks} uplinks, {values} sensor values, Pub/Sub latency scale {fakes.latency_scale:g} "
+              f"(client {fakes.PUBSUB_LATENCY['client'] * args.scale * 1000:.0f} ms, "
+              f"RPC {fakes.PUBSUB_LATENCY['publish_rpc'] * args.scale * 1000:.0f} ms)\n")
+        print(f"{'mode':<10} {'seconds':>8} {'ingest s':>9} {'uplinks/s':>10} {'values/s':>10} {'published':>10} {'bytes':>8} "
+              f"{'clients':>8} {'RPCs':>6} {'max depth':>10} {'rejected':>9} {'spooled':>8} {'replay s':>9} {'dup hits':>9}")
+        for mode in args.modes:
+            result = run(forwarder, mode, uplinks, values)
+            print(f"{result['mode']:<10} {result['seconds']:8.2f} {result['ingest_seconds']:9.3f} "
+                  f"{result['uplinks_per_s']:10.1f} {result['values_per_s']:10.1f} {result['published']:>10} {result['published_bytes']:>8} "
+                  f"{result['clients']:>8} {result['rpcs']:>6} {result['max_depth']:>10} {result['rejected']:>9} "
+                  f"{result['spooled']:>8} {result['replay_seconds']:9.2f} {result['dedup_hits']:>9}")
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
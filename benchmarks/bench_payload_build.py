@@ -0,0 +1,150 @@
+"""
+Micro-benchmark for turning one datalogger record into hashed LoRa payload data.
+
+Compares the original lookup (a linear scan of sensor_mapping.yaml per key,
+called twice per key, with setup_logger run on every call) against the
+SensorRegistry used by build_lora_chunks now. The headline speedup is the
+lookup alone, scan against index. The legacy setup_logger added two handlers
+per call, so its cost grew with every lookup a process made; the copy here
+removes them first, so the per-record cost with logger setup, reported
+separately, counts each setup once instead of the pile-up. The record is shaped like a
+full node's table row. Run it on the Raspberry Pi to get Pi-class numbers:
+
+    python benchmarks/bench_payload_build.py --node LINEAR_CORN_B --cycles 48
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lora_payload import SensorRegistry
+
+LOG_DIR = tempfile.mkdtemp(prefix="bench_payload_build_")
+
+
+def legacy_setup_logger(name, log_file, level=logging.DEBUG):
+    # Copy of utils.setup_logger before it returned already-configured loggers, except
+    # that earlier handlers are removed so each call is timed as a single setup
+    reset_legacy_logger()
+    full_path = os.path.join(LOG_DIR, log_file)
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    file_handler = RotatingFileHandler(full_path, maxBytes=5 * 1024 * 1024, backupCount=5)
+    console_handler = logging.StreamHandler(sys.stdout)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    console_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logger.addHandler(file_handler)
+    logger.addHandler(console_handler)
+    return logger
+
+
+def legacy_get_sensor_hash(sensor_id, sensor_metadata):
+    logger = legacy_setup_logger("bench_legacy_utils", "utils.log")
+    for sensor in sensor_metadata:
+        if sensor["sensor_id"] == sensor_id:
+            logger.debug(f"Hash found for sensor_id: {sensor_id}")
+            return sensor["hash"]
+    logger.warning(f"No hash found for sensor_id: {sensor_id}")
+    return None
+
+
+def legacy_hash(data, sensor_metadata):
+    return {
+        legacy_get_sensor_hash(k, sensor_metadata): v
+        for k, v in data.items()
+        if legacy_get_sensor_hash(k, sensor_metadata) and k != "TIMESTAMP"
+    }
+
+
+def scan_hash(data, sensor_metadata):
+    # The legacy double scan without the per-call logger setup, to separate the two costs
+    def find(sensor_id):
+        for sensor in sensor_metadata:
+            if sensor["sensor_id"] == sensor_id:
+                return sensor["hash"]
+        return None
+
+    return {find(k): v for k, v in data.items() if find(k) and k != "TIMESTAMP"}
+
+
+def registry_hash(data, registry):
+    hashed_data = {}
+    for k, v in data.items():
+        if k == "TIMESTAMP":
+            continue
+        sensor_hash = registry.hash_for(k)
+        if sensor_hash:
+            hashed_data[sensor_hash] = v
+    return hashed_data
+
+
+def make_record(sensor_ids):
+    record = {"TIMESTAMP": datetime(2024, 7, 1, 12, 0), "RecNbr": 1, "BatV": 12.8, "PanelTempC": 31.2}
+    record.update((sensor_id, 0.25) for sensor_id in sensor_ids)
+    return record
+
+
+def per_call(func, args, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return (time.perf_counter() - started) / repeat
+
+
+def reset_legacy_logger():
+    logger = logging.getLogger("bench_legacy_utils")
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--node", default="LINEAR_CORN_B", help="Node whose sensors make up the record")
+    parser.add_argument("--cycles", type=int, default=48, help="Records hashed per measurement (48 = one day)")
+    args = parser.parse_args()
+
+    with open(os.path.join(ROOT, "config", "sensor_mapping.yaml"), "r") as f:
+        sensor_metadata = yaml.safe_load(f)
+
+    field, _, node = args.node.rpartition("_")
+    started = time.perf_counter()
+    registry = SensorRegistry(sensor_metadata)
+    build_ms = (time.perf_counter() - started) * 1000
+    record = make_record(sensor["sensor_id"] for sensor in registry.node_sensors(field, node))
+
+    devnull = open(os.devnull, "w")
+    try:
+        with contextlib.redirect_stdout(devnull):
+            if legacy_hash(record, sensor_metadata) != registry_hash(record, registry):
+                raise SystemExit("Registry lookup differs from the legacy scan")
+            legacy = per_call(legacy_hash, (record, sensor_metadata), args.cycles)
+            reset_legacy_logger()
+            scanned = per_call(scan_hash, (record, sensor_metadata), args.cycles)
+            indexed = per_call(registry_hash, (record, registry), args.cycles)
+    finally:
+        devnull.close()
+        reset_legacy_logger()
+        shutil.rmtree(LOG_DIR, ignore_errors=True)
+
+    print(f"{args.node}: {len(record)} columns, {len(registry)} sensors in mapping, registry built in {build_ms:.2f} ms")
+    print(f"  linear scan                   : {scanned * 1000:9.3f} ms/record")
+    print(f"  SensorRegistry                : {indexed * 1000:9.3f} ms/record")
+    print(f"  lookup speedup                : {scanned / indexed:9.1f}x")
+    print(f"  legacy scan + logger setup    : {legacy * 1000:9.3f} ms/record")
+    print(f"  speedup incl. logger setup    : {legacy / indexed:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+"""
+Hardware-free stand-ins for pycampbellcr1000.CR1000 and rak811.rak811_v3.Rak811,
+and for the forwarder VM's google.cloud.pubsub_v1 and paho.mqtt.client.
+
+install_fakes() registers the fakes under the real module names, so it must be
+called before anything from src is imported:
+
+    from fakes import install_fakes
+    install_fakes(scale=1.0)
+    from src import ...
+
+FakeCR1000 serves a table shaped like the node's real CR8 program (one column per
+sensor in sensor_mapping.yaml plus BatV/PanelTempC, "_Avg" suffixes, bytes-style
+keys, occasional NaNs) with one record every RECORD_INTERVAL_MINUTES of simulated
+logger time. The scale passed to install_fakes multiplies rough per-call delay
+estimates for the 38400 baud serial link and the RAK811 UART; 0 disables them.
+
+install_forwarder_fakes() does the same for the forwarder. FakePublisherClient
+batches like the real client (BatchSettings limits, one commit RPC per batch on
+a background thread) with a simulated client setup and RPC latency.
+"""
+import sys
+import math
+import time
+import types
+import random
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+import yaml
+
+from lora_payload import SensorRegistry
+
+RECORD_INTERVAL_MINUTES = 2
+
+# Rough per-call latency estimates in seconds for the deployed hardware
+CR1000_LATENCY = {
+    "connect": 1.5,
+    "gettime": 0.15,
+    "list_tables": 0.8,
+    "table_def": 2.0,
+    "get_data_base": 0.4,
+    "get_data_per_record": 0.012,
+    "bye": 0.1,
+}
+RAK811_LATENCY = {
+    "open": 0.2,
+    "set_config": 0.25,
+    "join": 1.0,
+    "send": 1.2,
+    "close": 0.05,
+}
+
+# Rough latency estimates in seconds from the forwarder VM to Pub/Sub
+PUBSUB_LATENCY = {
+    "client": 0.05,  # PublisherClient(): credentials and gRPC channel setup
+    "publish_rpc": 0.03,  # one Publish call, whatever the batch size
+}
+
+SENSOR_RANGES = {
+    "IRT": (18.0, 38.0),
+    "TDR": (0.08, 0.45),
+    "SAP": (0.0, 120.0),
+    "DEN": (0.0, 6.0),
+}
+
+latency_scale = 0.0
+
+
+def simulated_delay(seconds):
+    if latency_scale > 0:
+        time.sleep(seconds * latency_scale)
+
+
+def node_sensor_ids(sensor_mapping_path, node_id):
+    with open(sensor_mapping_path, "r") as f:
+        registry = SensorRegistry(yaml.safe_load(f))
+    field, _, node = node_id.rpartition("_")
+    return [sensor["sensor_id"] for sensor in registry.node_sensors(field, node)]
+
+
+class FakeCR1000:
+    table_name = b"Table1"
+    clock_start = datetime(2024, 7, 1)
+    sensor_ids = []
+    nan_ratio = 0.01
+
+    def __init__(self):
+        self.url = None
+        self.rng = random.Random(7)
+        self.calls = {}
+
+    @classmethod
+    def from_url(cls, url, timeout=10):
+        simulated_delay(CR1000_LATENCY["connect"])
+        instance = cls()
+        instance.url = url
+        return instance
+
+    @classmethod
+    def configure(cls, sensor_ids, clock_start=None, nan_ratio=0.01):
+        cls.sensor_ids = list(sensor_ids)
+        cls.nan_ratio = nan_ratio
+        if clock_start is not None:
+            cls.clock_start = clock_start
+
+    @classmethod
+    def advance_clock(cls, minutes):
+        # Simulated logger time is shared by every connection, like the real logger
+        cls.clock_start = cls.clock_start + timedelta(minutes=minutes)
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def gettime(self):
+        self.count("gettime")
+        simulated_delay(CR1000_LATENCY["gettime"])
+        return FakeCR1000.clock_start
+
+    def list_tables(self):
+        self.count("list_tables")
+        simulated_delay(CR1000_LATENCY["list_tables"])
+        return [b"Status", b"DataTableInfo", b"Public", self.table_name]
+
+    @property
+    def table_def(self):
+        self.count("table_def")
+        simulated_delay(CR1000_LATENCY["table_def"])
+        fields = [{"FieldName": b"BatV", "FieldType": "FP2"}, {"FieldName": b"PanelTempC", "FieldType": "FP2"}]
+        fields += [{"FieldName": f"{sensor_id}_Avg".encode(), "FieldType": "IEEE4"} for sensor_id in self.sensor_ids]
+        return [{"Header": {"TableName": self.table_name}, "Fields": fields}]
+
+    def make_record(self, timestamp, rec_nbr):
+        record = {
+            "Datetime": timestamp,
+            "RecNbr": rec_nbr,
+            "b'BatV'": round(12.4 + 0.6 * math.sin(rec_nbr / 360), 2),
+            "b'PanelTempC'": round(25 + 8 * math.sin(rec_nbr / 360), 2),
+        }
+        for sensor_id in self.sensor_ids:
+            low, high = SENSOR_RANGES.get(sensor_id[:3], (0.0, 1.0))
+            if self.rng.random() < self.nan_ratio:
+                value = float("nan")
+            else:
+                value = self.rng.uniform(low, high)
+            record[f"b'{sensor_id}_Avg'"] = value
+        return record
+
+    def get_data(self, table_name, start_date=None, stop_date=None):
+        self.count("get_data")
+        epoch = datetime(2024, 1, 1)
+        interval = timedelta(minutes=RECORD_INTERVAL_MINUTES)
+        stop_date = min(stop_date or FakeCR1000.clock_start, FakeCR1000.clock_start)
+        start_date = start_date or stop_date - timedelta(days=1)
+
+        # Records sit on interval boundaries; RecNbr counts intervals since a fixed epoch
+        first = max(0, math.ceil((start_date - epoch) / interval))
+        last = math.floor((stop_date - epoch) / interval)
+        records = [self.make_record(epoch + i * interval, i) for i in range(first, last + 1)]
+        simulated_delay(CR1000_LATENCY["get_data_base"] + CR1000_LATENCY["get_data_per_record"] * len(records))
+        return records
+
+    def bye(self):
+        self.count("bye")
+        simulated_delay(CR1000_LATENCY["bye"])
+
+
+class FakeRak811:
+    instances = 0
+    packets = []
+    fail_sends = 0
+    # Session state lives in the module, so it survives reopening the UART
+    joined = False
+    uplink_counter = 0
+    # Downlinks the network has queued; one is delivered after each uplink
+    pending_downlinks = []
+
+    def __init__(self, *args, **kwargs):
+        FakeRak811.instances += 1
+        self.calls = {}
+        simulated_delay(RAK811_LATENCY["open"])
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def set_config(self, config):
+        self.count("set_config")
+        simulated_delay(RAK811_LATENCY["set_config"])
+        key, _, value = config.rpartition(":")
+        if key == "lora:uplink_counter":
+            FakeRak811.uplink_counter = int(value)
+
+    def get_config(self, config):
+        self.count("get_config")
+        simulated_delay(RAK811_LATENCY["set_config"])
+        if config == "lora:status":
+            return [
+                "Work Mode: LoRaWAN",
+                "Join_mode: ABP",
+                f"Joined Network:{'true' if FakeRak811.joined else 'false'}",
+                f"UpLinkCounter: {FakeRak811.uplink_counter}",
+                "DownLinkCounter: 0",
+            ]
+        return ""
+
+    def join(self):
+        self.count("join")
+        simulated_delay(RAK811_LATENCY["join"])
+        FakeRak811.joined = True
+
+    def send(self, data, *args, **kwargs):
+        self.count("send")
+        simulated_delay(RAK811_LATENCY["send"])
+        if FakeRak811.fail_sends > 0:
+            FakeRak811.fail_sends -= 1
+            raise IOError("Simulated LoRa transmission failure")
+        FakeRak811.packets.append(bytes(data))
+        FakeRak811.uplink_counter += 1
+        self.received = FakeRak811.pending_downlinks[:1]
+        del FakeRak811.pending_downlinks[:1]
+
+    @property
+    def nb_downlinks(self):
+        return len(getattr(self, "received", []))
+
+    def get_downlink(self):
+        received = getattr(self, "received", [])
+        if not received:
+            return None
+        return {"port": 10, "rssi": -90, "snr": 7, "len": len(received[0]), "data": received.pop(0)}
+
+    def close(self):
+        self.count("close")
+        simulated_delay(RAK811_LATENCY["close"])
+
+
+def install_fakes(scale=0.0):
+    global latency_scale
+    latency_scale = scale
+
+    pycampbellcr1000 = types.ModuleType("pycampbellcr1000")
+    pycampbellcr1000.CR1000 = FakeCR1000
+
+    rak811 = types.ModuleType("rak811")
+    rak811_v3 = types.ModuleType("rak811.rak811_v3")
+    rak811_v3.Rak811 = FakeRak811
+    rak811.rak811_v3 = rak811_v3
+
+    sys.modules["pycampbellcr1000"] = pycampbellcr1000
+    sys.modules["rak811"] = rak811
+    sys.modules["rak811.rak811_v3"] = rak811_v3
+
+
+FakeBatchSettings = namedtuple("BatchSettings", ["max_bytes", "max_latency", "max_messages"])
+FakeBatchSettings.__new__.__defaults__ = (1000 * 1000, 0.01, 100)  # the real client's defaults
+FakePublishFlowControl = namedtuple("PublishFlowControl", ["message_limit", "byte_limit", "limit_exceeded_behavior"])
+FakePublishFlowControl.__new__.__defaults__ = (1000, 10 * 1000 * 1000, "ignore")
+FakePublisherOptions = namedtuple("PublisherOptions", ["flow_control"])
+FakePublisherOptions.__new__.__defaults__ = (FakePublishFlowControl(),)
+FakeLimitExceededBehavior = types.SimpleNamespace(IGNORE="ignore", BLOCK="block", ERROR="error")
+
+
+class FakePublisherClient:
+    instances = 0
+    rpcs = 0
+    published = []
+    # The next N publish RPCs fail, failing every message in their batch
+    fail_rpcs = 0
+    lock = threading.Lock()
+
+    def __init__(self, batch_settings=None, publisher_options=None, **kwargs):
+        simulated_delay(PUBSUB_LATENCY["client"])
+        with FakePublisherClient.lock:
+            FakePublisherClient.instances += 1
+        self.settings = batch_settings or FakeBatchSettings()
+        self.flow_control = (publisher_options or FakePublisherOptions()).flow_control
+        self.outstanding = threading.Condition()
+        self.outstanding_count = 0
+        self.batch_lock = threading.Lock()
+        self.batch = []
+        self.batch_bytes = 0
+        self.timer = None
+        self.commits = []
+
+    @classmethod
+    def reset(cls):
+        cls.instances = 0
+        cls.rpcs = 0
+        cls.published = []
+        cls.fail_rpcs = 0
+
+    def topic_path(self, project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic, data, **attributes):
+        with self.outstanding:
+            if self.flow_control.limit_exceeded_behavior == "block":
+                self.outstanding.wait_for(lambda: self.outstanding_count < self.flow_control.message_limit)
+            self.outstanding_count += 1
+        future = Future()
+        with self.batch_lock:
+            self.batch.append((data, future))
+            self.batch_bytes += len(data)
+            if len(self.batch) >= self.settings.max_messages or self.batch_bytes >= self.settings.max_bytes:
+                self.commit_batch()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.settings.max_latency, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        return future
+
+    def flush(self):
+        with self.batch_lock:
+            self.commit_batch()
+
+    def commit_batch(self):
+        # Called with batch_lock held
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.batch:
+            return
+        batch, self.batch, self.batch_bytes = self.batch, [], 0
+        commit = threading.Thread(target=self.send_rpc, args=(batch,), daemon=True)
+        commit.start()
+        self.commits.append(commit)
+
+    def send_rpc(self, batch):
+        simulated_delay(PUBSUB_LATENCY["publish_rpc"])
+        with FakePublisherClient.lock:
+            FakePublisherClient.rpcs += 1
+            failed = FakePublisherClient.fail_rpcs > 0
+            if failed:
+                FakePublisherClient.fail_rpcs -= 1
+            else:
+                FakePublisherClient.published.extend(data for data, _ in batch)
+                first_id = len(FakePublisherClient.published) - len(batch)
+        with self.outstanding:
+            self.outstanding_count -= len(batch)
+            self.outstanding.notify_all()
+        for i, (_, future) in enumerate(batch):
+            if failed:
+                future.set_exception(IOError("Simulated Pub/Sub outage"))
+            else:
+                future.set_result(str(first_id + i))
+
+    def stop(self):
+        self.flush()
+        for commit in list(self.commits):
+            commit.join()
+
+
+class FakeMQTTMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeMQTTClient:
+    def __init__(self, *args, **kwargs):
+        self.published = []
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def tls_set(self, *args, **kwargs):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+
+    def connect(self, host, port=1883, keepalive=60):
+        raise ConnectionError("FakeMQTTClient does not connect; call on_message directly")
+
+
+def install_forwarder_fakes(scale=0.0):
+    global latency_scale
+    latency_scale = scale
+
+    pubsub_v1 = types.ModuleType("google.cloud.pubsub_v1")
+    pubsub_v1.PublisherClient = FakePublisherClient
+    pubsub_v1.types = types.SimpleNamespace(
+        BatchSettings=FakeBatchSettings,
+        PublishFlowControl=FakePublishFlowControl,
+        PublisherOptions=FakePublisherOptions,
+        LimitExceededBehavior=FakeLimitExceededBehavior,
+    )
+    cloud = types.ModuleType("google.cloud")
+    cloud.pubsub_v1 = pubsub_v1
+    google = types.ModuleType("google")
+    google.cloud = cloud
+
+    client = types.ModuleType("paho.mqtt.client")
+    client.Client = FakeMQTTClient
+    client.MQTTMessage = FakeMQTTMessage
+    client.MQTTv311 = 4
+    mqtt = types.ModuleType("paho.mqtt")
+    mqtt.client = client
+    paho = types.ModuleType("paho")
+    paho.mqtt = mqtt
+
+    sys.modules.update({
+        "google": google,
+        "google.cloud": cloud,
+        "google.cloud.pubsub_v1": pubsub_v1,
+        "paho": paho,
+        "paho.mqtt": mqtt,
+        "paho.mqtt.client": client,
+    })
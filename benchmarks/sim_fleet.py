@@ -0,0 +1,217 @@
+"""
+Offline discrete-event simulation of a LoRa fleet sharing one gateway.
+
+Every node from config/Gateway-Devices-Config.csv (repeated to reach --nodes)
+wakes every schedule.interval_minutes at its own random phase, builds its
+uplinks with the real src.lora_functions chunking and packing for its sensors
+in sensor_mapping.yaml, and spaces them with the real AirtimeScheduler over
+schedule.transmission_window. Time on air comes from lora_payload.airtime.
+
+Uplinks are pure ALOHA: a packet is lost when another packet overlaps it in
+time on the same channel with the same spreading factor (no capture effect).
+Each packet hops to a random channel of the gateway's sub-band. Nodes send
+unconfirmed uplinks, so a collided packet is lost unless gap repair recovers it;
+delivery ratio counts first transmissions only. "deferred" counts packets that
+did not fit the window; on a node they stay in the outbox for a later cycle,
+which the simulation does not replay.
+
+    python benchmarks/sim_fleet.py --nodes 10 20 50 --windows 60 300 --data-rates 1 3
+    python benchmarks/sim_fleet.py --nodes 10 --hours 72 --json sim_output.json
+
+Nodes without sensors in sensor_mapping.yaml are simulated with the sensors of
+the largest mapped node.
+"""
+import os
+import sys
+import csv
+import json
+import heapq
+import random
+import logging
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import install_fakes
+
+# Uplink channels per data rate's bandwidth in a single US915/AU915 sub-band;
+# EU868 gateways listen on 8 channels as well
+CHANNELS = {125000: 8, 500000: 1, 250000: 1}
+
+
+def load_devices(path):
+    with open(path, "r", newline="") as f:
+        return [row["name"] for row in csv.DictReader(f)]
+
+
+class Node:
+    def __init__(self, name, sensor_ids, phase, rng):
+        self.name = name
+        self.sensor_ids = sensor_ids
+        self.phase = phase
+        self.rng = rng
+
+    def record(self, timestamp):
+        record = {"TIMESTAMP": timestamp, "BatV": round(self.rng.uniform(12.0, 13.2), 2)}
+        record.update((sensor_id, round(self.rng.uniform(0.05, 40.0), 4)) for sensor_id in self.sensor_ids)
+        return record
+
+
+def build_fleet(src, config, registry, count, rng):
+    devices = load_devices(os.path.join(ROOT, "config", "Gateway-Devices-Config.csv"))
+    mapped = {}
+    for name in devices:
+        field, _, node = name.rpartition("_")
+        mapped[name] = [sensor["sensor_id"] for sensor in registry.node_sensors(field, node)]
+    fallback = max(mapped.values(), key=len)
+
+    interval = config["schedule"]["interval_minutes"] * 60
+    fleet = []
+    for i in range(count):
+        name = devices[i % len(devices)]
+        label = name if i < len(devices) else f"{name}#{i // len(devices)}"
+        fleet.append(Node(label, mapped[name] or fallback, rng.uniform(0, interval), random.Random(rng.random())))
+    return fleet
+
+
+def simulate(src, config, registry, fleet, window, data_rate, hours, rng, work_dir):
+    from lora_payload import data_rate_params, encode_json
+    from src.lora_functions import get_payload_codec, get_packet_packer
+
+    lora_config = dict(config["lora"], data_rate=data_rate)
+    schedule_config = dict(config["schedule"], transmission_window=window)
+    node_config = dict(config, lora=lora_config, schedule=schedule_config)
+    codec = get_payload_codec(node_config, registry)
+    packer = get_packet_packer(node_config, codec)
+    encode = codec.encode if codec else encode_json
+    spreading_factor, bandwidth, _ = data_rate_params(lora_config["region"], data_rate)
+    channels = CHANNELS.get(bandwidth, 1)
+
+    interval = config["schedule"]["interval_minutes"] * 60
+    horizon = hours * 3600
+    epoch = datetime(2024, 7, 1)
+
+    # Event queue of (wake-up time, node index) processed in time order
+    events = []
+    for node_index, node in enumerate(fleet):
+        heapq.heappush(events, (node.phase, node_index))
+
+    transmissions = []
+    deferred = 0
+    schedulers = {}
+    while events:
+        now, node_index = heapq.heappop(events)
+        if now >= horizon:
+            continue
+        node = fleet[node_index]
+        scheduler = schedulers.get(node_index)
+        if scheduler is None:
+            db_name = os.path.join(work_dir, f"sim_{data_rate}_{window}_{node_index}.db")
+            scheduler = src.AirtimeScheduler(db_name, lora_config, schedule_config, rng=random.Random(rng.random()))
+            schedulers[node_index] = scheduler
+
+        record_time = epoch + timedelta(seconds=now)
+        chunks = src.build_lora_chunks(node.record(record_time), registry, packer=packer)
+        sizes = [len(encode(chunk)) for chunk in chunks]
+        sim_now = epoch.timestamp() + now
+        admitted, rejected = scheduler.admit(sizes, now=sim_now)
+        airtimes = [scheduler.airtime(sizes[i]) for i in admitted]
+        offsets = scheduler.plan(airtimes)
+        deferred += len(sizes) - len(offsets)
+
+        for offset, airtime, i in zip(offsets, airtimes, admitted):
+            start = now + offset
+            transmissions.append({
+                "node": node_index,
+                "start": start,
+                "end": start + airtime,
+                "channel": rng.randrange(channels),
+                "created": now,
+            })
+            scheduler.record(sizes[i], airtime, now=sim_now + offset)
+
+        heapq.heappush(events, (now + interval, node_index))
+
+    # Sweep transmissions in start order; overlaps on the same channel and SF collide
+    transmissions.sort(key=lambda packet: packet["start"])
+    active = {}
+    for packet in transmissions:
+        packet["collided"] = False
+        busy = [other for other in active.get(packet["channel"], []) if other["end"] > packet["start"]]
+        for other in busy:
+            other["collided"] = True
+            packet["collided"] = True
+        busy.append(packet)
+        active[packet["channel"]] = busy
+
+    delivered = [packet for packet in transmissions if not packet["collided"]]
+    latencies = sorted(packet["end"] - packet["created"] for packet in delivered)
+    airtime_total = sum(packet["end"] - packet["start"] for packet in transmissions)
+    return {
+        "nodes": len(fleet),
+        "window": window,
+        "data_rate": data_rate,
+        "spreading_factor": spreading_factor,
+        "packets": len(transmissions),
+        "deferred": deferred,
+        "collided": len(transmissions) - len(delivered),
+        "delivery_ratio": len(delivered) / len(transmissions) if transmissions else 1.0,
+        "latency_mean_s": sum(latencies) / len(latencies) if latencies else 0.0,
+        "latency_p95_s": latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+        "channel_load": airtime_total / (horizon * channels),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[10, 25, 50, 100])
+    parser.add_argument("--windows", type=int, nargs="+", default=None, help="transmission_window values in seconds")
+    parser.add_argument("--data-rates", type=int, nargs="+", default=None)
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_path", help="Also write results as JSON to this path")
+    args = parser.parse_args()
+
+    install_fakes(0)
+    os.chdir(ROOT)
+    devnull = open(os.devnull, "w")
+    with contextlib.redirect_stdout(devnull):
+        import src
+        logging.disable(logging.WARNING)
+        config = src.load_config()
+        registry = src.load_sensor_registry(config["sensor_metadata"])
+    devnull.close()
+
+    windows = args.windows or [config["schedule"]["transmission_window"]]
+    data_rates = args.data_rates or [config["lora"]["data_rate"]]
+    results = []
+    with tempfile.TemporaryDirectory(prefix="sim_fleet_") as work_dir:
+        for nodes in args.nodes:
+            for window in windows:
+                for data_rate in data_rates:
+                    rng = random.Random(args.seed)
+                    fleet = build_fleet(src, config, registry, nodes, rng)
+                    results.append(simulate(src, config, registry, fleet, window, data_rate, args.hours, rng, work_dir))
+        src.close_databases()
+
+    print(f"{config['lora']['region']}, {config['schedule']['interval_minutes']} min cycles, "
+          f"{args.hours:g} h simulated, pure ALOHA per channel and SF\n")
+    print(f"{'nodes':>5} {'window s':>8} {'DR':>3} {'SF':>3} {'packets':>8} {'deferred':>8} {'collided':>8} "
+          f"{'delivery':>9} {'lat mean s':>10} {'lat p95 s':>10} {'ch load':>8}")
+    for result in results:
+        print(f"{result['nodes']:>5} {result['window']:>8} {result['data_rate']:>3} {result['spreading_factor']:>3} "
+              f"{result['packets']:>8} {result['deferred']:>8} {result['collided']:>8} "
+              f"{result['delivery_ratio'] * 100:8.2f}% {result['latency_mean_s']:10.1f} {result['latency_p95_s']:10.1f} "
+              f"{result['channel_load'] * 100:7.3f}%")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+from .codec import (
+    PayloadCodec,
+    PayloadError,
+    FORMAT_VERSION,
+    META_KEYS,
+    NODE_MISSING_VALUE,
+    TIME_FORMAT,
+    sensor_scales,
+    encode_json,
+)
+from .airtime import (
+    REGION_DATA_RATES,
+    REGION_LIMITS,
+    region_limits,
+    LORAWAN_OVERHEAD,
+    data_rate_params,
+    max_payload_size,
+    time_on_air,
+)
+from .records import (
+    format_time,
+    parse_time,
+    hash_record,
+    split_record,
+    expand_uplink,
+)
+from .packer import PacketPacker
+from .delta import DeltaDecoder
+from .registry import SensorRegistry
+from .repair import (
+    GapTracker,
+    REPAIR_FPORT,
+    encode_repair_request,
+    decode_repair_request,
+)
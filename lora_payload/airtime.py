@@ -0,0 +1,73 @@
+# LoRaWAN uplink limits and time on air. Time on air follows the Semtech SX127x
+# formula (AN1200.13) with the LoRaWAN uplink defaults: 8-symbol preamble, explicit
+# header, CRC on, coding rate 4/5, low data rate optimisation for SF11/SF12 at
+# 125 kHz. The PHY payload is the application payload plus LORAWAN_OVERHEAD bytes.
+import math
+
+LORAWAN_OVERHEAD = 13
+PREAMBLE_SYMBOLS = 8
+CODING_RATE = 1  # 4/5
+
+# Uplink data rates per region: DR -> (spreading factor, bandwidth Hz, max application payload bytes)
+REGION_DATA_RATES = {
+    "US915": {
+        0: (10, 125000, 11),
+        1: (9, 125000, 53),
+        2: (8, 125000, 125),
+        3: (7, 125000, 242),
+        4: (8, 500000, 242),
+    },
+    "AU915": {
+        0: (12, 125000, 59),
+        1: (11, 125000, 59),
+        2: (10, 125000, 59),
+        3: (9, 125000, 123),
+        4: (8, 125000, 230),
+        5: (7, 125000, 230),
+        6: (8, 500000, 230),
+    },
+    "EU868": {
+        0: (12, 125000, 51),
+        1: (11, 125000, 51),
+        2: (10, 125000, 51),
+        3: (9, 125000, 115),
+        4: (8, 125000, 222),
+        5: (7, 125000, 222),
+        6: (7, 250000, 222),
+    },
+}
+
+# Regulatory limits per region: duty_cycle is the fraction of each hour a node may
+# transmit (ETSI sub-band g1 for EU868), max_dwell the longest single uplink in
+# seconds (FCC 15.247 for US915, the AU915 uplink dwell time limit)
+REGION_LIMITS = {
+    "US915": {"duty_cycle": None, "max_dwell": 0.4},
+    "AU915": {"duty_cycle": None, "max_dwell": 0.4},
+    "EU868": {"duty_cycle": 0.01, "max_dwell": None},
+}
+
+def region_limits(region):
+    return REGION_LIMITS.get(region, {"duty_cycle": None, "max_dwell": None})
+
+def data_rate_params(region, data_rate):
+    try:
+        return REGION_DATA_RATES[region][int(data_rate)]
+    except KeyError:
+        raise ValueError(f"Unknown data rate DR{data_rate} for region {region}")
+
+def max_payload_size(region, data_rate):
+    return data_rate_params(region, data_rate)[2]
+
+def time_on_air(payload_size, region, data_rate):
+    # Seconds on air for an uplink carrying payload_size application bytes
+    spreading_factor, bandwidth, _ = data_rate_params(region, data_rate)
+    low_data_rate = 1 if spreading_factor >= 11 and bandwidth == 125000 else 0
+    symbol_time = (2 ** spreading_factor) / bandwidth
+
+    phy_payload = payload_size + LORAWAN_OVERHEAD
+    numerator = 8 * phy_payload - 4 * spreading_factor + 28 + 16
+    payload_symbols = 8 + max(
+        math.ceil(numerator / (4 * (spreading_factor - 2 * low_data_rate))) * (CODING_RATE + 4), 0
+    )
+    preamble_time = (PREAMBLE_SYMBOLS + 4.25) * symbol_time
+    return preamble_time + payload_symbols * symbol_time
@@ -0,0 +1,262 @@
+# Versioned binary codec for node uplinks, replacing the JSON chunks ({"001": 0.41,
+# ..., "time": "20240704132200", "BatV": 12.83}). Decoding returns the same dict
+# shape, and a JSON payload always starts with "{" (never a valid version byte), so
+# the forwarder accepts both formats side by side.
+#
+# Wire format, version 1 (big-endian):
+#   byte 0     version (high nibble) | message type (low nibble)
+#   byte 1     flags: bit 0 = BatV present
+#   bytes 2-5  uint32 seconds since 2024-01-01 00:00:00 (logger local time)
+#   byte 6     bitmap base in bytes: bit 0 of the bitmap is hash base * 8 + 1
+#   byte 7     bitmap length in bytes
+#   bitmap     bit i (LSB first per byte) set = hash base * 8 + i + 1 present
+#   values     one int16 per set bit, in hash order, scaled by sensor type
+#   [BatV]     uint16, volts * 100, when flag bit 0 is set; 0xFFFF = missing
+#   [parts]    uint8, type 1 only: packets the delta record was split into
+#
+# Type 0 is a full reading (a keyframe in delta mode). Type 1 is a delta with only
+# the sensors that moved beyond their threshold; values are absolute, so a lost
+# delta only leaves those sensors stale. Type 2 batches N records of one node:
+# the header time is the first record's, the bitmap is the union, then a uint8
+# count N, N uint16 second offsets, N rows of values and, with the flag, N BatV.
+# Missing readings (-9999 on the node) travel as MISSING_VALUE or BATV_MISSING
+# and decode back to -9999.
+import json
+import struct
+from datetime import datetime, timedelta
+
+FORMAT_VERSION = 1
+MESSAGE_READING = 0
+MESSAGE_DELTA = 1
+MESSAGE_BATCH = 2
+# MESSAGE_REPAIR = 3 is a downlink, see repair.py
+
+FLAG_BATV = 0x01
+
+EPOCH = datetime(2024, 1, 1)
+TIME_FORMAT = "%Y%m%d%H%M%S"
+
+MISSING_VALUE = -32768  # int16 minimum is reserved for "no reading"
+NODE_MISSING_VALUE = -9999  # what the node stores for NaN readings
+INT16_MIN = -32767
+INT16_MAX = 32767
+
+# Fixed-point scale per sensor type prefix, chosen so the season's value range fits int16
+SENSOR_TYPE_SCALES = {
+    "TDR": 10000,  # volumetric water content, m3/m3, 0..3.27
+    "IRT": 100,  # canopy temperature, degC, -327..327
+    "DEN": 1000,  # dendrometer, mm, -32.7..32.7
+    "SAP": 100,  # sap flow, -327..327
+    "WAM": 10,  # watermark soil water tension, kPa, -3276..3276
+}
+DEFAULT_SCALE = 100
+BATV_SCALE = 100
+BATV_MISSING = 0xFFFF  # uint16 maximum is reserved for "no battery reading"
+
+HEADER = struct.Struct(">BBIBB")
+
+# Chunk keys that are not sensor hashes
+META_KEYS = ("time", "BatV", "delta", "parts", "batch")
+
+class PayloadError(ValueError):
+    pass
+
+def sensor_scales(sensor_metadata):
+    return {
+        sensor["hash"]: SENSOR_TYPE_SCALES.get(str(sensor["sensor_id"])[:3], DEFAULT_SCALE)
+        for sensor in sensor_metadata
+    }
+
+def hash_to_bit(sensor_hash):
+    try:
+        bit = int(sensor_hash) - 1
+    except (TypeError, ValueError):
+        raise PayloadError(f"Sensor hash {sensor_hash!r} is not numeric and cannot be bitmap-encoded")
+    if bit < 0:
+        raise PayloadError(f"Sensor hash {sensor_hash!r} must be 1 or greater")
+    return bit
+
+def bit_to_hash(bit):
+    return f"{bit + 1:03d}"
+
+def to_fixed_point(value, scale):
+    if value is None or value == NODE_MISSING_VALUE or value != value:
+        return MISSING_VALUE
+    scaled = int(round(value * scale))
+    # Saturate rather than wrap; a clipped reading is still recognisably extreme
+    return min(INT16_MAX, max(INT16_MIN, scaled))
+
+def from_fixed_point(raw, scale):
+    if raw == MISSING_VALUE:
+        return NODE_MISSING_VALUE
+    return raw / scale
+
+def encode_time(time_value):
+    seconds = int((datetime.strptime(time_value, TIME_FORMAT) - EPOCH).total_seconds())
+    if not 0 <= seconds <= 0xFFFFFFFF:
+        raise PayloadError(f"Timestamp {time_value} is outside the encodable range")
+    return seconds
+
+def decode_time(seconds):
+    return (EPOCH + timedelta(seconds=seconds)).strftime(TIME_FORMAT)
+
+def encode_batv(batv):
+    if batv is None or batv == NODE_MISSING_VALUE or batv != batv:
+        return BATV_MISSING
+    return max(0, min(BATV_MISSING - 1, int(round(batv * BATV_SCALE))))
+
+def decode_batv(raw):
+    if raw == BATV_MISSING:
+        return NODE_MISSING_VALUE
+    return raw / BATV_SCALE
+
+def build_bitmap(keys):
+    # Returns (base, length, bitmap, keys in hash order)
+    bits = sorted((hash_to_bit(key), key) for key in keys)
+    if bits:
+        base = bits[0][0] // 8
+        length = bits[-1][0] // 8 - base + 1
+    else:
+        base, length = 0, 0
+    if base > 255 or length > 255:
+        raise PayloadError("Sensor hashes exceed the bitmap range")
+
+    bitmap = bytearray(length)
+    for bit, _ in bits:
+        offset = bit - base * 8
+        bitmap[offset // 8] |= 1 << (offset % 8)
+    return base, length, bytes(bitmap), [key for _, key in bits]
+
+def read_bitmap(bitmap, base):
+    return [
+        bit_to_hash(base * 8 + byte_index * 8 + bit)
+        for byte_index, byte in enumerate(bitmap)
+        for bit in range(8)
+        if byte & (1 << bit)
+    ]
+
+class PayloadCodec:
+    def __init__(self, sensor_metadata):
+        self.scales = sensor_scales(sensor_metadata)
+
+    def scale_for(self, sensor_hash):
+        return self.scales.get(sensor_hash, DEFAULT_SCALE)
+
+    def encode(self, chunk):
+        # chunk is one send_lora_data packet: {hash: value, ..., "time": str, ["BatV": float],
+        # ["delta": True, "parts": int]},
+        # or {"batch": [such records without "delta"]} for a multi-interval uplink
+        if "batch" in chunk:
+            return self.encode_batch(chunk["batch"])
+
+        seconds = encode_time(chunk["time"])
+        message_type = MESSAGE_DELTA if chunk.get("delta") else MESSAGE_READING
+        flags = FLAG_BATV if chunk.get("BatV") is not None else 0
+        base, length, bitmap, keys = build_bitmap(key for key in chunk if key not in META_KEYS)
+        values = [to_fixed_point(chunk[key], self.scale_for(key)) for key in keys]
+
+        payload = bytearray(HEADER.pack((FORMAT_VERSION << 4) | message_type, flags, seconds, base, length))
+        payload += bitmap
+        payload += struct.pack(f">{len(values)}h", *values)
+        if flags & FLAG_BATV:
+            payload += struct.pack(">H", encode_batv(chunk["BatV"]))
+        if message_type == MESSAGE_DELTA:
+            parts = chunk.get("parts", 1)
+            if not 1 <= parts <= 255:
+                raise PayloadError(f"A delta record is split into 1 to 255 packets, not {parts}")
+            payload += struct.pack(">B", parts)
+        return bytes(payload)
+
+    def encode_batch(self, records):
+        # One header and bitmap (the union of the records' sensors) for all records;
+        # the header time is the first record's and each record carries a uint16
+        # offset in seconds from it. Sensors a record lacks are sent as MISSING_VALUE.
+        if not records or len(records) > 255:
+            raise PayloadError(f"A batch holds 1 to 255 records, not {len(records)}")
+        records = sorted(records, key=lambda record: record["time"])
+        seconds = encode_time(records[0]["time"])
+        offsets = [encode_time(record["time"]) - seconds for record in records]
+        if offsets[-1] > 0xFFFF:
+            raise PayloadError(f"Batch spans {offsets[-1]} seconds, more than a uint16 offset can hold")
+
+        flags = FLAG_BATV if any(record.get("BatV") is not None for record in records) else 0
+        base, length, bitmap, keys = build_bitmap(
+            {key for record in records for key in record if key not in META_KEYS}
+        )
+
+        payload = bytearray(HEADER.pack((FORMAT_VERSION << 4) | MESSAGE_BATCH, flags, seconds, base, length))
+        payload += bitmap
+        payload += struct.pack(f">B{len(offsets)}H", len(records), *offsets)
+        for record in records:
+            values = [to_fixed_point(record.get(key), self.scale_for(key)) for key in keys]
+            payload += struct.pack(f">{len(values)}h", *values)
+        if flags & FLAG_BATV:
+            batv = [encode_batv(record.get("BatV")) for record in records]
+            payload += struct.pack(f">{len(batv)}H", *batv)
+        return bytes(payload)
+
+    def decode(self, payload):
+        if payload[:1] == b"{":
+            try:
+                decoded = json.loads(payload.decode("utf-8"))
+            except ValueError as e:
+                raise PayloadError(f"Malformed JSON payload: {e}")
+            if not isinstance(decoded, dict):
+                raise PayloadError("JSON payload is not an object")
+            return decoded
+        if len(payload) < HEADER.size:
+            raise PayloadError(f"Payload of {len(payload)} bytes is shorter than the header")
+
+        version_type, flags, seconds, base, length = HEADER.unpack_from(payload)
+        version, message_type = version_type >> 4, version_type & 0x0F
+        if version != FORMAT_VERSION or message_type not in (MESSAGE_READING, MESSAGE_DELTA, MESSAGE_BATCH):
+            raise PayloadError(f"Unsupported payload version {version} / type {message_type}")
+
+        offset = HEADER.size
+        keys = read_bitmap(payload[offset:offset + length], base)
+        offset += length
+        if message_type == MESSAGE_BATCH:
+            return self.decode_batch(payload, offset, flags, seconds, keys)
+
+        expected = offset + 2 * len(keys) + (2 if flags & FLAG_BATV else 0) + (1 if message_type == MESSAGE_DELTA else 0)
+        if len(payload) != expected:
+            raise PayloadError(f"Payload length {len(payload)} does not match the {expected} bytes its header describes")
+
+        raw_values = struct.unpack_from(f">{len(keys)}h", payload, offset)
+        offset += 2 * len(keys)
+
+        decoded = {key: from_fixed_point(raw, self.scale_for(key)) for key, raw in zip(keys, raw_values)}
+        decoded["time"] = decode_time(seconds)
+        if flags & FLAG_BATV:
+            decoded["BatV"] = decode_batv(struct.unpack_from(">H", payload, offset)[0])
+            offset += 2
+        if message_type == MESSAGE_DELTA:
+            decoded["delta"] = True
+            decoded["parts"] = payload[offset]
+        return decoded
+
+    def decode_batch(self, payload, offset, flags, seconds, keys):
+        if len(payload) < offset + 1:
+            raise PayloadError("Batch payload is missing its record count")
+        count = payload[offset]
+        offset += 1
+        expected = offset + 2 * count + 2 * count * len(keys) + (2 * count if flags & FLAG_BATV else 0)
+        if len(payload) != expected:
+            raise PayloadError(f"Payload length {len(payload)} does not match the {expected} bytes its header describes")
+
+        offsets = struct.unpack_from(f">{count}H", payload, offset)
+        offset += 2 * count
+        records = []
+        for record_offset in offsets:
+            raw_values = struct.unpack_from(f">{len(keys)}h", payload, offset)
+            offset += 2 * len(keys)
+            record = {key: from_fixed_point(raw, self.scale_for(key)) for key, raw in zip(keys, raw_values)}
+            record["time"] = decode_time(seconds + record_offset)
+            records.append(record)
+        if flags & FLAG_BATV:
+            for record, raw in zip(records, struct.unpack_from(f">{count}H", payload, offset)):
+                record["BatV"] = decode_batv(raw)
+        return {"batch": records}
+
+def encode_json(chunk):
+    return json.dumps(chunk).encode("utf-8")
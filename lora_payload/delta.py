@@ -0,0 +1,67 @@
+# Rebuilds full rows from keyframe and delta uplinks: the decoder keeps the last
+# value of every sensor per device and fills in the sensors a delta left out. A
+# delta record split over several packets is filled only once all of its "parts"
+# have arrived, so a lost part leaves the record partial rather than wrong.
+import threading
+from .codec import META_KEYS
+
+class DeltaDecoder:
+    def __init__(self):
+        # device -> {"values": {hash: value}, "time": newest record time,
+        #            "pending": {"time", "keys", "parts"} of the delta record being received}
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def rebuild(self, device, decoded):
+        readings = {key: value for key, value in decoded.items() if key not in META_KEYS}
+        row = {key: value for key, value in decoded.items() if key not in ("delta", "parts")}
+
+        with self.lock:
+            state = self.devices.setdefault(device, {"values": {}, "time": None, "pending": None})
+            if state["time"] is not None and decoded["time"] < state["time"]:
+                # A resent or late record must not overwrite newer carried-forward values
+                return row
+            state["time"] = decoded["time"]
+
+            if decoded.get("delta"):
+                pending = state["pending"]
+                if pending is None or pending["time"] != decoded["time"]:
+                    # Parts of an older record that never completed can no longer be filled
+                    pending = state["pending"] = {"time": decoded["time"], "keys": [], "parts": 0}
+                pending["keys"].extend(readings)
+                pending["parts"] += 1
+                if pending["parts"] >= decoded.get("parts", 1):
+                    # Last part of the record: fill every sensor no part resent, once
+                    sent = set(pending["keys"])
+                    for key, value in state["values"].items():
+                        if key not in sent:
+                            row.setdefault(key, value)
+                    state["pending"] = None
+            else:
+                state["pending"] = None
+
+            state["values"].update(readings)
+        return row
+
+    def known_sensors(self, device):
+        with self.lock:
+            return len(self.devices.get(device, {}).get("values", {}))
+
+    def snapshot(self):
+        # JSON-serialisable copy of the state of every device
+        with self.lock:
+            return {
+                device: {
+                    "values": dict(state["values"]),
+                    "time": state["time"],
+                    "pending": dict(state["pending"], keys=list(state["pending"]["keys"])) if state["pending"] else None,
+                }
+                for device, state in self.devices.items()
+            }
+
+    def restore(self, snapshot):
+        with self.lock:
+            self.devices = {
+                device: {"values": dict(state["values"]), "time": state["time"], "pending": state.get("pending")}
+                for device, state in snapshot.items()
+            }
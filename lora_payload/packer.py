@@ -0,0 +1,142 @@
+# Airtime-aware packing of readings into uplinks. Readings are packed in hash
+# order, keeping each packet's bitmap short, up to the region's maximum payload;
+# when that leaves a short last packet an even split is also tried and the plan
+# with less time on air wins. pack_batch does the same for whole records.
+from .airtime import max_payload_size, time_on_air
+from .codec import PayloadError, META_KEYS
+
+MAX_PARTS = 255
+
+def hash_order(item):
+    key = item[0]
+    return (0, int(key), key) if str(key).isdigit() else (1, 0, str(key))
+
+def has_content(chunk):
+    return any(key not in ("time", "delta", "parts") for key in chunk)
+
+def number_parts(chunks):
+    for chunk in chunks:
+        if chunk.get("delta"):
+            chunk["parts"] = len(chunks)
+    return chunks
+
+class PacketPacker:
+    def __init__(self, region, data_rate, encode, max_values=None):
+        self.region = region
+        self.data_rate = data_rate
+        self.encode = encode
+        self.max_values = max_values
+        self.max_size = max_payload_size(region, data_rate)
+
+    def size(self, chunk):
+        return len(self.encode(chunk))
+
+    def fits(self, chunk):
+        if "batch" in chunk:
+            try:
+                return self.size(chunk) <= self.max_size
+            except PayloadError:
+                # More records than a batch header can describe
+                return False
+        values = sum(1 for key in chunk if key not in META_KEYS)
+        if self.max_values is not None and values > self.max_values:
+            return False
+        return self.size(chunk) <= self.max_size
+
+    def new_chunk(self, time_value, batv=None, delta=False):
+        chunk = {"time": time_value}
+        if batv is not None:
+            chunk["BatV"] = batv
+        if delta:
+            # Sized for the largest count until the plan is known
+            chunk["delta"] = True
+            chunk["parts"] = MAX_PARTS
+        return chunk
+
+    def greedy(self, readings, time_value, batv, delta=False):
+        chunks = []
+        current = self.new_chunk(time_value, batv, delta)
+        for key, value in readings:
+            candidate = dict(current)
+            candidate[key] = value
+            if self.fits(candidate):
+                current = candidate
+                continue
+
+            if has_content(current):
+                chunks.append(current)
+            current = self.new_chunk(time_value, delta=delta)
+            current[key] = value
+            if not self.fits(current):
+                raise PayloadError(
+                    f"A single reading does not fit in a {self.max_size}-byte {self.region} DR{self.data_rate} uplink"
+                )
+        # A delta with nothing changed still goes out so the row is rebuilt at the cloud
+        if has_content(current) or (delta and not chunks):
+            chunks.append(current)
+        return chunks
+
+    def even_split(self, readings, time_value, batv, count, delta=False):
+        chunks = []
+        size, remainder = divmod(len(readings), count)
+        start = 0
+        for i in range(count):
+            stop = start + size + (1 if i < remainder else 0)
+            chunk = self.new_chunk(time_value, batv if i == 0 else None, delta)
+            chunk.update(readings[start:stop])
+            if not self.fits(chunk):
+                return None
+            chunks.append(chunk)
+            start = stop
+        return chunks
+
+    def describe(self, chunks):
+        sizes = [self.size(chunk) for chunk in chunks]
+        airtimes = [time_on_air(size, self.region, self.data_rate) for size in sizes]
+        return {
+            "chunks": chunks,
+            "sizes": sizes,
+            "airtimes": airtimes,
+            "total_bytes": sum(sizes),
+            "total_airtime": sum(airtimes),
+        }
+
+    def pack(self, hashed_data):
+        time_value = hashed_data["time"]
+        batv = hashed_data.get("BatV")
+        delta = bool(hashed_data.get("delta"))
+        readings = sorted(
+            ((key, value) for key, value in hashed_data.items() if key not in META_KEYS), key=hash_order
+        )
+
+        plan = self.describe(number_parts(self.greedy(readings, time_value, batv, delta)))
+        count = len(plan["chunks"])
+        if count > 1 and readings:
+            balanced = self.even_split(readings, time_value, batv, count, delta)
+            if balanced is not None:
+                balanced_plan = self.describe(number_parts(balanced))
+                if balanced_plan["total_airtime"] < plan["total_airtime"]:
+                    plan = balanced_plan
+        return plan
+
+    def pack_batch(self, records):
+        # Groups consecutive records (oldest first) into as few batch uplinks as the
+        # payload limit allows. A record left on its own is packed as ordinary reading
+        # chunks, which are smaller than a one-record batch.
+        chunks = []
+        current = []
+
+        def flush():
+            if len(current) > 1:
+                chunks.append({"batch": current})
+            elif current:
+                chunks.extend(self.pack(current[0])["chunks"])
+
+        for record in sorted(records, key=lambda record: record["time"]):
+            if self.fits({"batch": current + [record]}):
+                current = current + [record]
+                continue
+            flush()
+            current = [record]
+        flush()
+        return self.describe(chunks)
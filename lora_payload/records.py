@@ -0,0 +1,61 @@
+# Record-level rules shared by the node and the forwarder. A record is a logger
+# row keyed by sensor hash: {"001": 0.41, ..., "time": "20240704132200", "BatV": 12.83}.
+# The node builds it with hash_record and the forwarder turns decoded uplinks
+# back into records with expand_uplink, so a format change reaches both ends.
+from datetime import datetime
+from .codec import TIME_FORMAT, META_KEYS
+
+def format_time(timestamp):
+    return timestamp.strftime(TIME_FORMAT)
+
+def parse_time(time_value):
+    return datetime.strptime(time_value, TIME_FORMAT)
+
+def hash_record(data, registry, clip_floats=False):
+    # Returns (record, columns without a sensor hash); data is a logger row with a
+    # datetime TIMESTAMP and registry a SensorRegistry
+    record = {}
+    unmapped = []
+    for key, value in data.items():
+        if key == "TIMESTAMP":
+            continue
+        sensor_hash = registry.hash_for(key)
+        if sensor_hash:
+            record[sensor_hash] = value
+        elif key != "BatV":
+            unmapped.append(key)
+
+    record["time"] = format_time(data["TIMESTAMP"])
+    if "BatV" in data:
+        record["BatV"] = data["BatV"]
+
+    if clip_floats:
+        record = {key: round(value, 2) if isinstance(value, float) else value for key, value in record.items()}
+    return record, unmapped
+
+def split_record(record, values_per_chunk):
+    # Fixed-size chunks of values_per_chunk readings each. Every chunk carries the
+    # record time (and, for a delta, the flag and the chunk count); BatV rides in the
+    # first chunk only. A record without readings, such as an unchanged delta, still
+    # yields one chunk.
+    readings = [(key, value) for key, value in record.items() if key not in META_KEYS]
+    groups = [readings[i:i + values_per_chunk] for i in range(0, len(readings), values_per_chunk)] or [[]]
+
+    chunks = []
+    for i, group in enumerate(groups):
+        chunk = dict(group)
+        chunk["time"] = record["time"]
+        if i == 0 and record.get("BatV") is not None:
+            chunk["BatV"] = record["BatV"]
+        if record.get("delta"):
+            chunk["delta"] = True
+            chunk["parts"] = len(groups)
+        chunks.append(chunk)
+    return chunks
+
+def expand_uplink(decoded):
+    # One record per logger interval: a batch uplink expands into its records,
+    # any other payload is a single record
+    if "batch" in decoded:
+        return list(decoded["batch"])
+    return [decoded]
@@ -0,0 +1,64 @@
+# Read-only index over sensor_mapping.yaml, built once so sensor lookups by
+# sensor_id, hash, node, plot or treatment are dict lookups instead of list
+# scans. Iterating a registry yields the sensor dicts in file order, so it can be
+# passed anywhere the raw list was accepted.
+from types import MappingProxyType
+
+def freeze_index(index):
+    return MappingProxyType({key: tuple(values) for key, values in index.items()})
+
+class SensorRegistry:
+    __slots__ = ("sensors", "by_sensor_id", "by_hash", "by_node", "by_plot", "by_treatment")
+
+    def __init__(self, sensor_metadata):
+        sensors = tuple(MappingProxyType(dict(sensor)) for sensor in sensor_metadata or [])
+        by_sensor_id, by_hash = {}, {}
+        by_node, by_plot, by_treatment = {}, {}, {}
+        for sensor in sensors:
+            by_sensor_id[sensor["sensor_id"]] = sensor
+            by_hash[sensor["hash"]] = sensor
+            by_node.setdefault((sensor.get("field"), sensor.get("node")), []).append(sensor)
+            by_plot.setdefault(sensor.get("plot_number"), []).append(sensor)
+            by_treatment.setdefault((sensor.get("field"), sensor.get("treatment")), []).append(sensor)
+
+        set_attr = object.__setattr__
+        set_attr(self, "sensors", sensors)
+        set_attr(self, "by_sensor_id", MappingProxyType(by_sensor_id))
+        set_attr(self, "by_hash", MappingProxyType(by_hash))
+        set_attr(self, "by_node", freeze_index(by_node))
+        set_attr(self, "by_plot", freeze_index(by_plot))
+        set_attr(self, "by_treatment", freeze_index(by_treatment))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SensorRegistry is immutable")
+
+    @classmethod
+    def build(cls, sensor_metadata):
+        # Accepts either a registry (returned as is) or the raw sensor list
+        return sensor_metadata if isinstance(sensor_metadata, cls) else cls(sensor_metadata)
+
+    def __iter__(self):
+        return iter(self.sensors)
+
+    def __len__(self):
+        return len(self.sensors)
+
+    def hash_for(self, sensor_id):
+        sensor = self.by_sensor_id.get(sensor_id)
+        return sensor["hash"] if sensor else None
+
+    def sensor_for_hash(self, sensor_hash):
+        return self.by_hash.get(sensor_hash)
+
+    def sensor_type(self, sensor_hash):
+        sensor = self.by_hash.get(sensor_hash)
+        return str(sensor["sensor_id"])[:3] if sensor else None
+
+    def node_sensors(self, field, node):
+        return self.by_node.get((field, node), ())
+
+    def plot_sensors(self, plot_number):
+        return self.by_plot.get(plot_number, ())
+
+    def treatment_sensors(self, field, treatment):
+        return self.by_treatment.get((field, treatment), ())
@@ -0,0 +1,65 @@
+# Gap repair: the forwarder's GapTracker turns a late record into a repair range,
+# which goes back to the node as a downlink after its next uplink (class A); the
+# node then re-queues the records it still holds for those ranges.
+#
+# Downlink format (big-endian):
+#   byte 0       version (high nibble) | MESSAGE_REPAIR (low nibble)
+#   byte 1       range count N
+#   N x 6 bytes  uint32 range start, seconds since 2024-01-01 (logger time),
+#                uint16 range length in minutes, rounded up
+import math
+import struct
+from datetime import timedelta
+from .codec import FORMAT_VERSION, EPOCH, PayloadError
+from .records import parse_time
+
+MESSAGE_REPAIR = 3
+REPAIR_FPORT = 10
+RANGE = struct.Struct(">IH")
+MAX_RANGES = 8  # keeps the downlink within the smallest US915/AU915 downlink payload
+
+def encode_repair_request(ranges):
+    # ranges: [(start datetime, stop datetime), ...]
+    ranges = list(ranges)[:MAX_RANGES]
+    payload = bytearray([(FORMAT_VERSION << 4) | MESSAGE_REPAIR, len(ranges)])
+    for start, stop in ranges:
+        seconds = int((start - EPOCH).total_seconds())
+        minutes = math.ceil((stop - start).total_seconds() / 60)
+        if not 0 <= seconds <= 0xFFFFFFFF:
+            raise PayloadError(f"Repair range start {start} is outside the encodable range")
+        payload += RANGE.pack(seconds, max(0, min(0xFFFF, minutes)))
+    return bytes(payload)
+
+def decode_repair_request(payload):
+    if len(payload) < 2 or payload[0] != (FORMAT_VERSION << 4) | MESSAGE_REPAIR:
+        raise PayloadError("Not a repair request")
+    count = payload[1]
+    if len(payload) != 2 + count * RANGE.size:
+        raise PayloadError(f"Repair request of {len(payload)} bytes does not hold {count} ranges")
+    ranges = []
+    for i in range(count):
+        seconds, minutes = RANGE.unpack_from(payload, 2 + i * RANGE.size)
+        start = EPOCH + timedelta(seconds=seconds)
+        ranges.append((start, start + timedelta(minutes=minutes)))
+    return ranges
+
+class GapTracker:
+    def __init__(self, interval_minutes=30, tolerance=1.5, max_gap_hours=72):
+        self.interval = timedelta(minutes=interval_minutes)
+        self.tolerance = tolerance
+        self.max_gap = timedelta(hours=max_gap_hours)
+        # device -> time of the newest record seen
+        self.last_seen = {}
+
+    def observe(self, device, time_value):
+        # Returns the repair ranges opened by this record; older records (repairs,
+        # late packets) never open or move a gap
+        record_time = parse_time(time_value)
+        last = self.last_seen.get(device)
+        if last is None or record_time > last:
+            self.last_seen[device] = record_time
+        if last is None or record_time <= last or record_time - last <= self.interval * self.tolerance:
+            return []
+
+        start = max(last + timedelta(seconds=1), record_time - self.max_gap)
+        return [(start, record_time - timedelta(seconds=1))]
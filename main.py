@@ -1,29 +1,29 @@
-import sys
 import os
 import time
-from datetime import datetime, timedelta
 import traceback
 import json
-import random
 from src.utils import (
     load_config,
     setup_logger,
     get_project_root,
-    reset_reboot_counter,
-    increment_reboot_counter,
-    read_reboot_counter
+    reset_reboot_counter
 )
 from src import (
-    connect_to_datalogger,
-    get_tables,
-    get_data,
-    get_logger_time,
+    DataloggerSession,
+    get_new_data,
+    advance_watermark,
+    needs_backfill,
+    backfill_data,
     setup_database,
     insert_data_to_db,
+    setup_watermark_table,
+    close_databases,
+    update_rollups,
+    run_maintenance,
     send_lora_data,
-    load_sensor_metadata,
-    reboot_system,
-    wait_for_usb_device
+    create_lora_session,
+    load_sensor_registry,
+    reboot_system
 )
 
 logger = setup_logger("main", "main.log")
@@ -35,6 +35,14 @@ def main():
     logger.info("=== System started ===")
     failure_count = 0
     config = load_config()
+    # The sensor file only changes with a redeploy, so it is indexed once at startup;
+    # lookups by sensor_id and hash are dict hits
+    sensor_metadata = load_sensor_registry(config["sensor_metadata"])
+    logger.info(f"Loaded metadata for {len(sensor_metadata)} sensors")
+    # One datalogger connection is kept open and reused across cycles
+    session = DataloggerSession(config["datalogger"])
+    # Likewise the LoRaWAN session is configured and joined once, not every cycle
+    lora_session = None
 
     while True:
         try:
@@ -55,40 +63,80 @@ def main():
                 logger.error(f"No write permission for database directory: {db_dir}")
                 return
 
-            sensor_metadata = load_sensor_metadata(config["sensor_metadata"])
-            logger.info(f"Loaded metadata for {len(sensor_metadata)} sensors")
+            logger_time = session.ensure_connected()
 
-            # Wait for USB device
-            if not wait_for_usb_device(config["datalogger"]["port"]):
-                raise Exception("USB device not available")
-
-            datalogger = connect_to_datalogger(config["datalogger"])
-
-            table_names = get_tables(datalogger)
+            table_names = session.get_tables()
             if not table_names:
                 raise Exception("Failed to retrieve table names")
-
-            logger_time = get_logger_time(datalogger)
-            start_time = logger_time - timedelta(minutes=35)  # Get data from last 35 minutes
-            
-            table_data = get_data(datalogger, table_names[0], start_time, logger_time)
-            if not table_data:
-                logger.info("No new data to process")
+            column_plan = session.get_column_plan(table_names[0])
+
+            db_name = config["database"]["name"]
+            setup_watermark_table(db_name)
+
+            datalogger_config = config["datalogger"]
+
+            if needs_backfill(
+                table_names[0],
+                db_name,
+                logger_time,
+                datalogger_config.get("backfill_threshold_minutes", 60),
+            ):
+                # Recover the whole gap chunk by chunk instead of only the latest window
+                backfill_stats = backfill_data(
+                    session.datalogger,
+                    table_names[0],
+                    db_name,
+                    logger_time,
+                    chunk_minutes=datalogger_config.get("backfill_chunk_minutes", 360),
+                    max_chunk_records=datalogger_config.get("backfill_max_chunk_records", 500),
+                    column_plan=column_plan,
+                )
+                logger.info(
+                    f"Backfilled {backfill_stats['records']} records at "
+                    f"{backfill_stats['records_per_second']:.1f} records/s"
+                )
+                latest_data = backfill_stats["latest_record"]
+            else:
+                # Only ask the logger for records newer than what we already hold
+                table_data = get_new_data(session.datalogger, table_names[0], db_name, logger_time, column_plan)
+                latest_data = table_data[-1] if table_data else None
+
+                if table_data:
+                    logger.info(f"Retrieved {len(table_data)} data points")
+                    logger.debug(f"Sample of retrieved data: {json.dumps(table_data[:2], default=str)}")
+                    setup_database(latest_data.keys(), db_name, table_data)
+                    insert_data_to_db(table_data, db_name)
+                    advance_watermark(table_names[0], table_data, db_name)
+
+            update_rollups(db_name, config.get("retention"))
+
+            if latest_data is None:
+                interval = config['schedule']['interval_minutes']
+                logger.info(f"No new data to process. Waiting for {interval} minutes before next check")
+                time.sleep(interval * 60)
                 continue
 
-            logger.info(f"Retrieved {len(table_data)} data points")
-            logger.debug(f"Sample of retrieved data: {json.dumps(table_data[:2], default=str)}")
-
-            latest_data = table_data[-1]  # Get the last (most recent) data point
             logger.info(f"Latest timestamp from logger: {latest_data['TIMESTAMP']}")
             logger.debug(f"Latest data point: {json.dumps(latest_data, default=str)}")
 
-            setup_database(latest_data.keys(), config["database"]["name"])
-            insert_data_to_db([latest_data], config["database"]["name"])
-
-            send_lora_data(latest_data, config, sensor_metadata, clip_floats=config.get("clip_floats", False))
+            if lora_session is None:
+                lora_session = create_lora_session(config, sensor_metadata)
+            send_lora_data(
+                latest_data,
+                config,
+                sensor_metadata,
+                clip_floats=config.get("clip_floats", False),
+                lora_manager=lora_session,
+            )
 
             logger.info("Data processing and transmission successful!")
+
+            # Pruning and compaction run in the idle time before the next cycle; they
+            # are best-effort and must not count as a collection failure
+            try:
+                run_maintenance(db_name, config.get("retention"))
+            except Exception as e:
+                logger.warning(f"Database maintenance failed: {e}")
             
             # Reset the failure counter after a successful run
             failure_count = 0
@@ -106,6 +154,10 @@ def main():
             failure_count += 1
             if failure_count >= MAX_FAILURES:
                 logger.error(f"Max failures ({MAX_FAILURES}) reached. Initiating system reboot.")
+                session.close()
+                if lora_session is not None:
+                    lora_session.close()
+                close_databases()
                 reboot_system()
                 logger.info("=== System reboot initiated ===")
                 return  # Exit the script, it will be restarted by the system
@@ -18,15 +18,39 @@ import json
 import os
 import time
 import ssl
+import threading
+import queue
+import struct
+import zlib
+import hashlib
+from collections import namedtuple, OrderedDict
+from datetime import timezone
+from zoneinfo import ZoneInfo
 from logging.handlers import RotatingFileHandler
 from google.cloud import pubsub_v1
 import paho.mqtt.client as mqtt
 import yaml
 
+# lora_payload is deployed next to this script on the VM; in the repo it lives one level up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lora_payload import (
+    PayloadCodec,
+    PayloadError,
+    DeltaDecoder,
+    SensorRegistry,
+    GapTracker,
+    parse_time,
+    expand_uplink,
+    REPAIR_FPORT,
+    encode_repair_request,
+)
+
 # EMQX Cloud connection details
 EMQX_HOST = 's11a17e5.ala.us-east-1.emqxsl.com'
 EMQX_PORT = 8883
 EMQX_TOPIC = 'device/data/uplink'
+# Downlinks published here are queued by the network server for the named device
+EMQX_DOWNLINK_TOPIC = 'device/data/downlink'
 EMQX_USERNAME = 'admin'
 EMQX_PASSWORD = 'Iam>Than1M'
 CA_CERT_PATH = os.path.expanduser('~/emqxsl-ca.crt')
@@ -34,8 +58,51 @@ CA_CERT_PATH = os.path.expanduser('~/emqxsl-ca.crt')
 # Google Cloud Pub/Sub Configuration
 PROJECT_ID = 'crop2cloud24'
 TOPIC_ID = 'tester'
-MAX_RETRIES = 3
-RETRY_DELAY = 5
+RETRY_DELAY = 5  # seconds between spool replay attempts while Pub/Sub is failing
+# 'value' is the original one message per sensor value (no schema_version field,
+# read as version 1), which the BigQuery cloud function reads. 'row' publishes one
+# message per (dataset, table, timestamp) holding all of its values (schema_version
+# 2); switch to it only after the subscriber has been migrated to that format
+PUBSUB_MESSAGE_FORMAT = 'value'
+PUBSUB_SCHEMA_VERSION = 2
+# One publisher client batches messages until any of these limits is reached
+PUBSUB_BATCH_MAX_MESSAGES = 100
+PUBSUB_BATCH_MAX_BYTES = 1024 * 1024  # 1 MB
+PUBSUB_BATCH_MAX_LATENCY = 0.05  # seconds
+# Messages the publisher may hold unacknowledged; beyond this, publishing workers block
+PUBSUB_FLOW_MAX_MESSAGES = 5000
+PUBSUB_FLOW_MAX_BYTES = 50 * 1024 * 1024  # 50 MB
+
+# Received uplinks wait in a bounded queue for the worker pool; when it is full
+# new uplinks are rejected instead of blocking the MQTT network thread
+MESSAGE_QUEUE_SIZE = 10000
+WORKER_COUNT = 4
+STATS_LOG_INTERVAL = 60  # seconds between queue, publisher and spool counter log lines
+
+# Messages Pub/Sub rejects and uplinks the queue cannot take are appended to an
+# on-disk spool and replayed in order once the sink recovers
+SPOOL_DIR = os.path.expanduser('~/forwarder_spool')
+SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024  # 16 MB per segment file
+SPOOL_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2 GB; the oldest segments are dropped beyond this
+SPOOL_FSYNC_INTERVAL = 0.2  # seconds; appends between fsyncs share one
+SPOOL_REPLAY_BATCH = 1000  # records replayed per offset commit
+
+# Node record times are logger local time; they are published as UTC with an explicit
+# offset, the same time base as the network server's receive time
+LOGGER_TIMEZONE = ZoneInfo('America/Chicago')
+
+# Gap repair: records arriving more than GAP_TOLERANCE collection intervals apart trigger a repair downlink
+COLLECTION_INTERVAL_MINUTES = 30
+GAP_TOLERANCE = 1.5
+
+# Duplicate suppression: the same uplink heard by several gateways, or resent by
+# the node (outbox retries, gap repair), is published once within DEDUP_TTL_HOURS
+DEDUP_TTL_HOURS = 72  # covers the furthest back a gap repair resends
+DEDUP_MAX_ENTRIES = 100000
+DEDUP_STATE_PATH = os.path.expanduser('~/forwarder_dedup.json')  # None keeps the cache in memory only
+
+# Last known value of every sensor per device, used to rebuild delta uplinks
+DELTA_STATE_PATH = os.path.expanduser('~/forwarder_delta.json')  # None keeps the state in memory only
 
 # Logging configuration
 LOG_FILENAME = os.path.expanduser('~/app.log')
@@ -68,44 +135,261 @@ def load_sensor_mapping():
         return None
 
 SENSOR_MAPPING = load_sensor_mapping()
+# Indexed once at startup; hash lookups per decoded value are dict hits
+SENSOR_REGISTRY = SensorRegistry(SENSOR_MAPPING or [])
+PAYLOAD_CODEC = PayloadCodec(SENSOR_REGISTRY)
+GAP_TRACKER = GapTracker(COLLECTION_INTERVAL_MINUTES, GAP_TOLERANCE)
+
+class PersistentDeltaDecoder(DeltaDecoder):
+    """
+    DeltaDecoder whose state survives forwarder restarts.
+
+    With a path the state is saved there (by save(), atomically) and reloaded
+    on start, so delta uplinks arriving after a restart are still rebuilt into
+    full rows instead of waiting for the device's next keyframe.
+    """
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading delta state from {self.path}: {str(e)}")
+            return
+        self.restore(snapshot)
+        logger.info(f"Loaded delta state of {len(snapshot)} devices from {self.path}")
+
+    def save(self):
+        if not self.path:
+            return
+        snapshot = self.snapshot()
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            logger.error(f"Error saving delta state to {self.path}: {str(e)}")
+
+# Fills in sensors a node left out of a delta uplink with their last known value
+DELTA_DECODER = PersistentDeltaDecoder(DELTA_STATE_PATH)
+
+class DedupCache:
+    """
+    TTL and size-bounded record of uplinks already processed.
+
+    Keys expire ttl_seconds after they were first seen; beyond max_entries the
+    oldest keys are evicted first. With a path the cache is saved there (by
+    save(), atomically) and reloaded on start, so duplicates arriving across a
+    restart are still caught.
+    """
+
+    def __init__(self, ttl_seconds, max_entries, path=None):
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.path = path
+        self.lock = threading.Lock()
+        # key -> expiry (epoch seconds), oldest first
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        if path:
+            self.load()
+
+    def seen(self, key, now=None):
+        """
+        Record key and report whether it was already present.
+
+        Args:
+            key (str): The uplink's dedup key.
+            now (float): Current epoch seconds; defaults to time.time().
+
+        Returns:
+            bool: True if the key was seen within the TTL (a duplicate).
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            self.expire(now)
+            if key in self.entries:
+                self.stats["hits"] += 1
+                return True
+            self.stats["misses"] += 1
+            self.entries[key] = now + self.ttl
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            return False
+
+    def expire(self, now):
+        # Called with the lock held; entries are in expiry order
+        while self.entries:
+            key, expiry = next(iter(self.entries.items()))
+            if expiry > now:
+                break
+            del self.entries[key]
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading dedup cache from {self.path}: {str(e)}")
+            return
+        now = time.time()
+        for key, expiry in sorted(entries.items(), key=lambda item: item[1])[-self.max_entries:]:
+            if expiry > now:
+                self.entries[key] = expiry
+        logger.info(f"Loaded {len(self.entries)} dedup keys from {self.path}")
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            entries = dict(self.entries)
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(entries, f)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            logger.error(f"Error saving dedup cache to {self.path}: {str(e)}")
+
+    def log_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self.entries)
+        logger.info("forwarder_dedup " + " ".join(f"{key}={value}" for key, value in stats.items()))
+
+DEDUP_CACHE = DedupCache(DEDUP_TTL_HOURS * 3600, DEDUP_MAX_ENTRIES, DEDUP_STATE_PATH)
+
+def dedup_key(device_name, records, raw_payload):
+    """
+    Build the duplicate-suppression key of an uplink.
+
+    The frame counter is not part of the key: a node's own resends go out with
+    a new one. The record time and a hash of the raw payload identify the same
+    packet however it reached the forwarder.
+
+    Args:
+        device_name (str): The uplink's deviceName.
+        records (list): The decoded records of the uplink.
+        raw_payload (bytes): The LoRa payload as received.
+
+    Returns:
+        str: The dedup key.
+    """
+    record_time = records[0].get('time', '') if records else ''
+    payload_hash = hashlib.blake2b(raw_payload, digest_size=12).hexdigest()
+    return f"{device_name}|{record_time}|{payload_hash}"
 
 def get_sensor_info(hash_value):
-    for sensor in SENSOR_MAPPING:
-        if sensor['hash'] == hash_value:
-            logger.debug(f"Found sensor info for hash {hash_value}: {json.dumps(sensor)}")
-            return sensor
+    sensor = SENSOR_REGISTRY.sensor_for_hash(hash_value)
+    if sensor:
+        logger.debug(f"Found sensor info for hash {hash_value}: {json.dumps(dict(sensor))}")
+        return sensor
     logger.warning(f"No sensor info found for hash {hash_value}")
     return None
 
 def prepare_pubsub_messages(decoded_payload, device_name, timestamp):
+    """
+    Turn one decoded record into Pub/Sub messages.
+
+    In the 'row' format the values of all sensors sharing a dataset and table
+    become one message:
+
+        {"schema_version": 2, "project_name": ..., "dataset_name": ..., "table_name": ...,
+         "timestamp": ..., "values": {sensor_id: value, ...}}
+
+    In the 'value' format every sensor value is its own message, as before.
+
+    Args:
+        decoded_payload (dict): The record, keyed by sensor hash.
+        device_name (str): The uplink's deviceName.
+        timestamp (str): ISO timestamp of the record.
+
+    Returns:
+        list: The messages to publish.
+    """
     logger.info(f"Preparing Pub/Sub messages for device {device_name} at {timestamp}")
     logger.debug(f"Decoded payload: {json.dumps(decoded_payload)}")
     messages = []
+    rows = {}
     for hash_value, value in decoded_payload.items():
         if hash_value != 'time':  # Skip the 'time' field
             sensor_info = get_sensor_info(hash_value)
             if sensor_info:
-                message = {
-                    "timestamp": timestamp,
-                    "sensor_id": sensor_info['sensor_id'],
-                    "value": value,
-                    "project_name": PROJECT_ID,
-                    "dataset_name": f"{sensor_info['field']}_trt{sensor_info['treatment']}",
-                    "table_name": f"plot_{sensor_info['plot_number']}"
-                }
-                logger.debug(f"Prepared message: {json.dumps(message)}")
-                messages.append(message)
+                dataset_name = f"{sensor_info['field']}_trt{sensor_info['treatment']}"
+                table_name = f"plot_{sensor_info['plot_number']}"
+                if PUBSUB_MESSAGE_FORMAT == 'value':
+                    message = {
+                        "timestamp": timestamp,
+                        "sensor_id": sensor_info['sensor_id'],
+                        "value": value,
+                        "project_name": PROJECT_ID,
+                        "dataset_name": dataset_name,
+                        "table_name": table_name
+                    }
+                    logger.debug(f"Prepared message: {json.dumps(message)}")
+                    messages.append(message)
+                else:
+                    row = rows.get((dataset_name, table_name))
+                    if row is None:
+                        row = rows[(dataset_name, table_name)] = {
+                            "schema_version": PUBSUB_SCHEMA_VERSION,
+                            "project_name": PROJECT_ID,
+                            "dataset_name": dataset_name,
+                            "table_name": table_name,
+                            "timestamp": timestamp,
+                            "values": {},
+                        }
+                    row["values"][sensor_info['sensor_id']] = value
             else:
                 logger.warning(f"No mapping found for hash: {hash_value}")
+    for row in rows.values():
+        logger.debug(f"Prepared message: {json.dumps(row)}")
+        messages.append(row)
     logger.info(f"Prepared {len(messages)} messages for Pub/Sub")
     return messages
 
-def process_message(message):
+def record_time_iso(row):
+    # e.g. "20240704132200" (CDT) -> "2024-07-04T18:22:00+00:00"
+    return parse_time(row['time']).replace(tzinfo=LOGGER_TIMEZONE).astimezone(timezone.utc).isoformat()
+
+def request_gap_repair(client, decoded_message, gaps):
+    """
+    Queue a downlink asking the node to resend the records in the given gaps.
+
+    Args:
+        client (mqtt.Client): The MQTT client instance.
+        decoded_message (dict): The uplink message that revealed the gaps.
+        gaps (list): (start, stop) datetime ranges of missing records.
+    """
+    device_name = decoded_message['deviceName']
+    downlink = {
+        "deviceName": device_name,
+        "devEUI": decoded_message.get('devEUI'),
+        "confirmed": False,
+        "fPort": REPAIR_FPORT,
+        "data": base64.b64encode(encode_repair_request(gaps)).decode('ascii'),
+    }
+    logger.info(f"Requesting repair of {len(gaps)} gaps from {device_name}: "
+                f"{', '.join(f'{start} - {stop}' for start, stop in gaps)}")
+    client.publish(EMQX_DOWNLINK_TOPIC, json.dumps(downlink))
+
+def process_message(message, client=None):
     """
     Process the received MQTT message.
 
     Args:
         message (mqtt.MQTTMessage): The received MQTT message.
+        client (mqtt.Client): The MQTT client, used to queue gap repair downlinks.
     """
     try:
         logger.info("Processing new MQTT message")
@@ -118,50 +402,626 @@ def process_message(message):
         payload = decoded_message['data']
         logger.debug(f"Base64 payload: {payload}")
         
-        decoded_payload = json.loads(base64.b64decode(payload).decode('utf-8'))
+        # Nodes send either the binary lora_payload format or legacy JSON; the codec accepts both
+        raw_payload = base64.b64decode(payload)
+        decoded_payload = PAYLOAD_CODEC.decode(raw_payload)
         logger.info(f"Decoded payload: {json.dumps(decoded_payload, indent=2)}")
 
-        # Prepare messages for Pub/Sub
         device_name = decoded_message['deviceName']
-        timestamp = decoded_message['time']
-        pubsub_messages = prepare_pubsub_messages(decoded_payload, device_name, timestamp)
+        records = expand_uplink(decoded_payload)
+        # Before any state is touched: a duplicate must not move delta or gap tracking either
+        if DEDUP_CACHE.seen(dedup_key(device_name, records, raw_payload)):
+            logger.info(f"Dropping duplicate uplink from {device_name} (fCnt {decoded_message.get('fCnt')})")
+            return
+        if 'batch' in decoded_payload:
+            logger.info(f"Expanding batch of {len(records)} records from {device_name}")
+        # Every row is stamped with its own logger time, never the receive time: outbox
+        # replays and gap repairs carry records hours or days old, possibly out of order
+        rows = [(row, record_time_iso(row)) for row in records]
+
+        pubsub_messages = []
+        gaps = []
+        for row, timestamp in rows:
+            gaps.extend(GAP_TRACKER.observe(device_name, row['time']))
+            if row.get('delta'):
+                logger.info(f"Rebuilding delta uplink from {DELTA_DECODER.known_sensors(device_name)} known sensors of {device_name}")
+            row = DELTA_DECODER.rebuild(device_name, row)
+
+            # Prepare messages for Pub/Sub
+            pubsub_messages.extend(prepare_pubsub_messages(row, device_name, timestamp))
 
         # Publish messages to Pub/Sub
         for msg in pubsub_messages:
             publish_to_pubsub(msg)
 
+        if gaps and client is not None:
+            request_gap_repair(client, decoded_message, gaps)
+
+    except PayloadError as e:
+        logger.error(f"Malformed LoRa payload: {str(e)}")
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
         logger.exception("Full traceback:")
 
-def publish_to_pubsub(data, retry_count=0):
+def encode_pubsub_message(data):
+    """
+    Build the publish arguments for a message.
+
+    The schema version is also set as a message attribute, so subscriptions can
+    filter on it while consumers migrate.
+
+    Args:
+        data (dict): The message to publish.
+
+    Returns:
+        dict: The data and attribute keyword arguments for PublisherClient.publish.
     """
-    Publish data to Google Cloud Pub/Sub using default credentials.
+    return {
+        "data": json.dumps(data, separators=(',', ':')).encode('utf-8'),
+        "schema_version": str(data.get("schema_version", 1)),
+    }
+
+class PubSubPublisher:
+    """
+    Process-wide Pub/Sub publisher.
+
+    One PublisherClient (one gRPC channel) is shared by every message. The client
+    batches publishes by count, size and latency, and completion is reported
+    through future callbacks, so publishing never waits for a round trip.
+    """
+
+    def __init__(self, project_id, topic_id, batch_settings, publisher_options=None):
+        self.client = pubsub_v1.PublisherClient(batch_settings=batch_settings, publisher_options=publisher_options)
+        self.topic_path = self.client.topic_path(project_id, topic_id)
+        self.lock = threading.Lock()
+        self.stats = {"submitted": 0, "published": 0, "failed": 0, "pending": 0}
+
+    def publish(self, data):
+        future = self.client.publish(self.topic_path, **encode_pubsub_message(data))
+        with self.lock:
+            self.stats["submitted"] += 1
+            self.stats["pending"] += 1
+        future.add_done_callback(lambda f: self.on_done(f, data))
+        return future
+
+    def on_done(self, future, data):
+        # Runs on the client's callback thread; must not block
+        with self.lock:
+            self.stats["pending"] -= 1
+        try:
+            message_id = future.result()
+        except Exception as e:
+            with self.lock:
+                self.stats["failed"] += 1
+            logger.error(f"Error publishing to Pub/Sub, spooling message for replay: {str(e)}")
+            get_spool().append({"kind": "pubsub", "data": data})
+            return
+
+        with self.lock:
+            self.stats["published"] += 1
+        logger.debug(f"Successfully published message with ID: {message_id}")
+
+    def log_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        logger.info("pubsub_publisher " + " ".join(f"{key}={value}" for key, value in stats.items()))
+
+    def stop(self):
+        # Flushes any partially filled batch before the client shuts down
+        self.client.stop()
+        self.log_stats()
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+def get_publisher():
+    """
+    Return the process-wide Pub/Sub publisher, creating it on first use.
+
+    Returns:
+        PubSubPublisher: The shared publisher.
+    """
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            batch_settings = pubsub_v1.types.BatchSettings(
+                max_messages=PUBSUB_BATCH_MAX_MESSAGES,
+                max_bytes=PUBSUB_BATCH_MAX_BYTES,
+                max_latency=PUBSUB_BATCH_MAX_LATENCY,
+            )
+            # Blocking flow control pushes back on the publishing workers, which
+            # fills the message queue, rather than buffering without limit
+            publisher_options = pubsub_v1.types.PublisherOptions(
+                flow_control=pubsub_v1.types.PublishFlowControl(
+                    message_limit=PUBSUB_FLOW_MAX_MESSAGES,
+                    byte_limit=PUBSUB_FLOW_MAX_BYTES,
+                    limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+                )
+            )
+            _publisher = PubSubPublisher(PROJECT_ID, TOPIC_ID, batch_settings, publisher_options)
+            logger.info(f"Created Pub/Sub publisher for {_publisher.topic_path} "
+                        f"(batches of up to {PUBSUB_BATCH_MAX_MESSAGES} messages, "
+                        f"{PUBSUB_BATCH_MAX_BYTES} bytes or {PUBSUB_BATCH_MAX_LATENCY * 1000:.0f} ms)")
+        return _publisher
+
+def publish_to_pubsub(data):
+    """
+    Queue data for publishing to Google Cloud Pub/Sub using default credentials.
+
+    The message joins the shared publisher's current batch and this call returns
+    immediately; success or failure is recorded by the completion callback, and
+    failed messages go to the spool.
 
     Args:
         data (dict): The data to publish to Pub/Sub.
-        retry_count (int): The current retry count.
     """
     try:
-        logger.info("Attempting to publish message to Pub/Sub")
-        logger.debug(f"Message data: {json.dumps(data, indent=2)}")
-        
-        publisher = pubsub_v1.PublisherClient()
-        topic_path = publisher.topic_path(PROJECT_ID, TOPIC_ID)
-        data_str = json.dumps(data)
-        future = publisher.publish(topic_path, data=data_str.encode('utf-8'))
-        message_id = future.result()  # Wait for the publish to complete
-        logger.info(f"Successfully published message with ID: {message_id}")
-        logger.debug(f"Published data: {data_str}")
+        logger.debug(f"Queueing message for Pub/Sub: {json.dumps(data)}")
+        get_publisher().publish(data)
     except Exception as e:
-        logger.error(f"Error publishing to Pub/Sub: {str(e)}")
-        logger.error(f"Failed data: {json.dumps(data, indent=2)}")
-        if retry_count < MAX_RETRIES:
-            logger.info(f"Retrying in {RETRY_DELAY} seconds... (Attempt {retry_count + 1}/{MAX_RETRIES})")
-            time.sleep(RETRY_DELAY)
-            publish_to_pubsub(data, retry_count + 1)
+        logger.error(f"Error queueing message for Pub/Sub, spooling it for replay: {str(e)}")
+        get_spool().append({"kind": "pubsub", "data": data})
+
+SpooledMessage = namedtuple('SpooledMessage', ['topic', 'payload'])
+
+class Spool:
+    """
+    Append-only, segment-based on-disk spool.
+
+    Records are JSON documents framed as uint32 length, uint32 CRC-32, payload,
+    and appended to numbered segment files of up to segment_bytes. Appends are
+    buffered and fsynced together every fsync_interval seconds by a background
+    thread, outside the lock, so an append never waits for the disk. Replay reads
+    frame by frame through a reader kept open across batches, so each batch costs
+    only its own records however large the segment. The replay position is kept
+    in an offset file replaced atomically after each committed batch; segments
+    behind it are deleted. After a crash, a torn record at the end of the newest
+    segment is truncated and replay resumes from the last committed offset, so
+    records are delivered at least once. When the spool outgrows max_bytes the
+    oldest segment is dropped.
+    """
+
+    FRAME = struct.Struct('>II')
+    OFFSET_FILE = 'offset.json'
+
+    def __init__(self, directory, segment_bytes, max_bytes, fsync_interval):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.has_data = threading.Event()
+        self.stopped = threading.Event()
+        self.stats = {"appended": 0, "replayed": 0, "dropped_segments": 0, "fsyncs": 0}
+        self.unsynced = 0
+        # (segment, open file) the replay thread reads from, positioned after the last batch
+        self.reader = None
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = {}
+        for name in os.listdir(directory):
+            if name.endswith('.seg'):
+                self.segments[int(name[:-4])] = os.path.getsize(os.path.join(directory, name))
+        self.read_segment, self.read_position = self.load_offset()
+        for segment in [segment for segment in self.segments if segment < self.read_segment]:
+            self.delete_segment(segment)
+
+        if self.segments:
+            self.write_segment = max(self.segments)
+            self.recover_tail(self.write_segment)
         else:
-            logger.error("Max retries reached. Skipping message.")
+            self.write_segment = self.read_segment
+            self.segments[self.write_segment] = 0
+        if self.read_segment not in self.segments:
+            self.read_segment, self.read_position = min(self.segments), 0
+        self.writer = open(self.segment_path(self.write_segment), 'ab')
+        if self.backlog_bytes() > 0:
+            self.has_data.set()
+
+        self.flusher = threading.Thread(target=self.run_flusher, name='spool-fsync', daemon=True)
+        self.flusher.start()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}.seg")
+
+    def load_offset(self):
+        try:
+            with open(os.path.join(self.directory, self.OFFSET_FILE), 'r') as f:
+                offset = json.load(f)
+            return int(offset['segment']), int(offset['position'])
+        except (OSError, ValueError, KeyError):
+            return (min(self.segments) if self.segments else 0), 0
+
+    def save_offset(self, segment, position):
+        path = os.path.join(self.directory, self.OFFSET_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({"segment": segment, "position": position}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def recover_tail(self, segment):
+        # Keeps the newest segment up to its last complete, checksummed record
+        path = self.segment_path(segment)
+        with open(path, 'rb') as f:
+            data = f.read()
+        position = 0
+        while position + self.FRAME.size <= len(data):
+            length, crc = self.FRAME.unpack_from(data, position)
+            end = position + self.FRAME.size + length
+            if end > len(data) or zlib.crc32(data[position + self.FRAME.size:end]) != crc:
+                break
+            position = end
+        if position < len(data):
+            logger.warning(f"Truncating {len(data) - position} bytes of incomplete spool records from {path}")
+            with open(path, 'r+b') as f:
+                f.truncate(position)
+        self.segments[segment] = position
+
+    def delete_segment(self, segment):
+        try:
+            os.remove(self.segment_path(segment))
+        except OSError as e:
+            logger.error(f"Error deleting spool segment {segment}: {str(e)}")
+        self.segments.pop(segment, None)
+
+    def backlog_bytes(self):
+        sizes = sum(self.segments.values())
+        return max(0, sizes - self.read_position)
+
+    def append(self, record):
+        data = json.dumps(record).encode('utf-8')
+        frame = self.FRAME.pack(len(data), zlib.crc32(data)) + data
+        with self.lock:
+            if self.segments[self.write_segment] and self.segments[self.write_segment] + len(frame) > self.segment_bytes:
+                self.roll()
+            self.writer.write(frame)
+            self.segments[self.write_segment] += len(frame)
+            self.unsynced += 1
+            self.stats["appended"] += 1
+            self.enforce_limit()
+            self.has_data.set()
+
+    def roll(self):
+        # Called with the lock held
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.writer.close()
+        self.write_segment += 1
+        self.segments[self.write_segment] = 0
+        self.writer = open(self.segment_path(self.write_segment), 'ab')
+
+    def enforce_limit(self):
+        # Called with the lock held
+        while sum(self.segments.values()) > self.max_bytes and len(self.segments) > 1:
+            oldest = min(self.segments)
+            logger.error(f"Spool exceeds {self.max_bytes} bytes; dropping segment {oldest} "
+                         f"({self.segments[oldest]} bytes of unreplayed messages)")
+            self.delete_segment(oldest)
+            self.stats["dropped_segments"] += 1
+            if self.read_segment == oldest:
+                self.read_segment, self.read_position = min(self.segments), 0
+
+    def sync(self):
+        # The buffer is flushed under the lock; the fsync runs on a duplicate descriptor
+        # outside it, so appends carry on and a roll may close the writer meanwhile
+        with self.lock:
+            if not self.unsynced:
+                return
+            self.writer.flush()
+            fd = os.dup(self.writer.fileno())
+            self.unsynced = 0
+            self.stats["fsyncs"] += 1
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def run_flusher(self):
+        while not self.stopped.wait(self.fsync_interval):
+            self.sync()
+
+    def read_batch(self, max_records):
+        """
+        Read up to max_records spooled records from the replay position.
+
+        Returns:
+            list: (record, (segment, position) just past it) tuples, in spool order.
+        """
+        self.sync()
+        with self.lock:
+            # Only whole frames, up to the sizes recorded by append, are read
+            self.writer.flush()
+            start = (self.read_segment, self.read_position)
+            last_segment = self.write_segment
+            sizes = dict(self.segments)
+        segment, position = start
+        batch = []
+        while True:
+            size = sizes.get(segment, 0)
+            f = self.reader_at(segment, position)
+            while f is not None and len(batch) < max_records and position + self.FRAME.size <= size:
+                length, crc = self.FRAME.unpack(f.read(self.FRAME.size))
+                end = position + self.FRAME.size + length
+                payload = f.read(length) if end <= size else b''
+                if end > size or len(payload) != length or zlib.crc32(payload) != crc:
+                    logger.error(f"Corrupt record in spool segment {segment} at {position}; skipping the rest of it")
+                    position = size
+                    batch.append(({"kind": "skip"}, (segment, position)))
+                    self.close_reader()
+                    break
+                position = end
+                batch.append((json.loads(payload), (segment, position)))
+            if len(batch) >= max_records or segment >= last_segment:
+                break
+            segment, position = segment + 1, 0
+        if not batch and (segment, position) != start:
+            # Moved past fully replayed segments without finding new records
+            batch.append(({"kind": "skip"}, (segment, position)))
+        return batch
+
+    def reader_at(self, segment, position):
+        # Called from the replay thread only; reopens only when the segment changes
+        # and seeks only when the last batch was not committed as read
+        if self.reader is None or self.reader[0] != segment:
+            self.close_reader()
+            try:
+                self.reader = (segment, open(self.segment_path(segment), 'rb'))
+            except FileNotFoundError:
+                return None
+        f = self.reader[1]
+        if f.tell() != position:
+            f.seek(position)
+        return f
+
+    def close_reader(self):
+        if self.reader is not None:
+            self.reader[1].close()
+            self.reader = None
+
+    def commit(self, offset):
+        # Marks everything up to offset as replayed
+        segment, position = offset
+        self.save_offset(segment, position)
+        with self.lock:
+            self.read_segment, self.read_position = segment, position
+            for old in [old for old in self.segments if old < segment]:
+                self.delete_segment(old)
+            if self.read_segment == self.write_segment and self.read_position >= self.segments[self.write_segment]:
+                self.has_data.clear()
+
+    def log_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["segments"] = len(self.segments)
+            stats["backlog_bytes"] = self.backlog_bytes()
+        logger.info("forwarder_spool " + " ".join(f"{key}={value}" for key, value in stats.items()))
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join()
+        self.sync()
+        self.close_reader()
+        with self.lock:
+            self.writer.close()
+
+_spool = None
+_spool_lock = threading.Lock()
+
+def get_spool():
+    """
+    Return the process-wide spool, opening it (and recovering it after a crash) on first use.
+
+    Returns:
+        Spool: The shared spool.
+    """
+    global _spool
+    with _spool_lock:
+        if _spool is None:
+            _spool = Spool(SPOOL_DIR, SPOOL_SEGMENT_BYTES, SPOOL_MAX_BYTES, SPOOL_FSYNC_INTERVAL)
+            backlog = _spool.backlog_bytes()
+            if backlog:
+                logger.info(f"Spool at {SPOOL_DIR} holds {backlog} bytes of messages to replay")
+        return _spool
+
+def replay_batch(batch, client):
+    """
+    Replay spooled records in order and return the offset of the last one delivered.
+
+    Pub/Sub messages of the batch are published together and awaited; spooled
+    uplinks go back to the worker pool. Replay stops at the first failure so the
+    records after it stay spooled.
+
+    Args:
+        batch (list): (record, offset) tuples from Spool.read_batch.
+        client (mqtt.Client): The MQTT client, passed on with replayed uplinks.
+
+    Returns:
+        tuple: The (segment, position) to commit, or None if nothing was delivered.
+    """
+    publisher = get_publisher()
+    futures = []
+    for record, offset in batch:
+        if record.get('kind') == 'skip':
+            futures.append((None, offset))
+        elif record.get('kind') == 'pubsub':
+            futures.append((publisher.client.publish(publisher.topic_path, **encode_pubsub_message(record['data'])), offset))
+        else:
+            message = SpooledMessage(record.get('topic'), base64.b64decode(record['payload']))
+            if not get_workers().submit(message, client, routing_key(message.payload)):
+                futures.append((False, offset))
+                break
+            futures.append((None, offset))
+
+    delivered = None
+    for future, offset in futures:
+        if future is False:
+            break
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"Spool replay paused, Pub/Sub still failing: {str(e)}")
+                break
+        delivered = offset
+    return delivered
+
+def replay_spool(client, stop_event):
+    """
+    Replay the spool whenever it has records, backing off RETRY_DELAY seconds while the sink fails.
+
+    Args:
+        client (mqtt.Client): The MQTT client, passed on with replayed uplinks.
+        stop_event (threading.Event): Set to end the loop.
+    """
+    spool = get_spool()
+    while not stop_event.is_set():
+        if not spool.has_data.wait(timeout=1):
+            continue
+        batch = spool.read_batch(SPOOL_REPLAY_BATCH)
+        if not batch:
+            # Caught up; committing the current position clears has_data
+            spool.commit((spool.read_segment, spool.read_position))
+            continue
+        delivered = replay_batch(batch, client)
+        if delivered is not None:
+            done = next(i for i, (_, offset) in enumerate(batch) if offset == delivered) + 1
+            replayed = sum(1 for record, _ in batch[:done] if record.get('kind') != 'skip')
+            spool.commit(delivered)
+            with spool.lock:
+                spool.stats["replayed"] += replayed
+            if replayed:
+                logger.info(f"Replayed {replayed} spooled messages")
+        if delivered != batch[-1][1]:
+            stop_event.wait(RETRY_DELAY)
+
+def routing_key(payload):
+    """
+    Return the device name of a raw uplink, used to pick its worker.
+
+    Args:
+        payload (bytes): The raw MQTT message payload.
+
+    Returns:
+        str: The deviceName, or an empty string if the payload cannot be read.
+    """
+    try:
+        return str(json.loads(payload).get('deviceName', ''))
+    except Exception:
+        return ''
+
+class MessageWorkers:
+    """
+    Bounded queues drained by a pool of worker threads.
+
+    Each device always maps to the same worker, so its uplinks are processed in
+    arrival order and the delta and gap state of one device is only touched by
+    one thread. submit() never blocks: when a worker's queue is full the message
+    is rejected and counted.
+    """
+
+    def __init__(self, handler, worker_count, queue_size):
+        self.handler = handler
+        self.queues = [queue.Queue(maxsize=max(1, queue_size // worker_count)) for _ in range(worker_count)]
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stats = {"received": 0, "rejected": 0, "processed": 0, "errors": 0, "max_depth": 0}
+
+    def start(self):
+        for index, work_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self.run, args=(work_queue,), name=f"forwarder-worker-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, message, client, key=''):
+        work_queue = self.queues[zlib.crc32(key.encode('utf-8')) % len(self.queues)]
+        try:
+            work_queue.put_nowait((message, client))
+        except queue.Full:
+            with self.lock:
+                self.stats["received"] += 1
+                self.stats["rejected"] += 1
+            return False
+        depth = self.depth()
+        with self.lock:
+            self.stats["received"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], depth)
+        return True
+
+    def depth(self):
+        return sum(work_queue.qsize() for work_queue in self.queues)
+
+    def run(self, work_queue):
+        while True:
+            item = work_queue.get()
+            try:
+                if item is None:
+                    return
+                self.handler(*item)
+                with self.lock:
+                    self.stats["processed"] += 1
+            except Exception as e:
+                with self.lock:
+                    self.stats["errors"] += 1
+                logger.error(f"Worker failed to process message: {str(e)}")
+            finally:
+                work_queue.task_done()
+
+    def join(self):
+        # Blocks until every queued message has been processed
+        for work_queue in self.queues:
+            work_queue.join()
+
+    def log_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["depth"] = self.depth()
+        logger.info("forwarder_queue " + " ".join(f"{key}={value}" for key, value in stats.items()))
+
+    def stop(self):
+        # Processes what is already queued, then ends the workers
+        for work_queue in self.queues:
+            work_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+_workers = None
+_workers_lock = threading.Lock()
+
+def get_workers():
+    """
+    Return the process-wide worker pool, starting it on first use.
+
+    Returns:
+        MessageWorkers: The running worker pool.
+    """
+    global _workers
+    with _workers_lock:
+        if _workers is None:
+            _workers = MessageWorkers(process_message, WORKER_COUNT, MESSAGE_QUEUE_SIZE)
+            _workers.start()
+            logger.info(f"Started {WORKER_COUNT} workers with a queue of {MESSAGE_QUEUE_SIZE} messages")
+        return _workers
+
+def log_stats_periodically(stop_event):
+    """
+    Log queue, publisher, spool and dedup counters every STATS_LOG_INTERVAL seconds,
+    and save the dedup cache and delta state.
+
+    Args:
+        stop_event (threading.Event): Set to end the loop.
+    """
+    while not stop_event.wait(STATS_LOG_INTERVAL):
+        if _workers is not None:
+            _workers.log_stats()
+        if _publisher is not None:
+            _publisher.log_stats()
+        if _spool is not None:
+            _spool.log_stats()
+        DEDUP_CACHE.log_stats()
+        DEDUP_CACHE.save()
+        DELTA_DECODER.save()
 
 def on_connect(client, userdata, flags, rc):
     """
@@ -189,8 +1049,15 @@ def on_message(client, userdata, message):
         userdata (Any): User-defined data passed to the callback.
         message (mqtt.MQTTMessage): The received MQTT message.
     """
-    logger.info(f"Received new message on topic: {message.topic}")
-    process_message(message)
+    logger.debug(f"Received new message on topic: {message.topic}")
+    # Decoding and publishing happen on the worker pool, never on paho's network thread
+    if not get_workers().submit(message, client, routing_key(message.payload)):
+        logger.warning("Message queue full; spooling uplink for replay")
+        get_spool().append({
+            "kind": "uplink",
+            "topic": message.topic,
+            "payload": base64.b64encode(message.payload).decode('ascii'),
+        })
 
 def main():
     client = mqtt.Client(protocol=mqtt.MQTTv311)
@@ -199,6 +1066,12 @@ def main():
     client.on_connect = on_connect
     client.on_message = on_message
     
+    workers = get_workers()
+    stop_threads = threading.Event()
+    threading.Thread(target=log_stats_periodically, args=(stop_threads,), daemon=True).start()
+    replay = threading.Thread(target=replay_spool, args=(client, stop_threads), name='spool-replay', daemon=True)
+    replay.start()
+
     logger.info(f"Attempting to connect to EMQX Cloud at {EMQX_HOST}:{EMQX_PORT}...")
     try:
         client.connect(EMQX_HOST, EMQX_PORT)
@@ -207,6 +1080,19 @@ def main():
     except Exception as e:
         logger.error(f"Failed to connect to EMQX Cloud: {str(e)}")
         logger.exception("Full traceback:")
+    finally:
+        stop_threads.set()
+        replay.join()
+        workers.stop()
+        workers.log_stats()
+        if _publisher is not None:
+            _publisher.stop()
+        # Last, so publishes failing during shutdown still reach the disk
+        get_spool().log_stats()
+        get_spool().close()
+        DEDUP_CACHE.log_stats()
+        DEDUP_CACHE.save()
+        DELTA_DECODER.save()
 
 if __name__ == "__main__":
     logger.info("Starting EMQX to Pub/Sub Bridge")
@@ -31,6 +31,15 @@ else
     echo "Warning: emqxsl-ca.crt not found in the home directory."
 fi
 
+# Install the shared payload codec next to the forwarder script
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+if [ -d "$SCRIPT_DIR/../lora_payload" ]; then
+    rm -rf $HOME/lora_payload
+    cp -r "$SCRIPT_DIR/../lora_payload" $HOME/lora_payload
+elif [ ! -d "$HOME/lora_payload" ]; then
+    echo "Warning: lora_payload package not found. Copy it from the repository root to your home directory."
+fi
+
 # Set appropriate permissions for the Python script
 chmod +x $HOME/emqx_to_pubsub.py
 
@@ -63,6 +72,6 @@ echo "sudo systemctl status emqx_to_pubsub.service"
 echo "And view the logs with:"
 echo "tail -f $HOME/app.log"
 
-echo "Please ensure that the sensor_mapping.yaml file is present in your home directory."
+echo "Please ensure that the sensor_mapping.yaml file and the lora_payload directory are present in your home directory."
 echo "If you need to make any changes, edit the $HOME/emqx_to_pubsub.py file and restart the service with:"
 echo "sudo systemctl restart emqx_to_pubsub.service"
\ No newline at end of file
@@ -3,14 +3,30 @@ from .data_logger import (
     get_tables,
     get_data,
     get_logger_time,  # Add this line
+    get_new_data,
+    advance_watermark,
+    needs_backfill,
+    backfill_data,
     reboot_system,
     wait_for_usb_device,
+    DataloggerSession,
 )
 from .system_functions import update_system_time
-from .database_functions import setup_database, insert_data_to_db
+from .database_functions import (
+    setup_database,
+    insert_data_to_db,
+    setup_watermark_table,
+    get_watermark,
+    update_watermark,
+    NodeDatabase,
+    get_node_database,
+    close_databases,
+)
+from .retention_functions import RetentionManager, update_rollups, run_maintenance
 from .utils import (
     load_config,
     load_sensor_metadata,
+    load_sensor_registry,
     get_sensor_hash,
     setup_logger,
     get_project_root,
@@ -18,4 +34,9 @@ from .utils import (
     reset_reboot_counter,
     read_reboot_counter,
 )
-from .lora_functions import send_lora_data
+from .outbox_functions import LoRaOutbox
+from .delta_functions import DeltaFilter
+from .airtime_functions import AirtimeScheduler
+from .batch_functions import RecordBatcher
+from .repair_functions import parse_repair_requests, select_repair_records
+from .lora_functions import LoRaManager, create_lora_session, send_lora_data, hash_lora_data, build_lora_chunks, drain_outbox
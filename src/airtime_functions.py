@@ -0,0 +1,138 @@
+import time
+import random
+from .utils import setup_logger
+from .database_functions import get_node_database
+from lora_payload import time_on_air, region_limits
+
+logger = setup_logger("airtime_functions", "airtime_functions.log")
+
+DUTY_CYCLE_WINDOW = 3600  # seconds; duty cycle is enforced over a rolling hour
+LEDGER_RETENTION = 86400  # seconds of ledger kept for the daily figures
+
+class AirtimeScheduler:
+    # Decides when, and whether, queued uplinks may go out. Every transmission is
+    # recorded in a rolling airtime ledger in the node database; packets are
+    # admitted only while the region's duty cycle (or an optional daily budget,
+    # e.g. a network's fair-use policy) allows, and are spread over the
+    # transmission window at a random point within equal slots so nodes on the
+    # same schedule do not keep colliding.
+    def __init__(self, db_name, lora_config, schedule_config, rng=None):
+        self.db = get_node_database(db_name)
+        self.region = lora_config['region']
+        self.data_rate = lora_config['data_rate']
+        limits = region_limits(self.region)
+        self.duty_cycle = lora_config.get('duty_cycle', limits['duty_cycle'])
+        self.max_dwell = lora_config.get('max_dwell', limits['max_dwell'])
+        self.daily_limit = lora_config.get('daily_airtime_limit')
+        self.window = schedule_config['transmission_window']
+        self.min_interval = schedule_config['min_interval']
+        self.rng = rng or random.Random()
+        self.setup()
+
+    def setup(self):
+        with self.db.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lora_airtime_ledger ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "sent_at REAL NOT NULL, "
+                "payload_size INTEGER NOT NULL, "
+                "airtime REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_lora_airtime_sent_at ON lora_airtime_ledger (sent_at)")
+
+    def airtime(self, payload_size):
+        return time_on_air(payload_size, self.region, self.data_rate)
+
+    def used(self, seconds, now=None):
+        now = time.time() if now is None else now
+        row = self.db.connect().execute(
+            "SELECT COALESCE(SUM(airtime), 0) FROM lora_airtime_ledger WHERE sent_at > ?", (now - seconds,)
+        ).fetchone()
+        return row[0]
+
+    def budget(self, now=None):
+        # Remaining airtime in seconds before a regulatory or configured limit is hit
+        remaining = []
+        if self.duty_cycle:
+            remaining.append(self.duty_cycle * DUTY_CYCLE_WINDOW - self.used(DUTY_CYCLE_WINDOW, now))
+        if self.daily_limit:
+            remaining.append(self.daily_limit - self.used(LEDGER_RETENTION, now))
+        return min(remaining) if remaining else float("inf")
+
+    def admit(self, payload_sizes, now=None):
+        # Returns (admitted indexes, rejected indexes with reasons). Packets longer than
+        # the dwell limit can never be sent; once the budget is spent the rest wait for
+        # a later cycle, keeping their order.
+        budget = self.budget(now)
+        admitted, rejected = [], []
+        for i, size in enumerate(payload_sizes):
+            airtime = self.airtime(size)
+            if self.max_dwell and airtime > self.max_dwell:
+                rejected.append((i, f"{airtime * 1000:.0f} ms on air exceeds the {self.max_dwell * 1000:.0f} ms dwell limit"))
+                continue
+            if airtime > budget:
+                logger.warning(
+                    f"Airtime budget exhausted ({budget:.2f} s left); deferring {len(payload_sizes) - i} packets"
+                )
+                break
+            budget -= airtime
+            admitted.append(i)
+        return admitted, rejected
+
+    def spacing(self, airtime):
+        # Under a duty cycle each transmission must be followed by airtime * (1/dc - 1) of silence
+        if self.duty_cycle:
+            return max(self.min_interval, airtime * (1 / self.duty_cycle - 1))
+        return self.min_interval
+
+    def plan(self, airtimes):
+        # Start offsets, in seconds from now, for as many packets as fit the window.
+        # The window is split into one slot per packet and each packet starts at a
+        # random point in its slot, never earlier than the spacing after the previous
+        # one allows. Packets that would end past the window are left for the next
+        # cycle; the first one always goes so a long window overrun cannot starve it.
+        if not airtimes:
+            return []
+        slot = self.window / len(airtimes)
+        offsets = []
+        earliest = 0.0
+        for i, airtime in enumerate(airtimes):
+            offset = max(i * slot + self.rng.uniform(0, max(0.0, slot - airtime)), earliest)
+            if offsets and offset + airtime > self.window:
+                logger.warning(
+                    f"Only {len(offsets)} of {len(airtimes)} packets fit the {self.window} s transmission window "
+                    "with the required spacing; deferring the rest"
+                )
+                break
+            offsets.append(offset)
+            earliest = offset + airtime + self.spacing(airtime)
+        return offsets
+
+    def record(self, payload_size, airtime=None, now=None):
+        now = time.time() if now is None else now
+        airtime = self.airtime(payload_size) if airtime is None else airtime
+        with self.db.connect() as conn:
+            conn.execute(
+                "INSERT INTO lora_airtime_ledger (sent_at, payload_size, airtime) VALUES (?, ?, ?)",
+                (now, payload_size, airtime),
+            )
+            conn.execute("DELETE FROM lora_airtime_ledger WHERE sent_at < ?", (now - LEDGER_RETENTION,))
+
+    def utilization(self, now=None):
+        hour = self.used(DUTY_CYCLE_WINDOW, now)
+        day = self.used(LEDGER_RETENTION, now)
+        metrics = {
+            "airtime_hour_s": round(hour, 3),
+            "airtime_day_s": round(day, 3),
+            "utilization_hour": round(hour / DUTY_CYCLE_WINDOW, 5),
+        }
+        if self.duty_cycle:
+            metrics["duty_cycle_used"] = round(hour / (self.duty_cycle * DUTY_CYCLE_WINDOW), 4)
+        if self.daily_limit:
+            metrics["daily_budget_used"] = round(day / self.daily_limit, 4)
+        return metrics
+
+    def log_utilization(self):
+        metrics = self.utilization()
+        logger.info("airtime_utilization " + " ".join(f"{key}={value}" for key, value in metrics.items()))
+        return metrics
@@ -0,0 +1,57 @@
+import json
+from datetime import timedelta
+from .utils import setup_logger
+from .database_functions import get_node_database
+from lora_payload import parse_time
+
+logger = setup_logger("batch_functions", "batch_functions.log")
+
+DEFAULT_RECORDS_PER_UPLINK = 4
+DEFAULT_MAX_AGE_HOURS = 6
+
+class RecordBatcher:
+    # Holds hashed records in the node database until records_per_uplink cycles
+    # have accumulated (or the oldest has waited max_age_hours of logger time), then
+    # releases them together so they can share one multi-interval uplink. Pending
+    # records survive restarts; a released batch moves to the outbox in the same
+    # cycle, so nothing is held in memory between cycles.
+    def __init__(self, db_name, batch_config=None):
+        self.db = get_node_database(db_name)
+        self.config = batch_config or {}
+        self.setup()
+
+    def setup(self):
+        with self.db.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lora_batch_pending (record_time TEXT PRIMARY KEY, record TEXT NOT NULL)"
+            )
+
+    def pending(self):
+        cursor = self.db.connect().execute("SELECT record FROM lora_batch_pending ORDER BY record_time")
+        return [json.loads(row[0]) for row in cursor]
+
+    def add(self, hashed_data):
+        # Returns the records to send now, oldest first, or an empty list while the batch fills
+        with self.db.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO lora_batch_pending (record_time, record) VALUES (?, ?)",
+                (hashed_data["time"], json.dumps(hashed_data, default=str)),
+            )
+        records = self.pending()
+
+        size = self.config.get("records_per_uplink", DEFAULT_RECORDS_PER_UPLINK)
+        max_age = timedelta(hours=self.config.get("max_age_hours", DEFAULT_MAX_AGE_HOURS))
+        oldest = parse_time(records[0]["time"])
+        newest = parse_time(records[-1]["time"])
+        if len(records) < size and newest - oldest < max_age:
+            logger.info(f"Batched record {hashed_data['time']} ({len(records)}/{size}); nothing to send yet")
+            return []
+
+        logger.info(f"Releasing batch of {len(records)} records from {records[0]['time']} to {records[-1]['time']}")
+        return records
+
+    def clear(self, records):
+        with self.db.connect() as conn:
+            conn.executemany(
+                "DELETE FROM lora_batch_pending WHERE record_time = ?", ((record["time"],) for record in records)
+            )
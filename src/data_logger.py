@@ -1,17 +1,19 @@
-from pycampbellcr1000 import CR1000
 from datetime import datetime, timedelta
 import os
-import math
 import json
 import time
-import subprocess
 from .utils import setup_logger, increment_reboot_counter
+from .database_functions import get_watermark, update_watermark, setup_database, insert_data_to_db
 
 logger = setup_logger("data_logger", "data_logger.log")
 
 MAX_RETRIES = 5
 MAX_DELAY = 180  # 3 minutes
 MAX_REBOOTS = 5
+DEFAULT_LOOKBACK_DAYS = 2  # How far back to collect when a table has no watermark yet
+BACKFILL_THRESHOLD_MINUTES = 60  # Gaps longer than this are collected in chunks
+BACKFILL_CHUNK_MINUTES = 360
+BACKFILL_MAX_CHUNK_RECORDS = 500  # Most records stored per chunk; denser windows are refetched in halves
 
 def exponential_backoff(attempt):
     return min(MAX_DELAY, (2 ** attempt) * 5)  # 5, 10, 20, 40, 80, 160 seconds
@@ -42,6 +44,8 @@ def wait_for_usb_device(device_path, timeout=300, check_interval=1):
     return False
 
 def connect_to_datalogger(config):
+    # Imported here so that src can be imported without the logger driver (e.g. by the exporter)
+    from pycampbellcr1000 import CR1000
     for attempt in range(MAX_RETRIES):
         try:
             logger.info(f"Attempting to connect to datalogger on port {config['port']} (Attempt {attempt + 1}/{MAX_RETRIES})")
@@ -85,45 +89,79 @@ def get_tables(datalogger):
             if attempt < MAX_RETRIES - 1:
                 logger.info(f"Retrying in {delay} seconds...")
                 time.sleep(delay)
-                # Attempt to re-establish connection
-                try:
-                    datalogger = CR1000.from_url(f"serial:{datalogger.url.split(':')[1]}:{datalogger.url.split(':')[2]}")
-                except Exception as conn_err:
-                    logger.error(f"Failed to re-establish connection: {conn_err}")
             else:
                 logger.error("Max retries reached. Unable to retrieve table names.")
                 return []
 
     return []
 
-def get_data(datalogger, table_name, start, stop):
+NUMERIC_FIELD_TYPES = {
+    "IEEE4", "IEEE4B", "IEEE4L", "IEEE8", "IEEE8B", "FP2", "FP4",
+    "UINT1", "UINT2", "UINT4", "INT1", "INT2", "INT4", "BOOL", "BOOL2", "BOOL4",
+}
+NAN_REPLACEMENT = -9999
+
+def clean_column_name(raw_key):
+    key = raw_key.replace("b'", "").replace("'", "")
+    if key == "Datetime":
+        return "TIMESTAMP"
+    if key != "RecNbr" and key.endswith("_Avg"):
+        return key[:-4]  # Remove "_Avg" suffix
+    return key
+
+def build_column_plan(raw_keys, numeric_keys=None):
+    # One (raw name, clean name, numeric) entry per column. When the field types
+    # are unknown every column is treated as numeric, which only costs a NaN check.
+    return tuple(
+        (raw_key, clean_column_name(raw_key), numeric_keys is None or raw_key in numeric_keys)
+        for raw_key in raw_keys
+    )
+
+def column_plan_from_table_def(table_def, table_name):
+    table_name_bytes = table_name if isinstance(table_name, bytes) else table_name.encode("utf-8")
+    for table in table_def or []:
+        if table.get("Header", {}).get("TableName") != table_name_bytes:
+            continue
+        raw_keys = ["Datetime", "RecNbr"]
+        numeric_keys = {"RecNbr"}
+        for field in table.get("Fields", []):
+            raw_key = str(field["FieldName"])
+            raw_keys.append(raw_key)
+            if str(field.get("FieldType", "")).upper() in NUMERIC_FIELD_TYPES:
+                numeric_keys.add(raw_key)
+        logger.debug(f"Built column plan for {table_name_bytes} from table definition ({len(raw_keys)} columns)")
+        return build_column_plan(raw_keys, numeric_keys)
+    return None
+
+def apply_column_plan(record, plan):
+    entry = {}
+    for raw_key, clean_key, numeric in plan:
+        value = record[raw_key]
+        if numeric and value != value:  # NaN is the only value not equal to itself
+            value = NAN_REPLACEMENT
+        entry[clean_key] = value
+    return entry
+
+def clean_records(records, column_plan=None):
+    plan = column_plan
+    for record in records:
+        if plan is None or len(record) != len(plan):
+            plan = build_column_plan(record.keys())
+        try:
+            yield apply_column_plan(record, plan)
+        except KeyError:
+            # The record does not match the plan (e.g. program change); replan from the record itself
+            plan = build_column_plan(record.keys())
+            yield apply_column_plan(record, plan)
+
+def get_data(datalogger, table_name, start, stop, column_plan=None):
     try:
         table_name_str = table_name.decode("utf-8")
         logger.info(
             f"Attempting to retrieve data from {table_name_str} between {start} and {stop}"
         )
         table_data = datalogger.get_data(table_name_str, start, stop)
-        cleaned_data = []
-
-        for label in table_data:
-            dict_entry = {}
-            for key, value in label.items():
-                key = key.replace("b'", "").replace("'", "")
-
-                if key == "Datetime":
-                    key = "TIMESTAMP"
-                elif key != "RecNbr" and key.endswith("_Avg"):
-                    key = key[:-4]  # Remove "_Avg" suffix
-
-                dict_entry[key] = value
-
-                try:
-                    if math.isnan(value):
-                        dict_entry[key] = -9999
-                except TypeError:
-                    continue
-
-            cleaned_data.append(dict_entry)
+        cleaned_data = list(clean_records(table_data, column_plan))
 
         cleaned_data.sort(key=lambda x: x["TIMESTAMP"])
         logger.info(f"Retrieved and cleaned {len(cleaned_data)} data points from {table_name_str}")
@@ -147,14 +185,228 @@ def get_logger_time(datalogger):
         logger.error(f"Failed to get logger time: {e}")
         raise
 
-def determine_time_range(latest_time):
+def determine_time_range(latest_time, stop=None):
     if latest_time:
-        start = datetime.fromisoformat(latest_time) + timedelta(seconds=1)
+        if not isinstance(latest_time, datetime):
+            latest_time = datetime.fromisoformat(str(latest_time))
+        start = latest_time + timedelta(seconds=1)
         logger.info(f"Using latest time from database: {start}")
     else:
-        start = datetime.now() - timedelta(days=2)
+        start = (stop or datetime.now()) - timedelta(days=DEFAULT_LOOKBACK_DAYS)
         logger.info(f"No latest time found, using default start time: {start}")
 
-    stop = datetime.now()
+    if stop is None:
+        stop = datetime.now()
     logger.info(f"Determined time range: start={start}, stop={stop}")
     return start, stop
+
+def is_after_watermark(record, watermark):
+    if not watermark or not watermark.get("TIMESTAMP"):
+        return True
+
+    watermark_time = watermark["TIMESTAMP"]
+    if not isinstance(watermark_time, datetime):
+        watermark_time = datetime.fromisoformat(str(watermark_time))
+
+    if record["TIMESTAMP"] > watermark_time:
+        return True
+    if record["TIMESTAMP"] == watermark_time and watermark.get("RecNbr") is not None:
+        return record.get("RecNbr", -1) > watermark["RecNbr"]
+    return False
+
+def get_new_data(datalogger, table_name, db_name, logger_time, column_plan=None):
+    table_name_str = table_name.decode("utf-8")
+    watermark = get_watermark(table_name_str, db_name)
+    start, stop = determine_time_range(watermark["TIMESTAMP"] if watermark else None, logger_time)
+
+    if start > stop:
+        logger.info(f"Watermark for {table_name_str} is ahead of logger time {stop}; nothing to collect")
+        return []
+
+    table_data = get_data(datalogger, table_name, start, stop, column_plan)
+    new_data = [record for record in table_data if is_after_watermark(record, watermark)]
+
+    if watermark and new_data and watermark.get("RecNbr") is not None:
+        if new_data[0].get("RecNbr", 0) < watermark["RecNbr"]:
+            logger.warning(
+                f"RecNbr went backwards on {table_name_str} ({watermark['RecNbr']} -> {new_data[0]['RecNbr']}); "
+                "datalogger program was probably reloaded"
+            )
+
+    skipped = len(table_data) - len(new_data)
+    if skipped:
+        logger.info(f"Dropped {skipped} records already at or below the watermark")
+    logger.info(f"Collected {len(new_data)} new records from {table_name_str} since {start}")
+    return new_data
+
+def advance_watermark(table_name, records, db_name):
+    if not records:
+        return
+    table_name_str = table_name.decode("utf-8") if isinstance(table_name, bytes) else table_name
+    latest = records[-1]
+    update_watermark(table_name_str, latest.get("RecNbr"), latest["TIMESTAMP"], db_name)
+
+def needs_backfill(table_name, db_name, logger_time, threshold_minutes=BACKFILL_THRESHOLD_MINUTES):
+    table_name_str = table_name.decode("utf-8") if isinstance(table_name, bytes) else table_name
+    watermark = get_watermark(table_name_str, db_name)
+    if not watermark or not watermark.get("TIMESTAMP"):
+        logger.info(f"No watermark for {table_name_str}; backfill required")
+        return True
+
+    gap = logger_time - datetime.fromisoformat(str(watermark["TIMESTAMP"]))
+    if gap > timedelta(minutes=threshold_minutes):
+        logger.info(f"Collection gap of {gap} on {table_name_str} exceeds {threshold_minutes} minutes; backfill required")
+        return True
+    return False
+
+def backfill_data(
+    datalogger,
+    table_name,
+    db_name,
+    logger_time,
+    chunk_minutes=BACKFILL_CHUNK_MINUTES,
+    max_chunk_records=BACKFILL_MAX_CHUNK_RECORDS,
+    column_plan=None,
+):
+    # Walks from the watermark to logger_time in windows of chunk_minutes. Each chunk
+    # is written and the watermark advanced before the next request, so only one
+    # window is held in memory and an interrupted backfill resumes where it stopped.
+    # A window returning more than max_chunk_records records is dropped unstored and
+    # refetched at half the length, so no stored chunk (one transaction) exceeds
+    # max_chunk_records unless the window is already down to one minute. The
+    # oversized window itself is still read once: the logger has no record count
+    # to ask for up front.
+    table_name_str = table_name.decode("utf-8")
+    watermark = get_watermark(table_name_str, db_name)
+    start, stop = determine_time_range(watermark["TIMESTAMP"] if watermark else None, logger_time)
+
+    stats = {"records": 0, "chunks": 0, "seconds": 0.0, "records_per_second": 0.0, "latest_record": None}
+    if start > stop:
+        logger.info(f"Watermark for {table_name_str} is ahead of logger time {stop}; nothing to backfill")
+        return stats
+
+    logger.info(f"Starting backfill of {table_name_str} from {start} to {stop} in {chunk_minutes}-minute chunks")
+    window = timedelta(minutes=chunk_minutes)
+    chunk_start = start
+    started = time.time()
+
+    while chunk_start <= stop:
+        chunk_stop = min(chunk_start + window, stop)
+        records = [
+            record
+            for record in get_data(datalogger, table_name, chunk_start, chunk_stop, column_plan)
+            if is_after_watermark(record, watermark)
+        ]
+
+        if len(records) > max_chunk_records and window > timedelta(minutes=1):
+            window = max(timedelta(minutes=1), window / 2)
+            logger.info(
+                f"Chunk {chunk_start} -> {chunk_stop} returned {len(records)} records, more than "
+                f"{max_chunk_records}; refetching with a {window} window"
+            )
+            del records
+            continue
+
+        if records:
+            setup_database(records[0].keys(), db_name, records)
+            insert_data_to_db(records, db_name)
+            advance_watermark(table_name, records, db_name)
+            watermark = {"RecNbr": records[-1].get("RecNbr"), "TIMESTAMP": records[-1]["TIMESTAMP"]}
+            stats["latest_record"] = records[-1]
+
+        stats["records"] += len(records)
+        stats["chunks"] += 1
+        stats["seconds"] = time.time() - started
+        stats["records_per_second"] = stats["records"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+        logger.info(
+            f"Backfill chunk {stats['chunks']} ({chunk_start} -> {chunk_stop}): {len(records)} records, "
+            f"{stats['records']} total at {stats['records_per_second']:.1f} records/s"
+        )
+
+        chunk_start = chunk_stop + timedelta(seconds=1)
+        del records
+
+    logger.info(
+        f"Backfill of {table_name_str} complete: {stats['records']} records in {stats['chunks']} chunks, "
+        f"{stats['seconds']:.1f} s ({stats['records_per_second']:.1f} records/s)"
+    )
+    return stats
+
+class DataloggerSession:
+    # Keeps one serial connection to the CR1000 open across collection cycles.
+    # The table list and column plans are cached for the life of the connection
+    # and dropped whenever a failed liveness probe forces a reconnect.
+    def __init__(self, datalogger_config):
+        self.config = datalogger_config
+        self.datalogger = None
+        self.table_names = None
+        self.column_plans = {}
+        self.reconnects = 0
+
+    def probe(self):
+        if self.datalogger is None:
+            return None
+        try:
+            logger_time = self.datalogger.gettime()
+            logger.debug(f"Datalogger liveness probe OK, logger time {logger_time}")
+            return logger_time
+        except Exception as e:
+            logger.warning(f"Datalogger liveness probe failed: {e}")
+            return None
+
+    def connect(self):
+        self.close()
+        if not wait_for_usb_device(self.config["port"]):
+            raise Exception("USB device not available")
+        self.datalogger = connect_to_datalogger(self.config)
+        self.reconnects += 1
+        return self.datalogger
+
+    def ensure_connected(self):
+        # Returns the current logger time, reconnecting only if the probe fails
+        logger_time = self.probe()
+        if logger_time is not None:
+            logger.info(f"Reusing datalogger session (logger time {logger_time})")
+            return logger_time
+
+        logger.info("Opening new datalogger session")
+        self.connect()
+        return get_logger_time(self.datalogger)
+
+    def get_tables(self):
+        if self.table_names:
+            return self.table_names
+
+        table_names = get_tables(self.datalogger)
+        if table_names:
+            self.table_names = table_names
+        else:
+            # Don't trust a connection that can't list tables; reconnect next cycle
+            self.close()
+        return table_names
+
+    def get_column_plan(self, table_name):
+        if table_name in self.column_plans:
+            return self.column_plans[table_name]
+
+        plan = None
+        try:
+            plan = column_plan_from_table_def(self.datalogger.table_def, table_name)
+        except Exception as e:
+            logger.warning(f"Could not read table definition for {table_name}: {e}")
+
+        if plan is None:
+            logger.info(f"No table definition for {table_name}; column plan will be built from the first record")
+        self.column_plans[table_name] = plan
+        return plan
+
+    def close(self):
+        if self.datalogger is not None:
+            try:
+                self.datalogger.bye()
+                logger.info("Datalogger connection closed successfully")
+            except Exception as e:
+                logger.error(f"Error closing datalogger connection: {e}")
+        self.datalogger = None
+        self.table_names = None
+        self.column_plans = {}
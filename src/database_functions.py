@@ -6,50 +6,298 @@ import json
 
 logger = setup_logger("database_functions", "database_functions.log")
 
-def setup_database(columns, db_name):
-    try:
-        os.makedirs(os.path.dirname(db_name), exist_ok=True)
-        logger.info(f"Ensuring directory exists for database: {db_name}")
-        
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
+KEY_COLUMNS = ("TIMESTAMP", "RecNbr")
+
+open_databases = {}
+
+def column_affinity(column, values):
+    if column == "TIMESTAMP":
+        return "TEXT"
+    if column == "RecNbr":
+        return "INTEGER"
+
+    affinity = None
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, float):
+            return "REAL"
+        if isinstance(value, (bool, int)):
+            affinity = "INTEGER"
+        else:
+            return "TEXT"
+    # Logger fields are numeric, so columns we have no values for default to REAL
+    return affinity or "REAL"
+
+def to_db_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    return value
+
+class NodeDatabase:
+    # Storage engine for a node's SQLite file. The connection stays open for the
+    # life of the process and runs in WAL mode, so collection writes don't block
+    # readers (exports, rollups) and each batch commits as one transaction.
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.conn = None
+        self.columns = None
+
+    def connect(self):
+        if self.conn is not None:
+            return self.conn
+
+        db_dir = os.path.dirname(self.db_name)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(self.db_name, timeout=30)
+        journal_mode = self.conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        logger.info(f"Opened database {self.db_name} (journal_mode={journal_mode})")
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+                logger.info(f"Closed database {self.db_name}")
+            except Exception as e:
+                logger.error(f"Error closing database {self.db_name}: {e}")
+        self.conn = None
+        self.columns = None
+
+    def table_exists(self, table_name):
+        row = self.connect().execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+        ).fetchone()
+        return row is not None
+
+    def load_columns(self):
+        if self.columns is None:
+            rows = self.connect().execute("PRAGMA table_info(data_table)").fetchall()
+            self.columns = {row[1]: row[2] for row in rows}
+        return self.columns
+
+    def has_unique_key(self):
+        for index in self.connect().execute("PRAGMA index_list(data_table)").fetchall():
+            if not index[2]:
+                continue
+            index_columns = [row[2] for row in self.conn.execute(f"PRAGMA index_info({index[1]})").fetchall()]
+            if tuple(index_columns) == KEY_COLUMNS:
+                return True
+        return False
+
+    def setup(self, columns, rows=None):
+        if self.columns is not None:
+            # Schema already verified on this connection; new columns are added on insert
+            return self.columns
+
+        conn = self.connect()
+        columns = list(columns)
+        for key in KEY_COLUMNS:
+            if key not in columns:
+                columns.insert(KEY_COLUMNS.index(key), key)
+
+        affinities = {
+            column: column_affinity(column, (row.get(column) for row in rows or []))
+            for column in columns
+        }
+
+        if self.table_exists("data_table"):
+            if not self.has_unique_key():
+                self.migrate_legacy_table(affinities)
+        else:
+            columns_str = ", ".join(f"{column} {affinity}" for column, affinity in affinities.items())
+            with conn:
+                conn.execute(
+                    f"CREATE TABLE data_table ({columns_str}, UNIQUE ({', '.join(KEY_COLUMNS)}))"
+                )
+            logger.info(f"Created data_table in {self.db_name}")
+            logger.debug(f"Created table with columns: {columns_str}")
+
+        # The unique (TIMESTAMP, RecNbr) index leads with TIMESTAMP, so it also serves time-range queries
+        self.columns = None
+        self.load_columns()
+        return self.columns
+
+    def migrate_legacy_table(self, affinities):
+        # Older nodes created data_table with TEXT columns and no key. Rebuild it with
+        # typed columns and the unique key, keeping the first copy of duplicated rows.
+        conn = self.connect()
+        existing = [row[1] for row in conn.execute("PRAGMA table_info(data_table)").fetchall()]
+        for column in existing:
+            if column not in affinities:
+                affinities[column] = column_affinity(column, [])
+
+        columns_str = ", ".join(f"{column} {affinity}" for column, affinity in affinities.items())
+        existing_str = ", ".join(existing)
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DROP TABLE IF EXISTS data_table_migrating")
+            conn.execute(
+                f"CREATE TABLE data_table_migrating ({columns_str}, UNIQUE ({', '.join(KEY_COLUMNS)}))"
+            )
+            conn.execute(
+                f"INSERT OR IGNORE INTO data_table_migrating ({existing_str}) "
+                f"SELECT {existing_str} FROM data_table ORDER BY rowid"
+            )
+            conn.execute("DROP TABLE data_table")
+            conn.execute("ALTER TABLE data_table_migrating RENAME TO data_table")
+        kept = conn.execute("SELECT COUNT(*) FROM data_table").fetchone()[0]
+        logger.info(f"Migrated legacy data_table in {self.db_name} to typed, keyed schema ({kept} unique rows)")
+
+    def add_columns(self, conn, new_columns, rows):
+        # Runs inside the caller's transaction so a failed insert also rolls back the ALTERs
+        added = {}
+        for column in new_columns:
+            affinity = column_affinity(column, (row.get(column) for row in rows))
+            conn.execute(f"ALTER TABLE data_table ADD COLUMN {column} {affinity}")
+            added[column] = affinity
+        return added
+
+    def insert_rows(self, rows):
+        if not rows:
+            return 0
+        conn = self.connect()
+        known_columns = self.setup(rows[0].keys(), rows)
+
+        # Rows from one program share a key layout, so this is one set per batch, not per row
+        columns = list(rows[0].keys())
+        for layout in {tuple(row.keys()) for row in rows}:
+            columns.extend(column for column in layout if column not in columns)
+        new_columns = [column for column in columns if column not in known_columns]
+
+        placeholders = ", ".join("?" for _ in columns)
+        # A row without a column (a partial or older-layout row) keeps the value already stored
+        updates = ", ".join(
+            f"{column} = COALESCE(excluded.{column}, {column})" for column in columns if column not in KEY_COLUMNS
+        )
+        insert_stmt = (
+            f"INSERT INTO data_table ({', '.join(columns)}) VALUES ({placeholders}) "
+            f"ON CONFLICT ({', '.join(KEY_COLUMNS)}) DO "
+            + (f"UPDATE SET {updates}" if updates else "NOTHING")
+        )
+
+        with conn:
+            # sqlite3 only opens a transaction implicitly before DML, so start it before any ALTER
+            conn.execute("BEGIN")
+            added = self.add_columns(conn, new_columns, rows) if new_columns else {}
+            conn.executemany(
+                insert_stmt,
+                ([to_db_value(row.get(column)) for column in columns] for row in rows),
+            )
 
-        columns_str = ", ".join([f"{col} TEXT" for col in columns])
-        create_table_stmt = f"CREATE TABLE IF NOT EXISTS data_table ({columns_str})"
+        if added:
+            known_columns.update(added)
+            logger.warning(
+                f"Datalogger program change detected: added columns {', '.join(f'{c} {a}' for c, a in added.items())} "
+                f"to data_table in {self.db_name}"
+            )
+        logger.info(f"Upserted {len(rows)} rows into {self.db_name}")
+        logger.debug(f"Sample of inserted data: {json.dumps(rows[:2], default=str)}")
+        return len(rows)
 
-        cursor.execute(create_table_stmt)
-        conn.commit()
+    def fetch_range(self, start, stop):
+        conn = self.connect()
+        cursor = conn.execute(
+            "SELECT * FROM data_table WHERE TIMESTAMP >= ? AND TIMESTAMP <= ? ORDER BY TIMESTAMP",
+            (to_db_value(start), to_db_value(stop)),
+        )
+        names = [description[0] for description in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def setup_watermark_table(self):
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS collection_watermarks ("
+                "table_name TEXT PRIMARY KEY, "
+                "rec_nbr INTEGER, "
+                "timestamp TEXT, "
+                "updated_at TEXT)"
+            )
+        logger.debug(f"Watermark table ready in {self.db_name}")
+
+    def get_watermark(self, table_name):
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT rec_nbr, timestamp FROM collection_watermarks WHERE table_name = ?",
+            (table_name,),
+        ).fetchone()
+        if row:
+            logger.info(f"Watermark for {table_name}: RecNbr={row[0]}, TIMESTAMP={row[1]}")
+            return {"RecNbr": row[0], "TIMESTAMP": row[1]}
+
+        # No watermark yet: seed it from the newest row already stored, so nodes
+        # that predate watermarks don't re-collect their whole history.
+        if self.table_exists("data_table"):
+            row = conn.execute(
+                "SELECT TIMESTAMP, RecNbr FROM data_table ORDER BY TIMESTAMP DESC LIMIT 1"
+            ).fetchone()
+            if row and row[0]:
+                rec_nbr = int(float(row[1])) if row[1] is not None else None
+                logger.info(f"Seeded watermark for {table_name} from data_table: RecNbr={rec_nbr}, TIMESTAMP={row[0]}")
+                return {"RecNbr": rec_nbr, "TIMESTAMP": row[0]}
+
+        logger.info(f"No watermark found for {table_name}")
+        return None
+
+    def update_watermark(self, table_name, rec_nbr, timestamp):
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO collection_watermarks (table_name, rec_nbr, timestamp, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (table_name, rec_nbr, to_db_value(timestamp), datetime.now().isoformat()),
+            )
+        logger.info(f"Updated watermark for {table_name}: RecNbr={rec_nbr}, TIMESTAMP={to_db_value(timestamp)}")
+
+def get_node_database(db_name):
+    if db_name not in open_databases:
+        open_databases[db_name] = NodeDatabase(db_name)
+    return open_databases[db_name]
+
+def close_databases():
+    for database in open_databases.values():
+        database.close()
+    open_databases.clear()
+
+def setup_database(columns, db_name, rows=None):
+    try:
+        get_node_database(db_name).setup(columns, rows)
         logger.info(f"Database {db_name} set up successfully")
-        logger.debug(f"Created table with columns: {columns_str}")
     except sqlite3.OperationalError as e:
         logger.error(f"SQLite operational error setting up database {db_name}: {e}")
         raise
     except Exception as e:
         logger.error(f"Unexpected error setting up database {db_name}: {e}")
         raise
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 def insert_data_to_db(data, db_name):
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-
-        columns = ", ".join(data[0].keys())
-        placeholders = ", ".join(["?" for _ in data[0]])
-        insert_stmt = f"INSERT INTO data_table ({columns}) VALUES ({placeholders})"
-
-        cursor.executemany(insert_stmt, [tuple(row.values()) for row in data])
-        conn.commit()
-        logger.info(f"Inserted {len(data)} rows into {db_name}")
-        logger.debug(f"Sample of inserted data: {json.dumps(data[:2], default=str)}")
+        get_node_database(db_name).insert_rows(data)
     except sqlite3.OperationalError as e:
         logger.error(f"SQLite operational error inserting data into {db_name}: {e}")
         raise
     except Exception as e:
         logger.error(f"Unexpected error inserting data into {db_name}: {e}")
         raise
-    finally:
-        if 'conn' in locals():
-            conn.close()
+
+def setup_watermark_table(db_name):
+    try:
+        get_node_database(db_name).setup_watermark_table()
+    except Exception as e:
+        logger.error(f"Error setting up watermark table in {db_name}: {e}")
+        raise
+
+def get_watermark(table_name, db_name):
+    try:
+        return get_node_database(db_name).get_watermark(table_name)
+    except Exception as e:
+        logger.error(f"Error reading watermark for {table_name} from {db_name}: {e}")
+        raise
+
+def update_watermark(table_name, rec_nbr, timestamp, db_name):
+    try:
+        get_node_database(db_name).update_watermark(table_name, rec_nbr, timestamp)
+    except Exception as e:
+        logger.error(f"Error updating watermark for {table_name} in {db_name}: {e}")
+        raise
@@ -0,0 +1,88 @@
+from datetime import timedelta
+from .utils import setup_logger
+from .database_functions import get_node_database
+from lora_payload import SensorRegistry, NODE_MISSING_VALUE, parse_time
+
+logger = setup_logger("delta_functions", "delta_functions.log")
+
+DEFAULT_KEYFRAME_INTERVAL_HOURS = 6
+DEFAULT_THRESHOLD = 0.0
+
+class DeltaFilter:
+    # Chooses which readings go into an uplink in delta mode. A keyframe with every
+    # sensor is sent when none has been sent for keyframe_interval_hours of logger
+    # time; in between only sensors that moved more than their sensor type's
+    # threshold since they were last sent are kept. The last sent values live in
+    # the node database, so the reference survives restarts.
+    def __init__(self, db_name, delta_config, sensor_metadata):
+        self.db = get_node_database(db_name)
+        self.config = delta_config or {}
+        self.registry = SensorRegistry.build(sensor_metadata)
+        self.setup()
+
+    def setup(self):
+        with self.db.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lora_delta_state (hash TEXT PRIMARY KEY, value REAL, sent_at TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lora_delta_keyframe "
+                "(id INTEGER PRIMARY KEY CHECK (id = 1), record_time TEXT)"
+            )
+
+    def threshold_for(self, sensor_hash):
+        thresholds = self.config.get("thresholds", {})
+        return thresholds.get(self.registry.sensor_type(sensor_hash), self.config.get("default_threshold", DEFAULT_THRESHOLD))
+
+    def last_sent(self):
+        return dict(self.db.connect().execute("SELECT hash, value FROM lora_delta_state"))
+
+    def last_keyframe(self):
+        row = self.db.connect().execute("SELECT record_time FROM lora_delta_keyframe WHERE id = 1").fetchone()
+        return parse_time(row[0]) if row else None
+
+    def keyframe_due(self, record_time):
+        last_keyframe = self.last_keyframe()
+        interval = timedelta(hours=self.config.get("keyframe_interval_hours", DEFAULT_KEYFRAME_INTERVAL_HOURS))
+        # A logger clock that went backwards also forces a keyframe
+        return last_keyframe is None or record_time < last_keyframe or record_time - last_keyframe >= interval
+
+    def changed(self, sensor_hash, value, previous):
+        if previous is None:
+            return True
+        if value == NODE_MISSING_VALUE or previous == NODE_MISSING_VALUE:
+            return value != previous
+        return abs(value - previous) > self.threshold_for(sensor_hash)
+
+    def apply(self, hashed_data):
+        # hashed_data is the {hash: value, "time": ..., "BatV": ...} dict built for one record
+        record_time = parse_time(hashed_data["time"])
+        readings = {key: value for key, value in hashed_data.items() if key not in ("time", "BatV")}
+
+        if self.keyframe_due(record_time):
+            selected = dict(hashed_data)
+            keyframe = True
+        else:
+            previous = self.last_sent()
+            selected = {key: value for key, value in hashed_data.items() if key in ("time", "BatV")}
+            selected.update(
+                (key, value) for key, value in readings.items() if self.changed(key, value, previous.get(key))
+            )
+            selected["delta"] = True
+            keyframe = False
+
+        sent = [(key, value, hashed_data["time"]) for key, value in selected.items() if key in readings]
+        with self.db.connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO lora_delta_state (hash, value, sent_at) VALUES (?, ?, ?)", sent
+            )
+            if keyframe:
+                conn.execute(
+                    "INSERT OR REPLACE INTO lora_delta_keyframe (id, record_time) VALUES (1, ?)", (hashed_data["time"],)
+                )
+
+        if keyframe:
+            logger.info(f"Sending keyframe with {len(readings)} readings")
+        else:
+            logger.info(f"Sending delta with {len(sent)} of {len(readings)} readings changed beyond threshold")
+        return selected
@@ -0,0 +1,191 @@
+import os
+import json
+import sqlite3
+import argparse
+from datetime import datetime
+from .utils import setup_logger
+
+logger = setup_logger("export_functions", "export_functions.log")
+
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_COMPRESSION = "zstd"
+STATE_FILE = "_export_state.json"
+TYPE_SAMPLE_SIZE = 200
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow
+    except ImportError:
+        logger.error("pyarrow is required for Parquet export. Install it with: pip install pyarrow")
+        raise
+
+def open_readonly(db_path):
+    # Exports usually run against copied SD cards or rsynced files; never modify them.
+    # A mode=ro open only fails at the first query, so probe the file here.
+    conn = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True)
+    try:
+        conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+    except sqlite3.Error:
+        conn.close()
+        raise
+    return conn
+
+def looks_numeric(conn, column):
+    rows = conn.execute(
+        f"SELECT {column} FROM data_table WHERE {column} IS NOT NULL LIMIT {TYPE_SAMPLE_SIZE}"
+    ).fetchall()
+    try:
+        for (value,) in rows:
+            float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+def build_export_schema(conn, pa):
+    # Maps each data_table column to an Arrow type and the SQL expression that reads it.
+    # Databases from before the typed schema store everything as TEXT, so numeric-looking
+    # TEXT columns are cast in SQLite rather than row by row in Python.
+    columns = []
+    for _, name, declared, *_ in conn.execute("PRAGMA table_info(data_table)").fetchall():
+        declared = (declared or "").upper()
+        if name == "TIMESTAMP":
+            columns.append((name, name, pa.timestamp("s")))
+        elif name == "RecNbr" or declared == "INTEGER":
+            columns.append((name, f"CAST({name} AS INTEGER)", pa.int64()))
+        elif declared == "REAL" or looks_numeric(conn, name):
+            columns.append((name, f"CAST({name} AS REAL)", pa.float64()))
+        else:
+            columns.append((name, name, pa.string()))
+    return columns
+
+def load_export_state(output_dir):
+    state_path = os.path.join(output_dir, STATE_FILE)
+    if os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            return json.load(f)
+    return {}
+
+def save_export_state(output_dir, state):
+    state_path = os.path.join(output_dir, STATE_FILE)
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+class PartitionWriter:
+    # One Parquet file per (node, date) per export run. Rows arrive ordered by
+    # TIMESTAMP, so only the current date's writer is ever open. Files are written
+    # under a temporary name and renamed when complete.
+    def __init__(self, pa, schema, node_dir, compression):
+        self.pa = pa
+        self.schema = schema
+        self.node_dir = node_dir
+        self.compression = compression
+        self.date = None
+        self.writer = None
+        self.path = None
+        self.rows = 0
+
+    def write(self, date, table):
+        if date != self.date:
+            self.close()
+            partition_dir = os.path.join(self.node_dir, f"date={date}")
+            os.makedirs(partition_dir, exist_ok=True)
+            self.path = os.path.join(partition_dir, f"part-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}.parquet")
+            self.writer = self.pa.parquet.ParquetWriter(f"{self.path}.tmp", self.schema, compression=self.compression)
+            self.date = date
+            self.rows = 0
+        self.writer.write_table(table)
+        self.rows += table.num_rows
+
+    def close(self):
+        if self.writer is None:
+            return None
+        self.writer.close()
+        os.replace(f"{self.path}.tmp", self.path)
+        logger.info(f"Wrote {self.rows} rows to {self.path}")
+        completed = self.date
+        self.writer = None
+        self.date = None
+        return completed
+
+def export_to_parquet(db_path, output_dir, batch_size=DEFAULT_BATCH_SIZE, compression=DEFAULT_COMPRESSION):
+    pa = import_pyarrow()
+    node = os.path.splitext(os.path.basename(db_path))[0]
+    os.makedirs(output_dir, exist_ok=True)
+    state = load_export_state(output_dir)
+    last_exported = state.get(node, {}).get("last_timestamp", "")
+
+    conn = open_readonly(db_path)
+    try:
+        columns = build_export_schema(conn, pa)
+        schema = pa.schema([(name, arrow_type) for name, _, arrow_type in columns])
+        select = ", ".join(expression for _, expression, _ in columns)
+        cursor = conn.execute(
+            f"SELECT {select} FROM data_table WHERE TIMESTAMP > ? ORDER BY TIMESTAMP", (last_exported,)
+        )
+
+        writer = PartitionWriter(pa, schema, os.path.join(output_dir, f"node={node}"), compression)
+        exported = 0
+        last_written = last_exported
+        started = datetime.now()
+
+        def commit_partition():
+            # State only moves forward once a partition file is complete on disk
+            if writer.close() is not None:
+                state[node] = {"last_timestamp": last_written, "exported_at": datetime.now().isoformat()}
+                save_export_state(output_dir, state)
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+
+            # Split the batch on date boundaries; rows are sorted so each date is contiguous
+            start = 0
+            while start < len(rows):
+                date = str(rows[start][0])[:10]
+                stop = start
+                while stop < len(rows) and str(rows[stop][0])[:10] == date:
+                    stop += 1
+
+                if writer.date is not None and writer.date != date:
+                    commit_partition()
+
+                chunk = rows[start:stop]
+                arrays = []
+                for i, (name, _, arrow_type) in enumerate(columns):
+                    values = [row[i] for row in chunk]
+                    if name == "TIMESTAMP":
+                        values = [datetime.fromisoformat(str(value)) for value in values]
+                    arrays.append(pa.array(values, type=arrow_type))
+                writer.write(date, pa.Table.from_arrays(arrays, schema=schema))
+                last_written = str(chunk[-1][0])
+                exported += len(chunk)
+                start = stop
+
+        commit_partition()
+        elapsed = (datetime.now() - started).total_seconds()
+        logger.info(
+            f"Exported {exported} rows from {db_path} to {output_dir} in {elapsed:.1f} seconds"
+            + (f" ({exported / elapsed:.0f} rows/s)" if elapsed > 0 else "")
+        )
+        return exported
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Incrementally export node databases to date-partitioned Parquet")
+    parser.add_argument("databases", nargs="+", help="Node SQLite databases, e.g. data/LINEAR_CORN_A.db")
+    parser.add_argument("--output", default="exports", help="Output directory (default: exports)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--compression", default=DEFAULT_COMPRESSION)
+    args = parser.parse_args()
+
+    for db_path in args.databases:
+        export_to_parquet(db_path, args.output, batch_size=args.batch_size, compression=args.compression)
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,69 @@
 import json
 import time
-import random
-from rak811.rak811_v3 import Rak811
-from .utils import setup_logger, get_sensor_hash
+from .utils import setup_logger
+from .outbox_functions import LoRaOutbox, KIND_REPAIR
+from .database_functions import get_node_database
+from .delta_functions import DeltaFilter
+from .airtime_functions import AirtimeScheduler
+from .batch_functions import RecordBatcher
+from .repair_functions import parse_repair_requests, select_repair_records
+from lora_payload import PayloadCodec, PacketPacker, SensorRegistry, encode_json, hash_record, split_record
 
 logger = setup_logger("lora_functions", "lora_functions.log")
 
 MAX_RETRIES = 3
 RETRY_DELAY = 60  # 1 minute
 
+DEFAULT_VALUES_PER_PACKET = 6
+
 class LoRaManager:
-    def __init__(self, lora_config):
+    # Long-lived LoRaWAN session on the RAK811. The module is configured and joined
+    # once; later cycles only confirm the session is still up and reconfigure after
+    # an error or a module reset. The uplink frame counter is mirrored in the node
+    # database; under ABP there is no join to resync it, so a counter that went
+    # backwards (module reset) is written back to the module from the database.
+    def __init__(self, lora_config, codec=None, state_db=None):
         self.lora = None
         self.config = lora_config
+        # Without a codec packets go out as JSON, as older forwarders expect
+        self.codec = codec
+        self.configured = False
+        self.joins = 0
+        # Downlinks received in the RX windows after our uplinks, oldest first
+        self.downlinks = []
+        self.state_db = get_node_database(state_db) if state_db else None
+        self.uplink_counter = self.load_uplink_counter()
+
+    def setup_state(self):
+        with self.state_db.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lora_session_state (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def load_uplink_counter(self):
+        if not self.state_db:
+            return 0
+        self.setup_state()
+        row = self.state_db.connect().execute(
+            "SELECT value FROM lora_session_state WHERE key = 'uplink_counter'"
+        ).fetchone()
+        return int(row[0]) if row else 0
+
+    def save_uplink_counter(self):
+        if not self.state_db:
+            return
+        with self.state_db.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO lora_session_state (key, value) VALUES ('uplink_counter', ?)",
+                (str(self.uplink_counter),),
+            )
 
     def setup_lora(self):
+        # Imported here so that src can be imported without the RAK811 driver (e.g. by the exporter)
+        from rak811.rak811_v3 import Rak811
         for attempt in range(MAX_RETRIES):
             try:
+                self.reset()
                 self.lora = Rak811()
                 logger.info("Setting LoRa work mode...")
                 self.lora.set_config("lora:work_mode:0")
@@ -34,7 +81,10 @@ class LoRaManager:
                 self.lora.set_config(f'lora:dr:{self.config["data_rate"]}')
                 logger.info("Joining LoRaWAN network...")
                 self.lora.join()
+                self.configured = True
+                self.joins += 1
                 logger.info("Joined LoRaWAN network successfully")
+                self.check_session()
                 return
             except Exception as e:
                 logger.error(f"Error setting up LoRa (Attempt {attempt + 1}/{MAX_RETRIES}): {e}")
@@ -45,23 +95,112 @@ class LoRaManager:
                     logger.error("Max retries reached. Unable to set up LoRa.")
                     raise
 
+    def read_status(self):
+        # "at+get_config=lora:status" answers with "Key: value" lines, e.g.
+        # "Joined Network:true" and "UpLinkCounter: 12"
+        response = self.lora.get_config("lora:status")
+        lines = response if isinstance(response, (list, tuple)) else str(response or "").splitlines()
+        status = {}
+        for line in lines:
+            key, sep, value = str(line).partition(":")
+            if sep:
+                status[key.strip()] = value.strip()
+        return status
+
+    def check_session(self):
+        try:
+            status = self.read_status()
+        except Exception as e:
+            logger.warning(f"Could not read LoRa session status: {e}")
+            return False
+
+        joined = status.get("Joined Network")
+        if joined is not None and joined.lower() != "true":
+            logger.warning("RAK811 reports it is no longer joined")
+            return False
+
+        counter = status.get("UpLinkCounter")
+        if counter is not None and counter.isdigit():
+            counter = int(counter)
+            if counter < self.uplink_counter:
+                logger.warning(f"RAK811 uplink frame counter went back from {self.uplink_counter} to {counter}; the module was reset")
+                if self.restore_uplink_counter():
+                    counter = self.uplink_counter
+                else:
+                    logger.warning("The network server may drop uplinks until it accepts the new counter")
+            if counter != self.uplink_counter:
+                self.uplink_counter = counter
+                self.save_uplink_counter()
+        return True
+
+    def restore_uplink_counter(self):
+        try:
+            self.lora.set_config(f"lora:uplink_counter:{self.uplink_counter}")
+        except Exception as e:
+            logger.error(f"Could not restore RAK811 uplink frame counter to {self.uplink_counter}: {e}")
+            return False
+        logger.info(f"Restored RAK811 uplink frame counter to {self.uplink_counter}")
+        return True
+
+    def ensure_session(self):
+        if self.lora is None or not self.configured:
+            logger.info("No LoRa session; configuring RAK811")
+            self.setup_lora()
+        elif not self.check_session():
+            logger.info("LoRa session is no longer valid; reconfiguring RAK811")
+            self.setup_lora()
+        else:
+            logger.info(f"Reusing LoRa session (uplink counter {self.uplink_counter})")
+
     def send_data(self, data):
         for attempt in range(MAX_RETRIES):
             try:
-                json_payload = json.dumps(data)
-                payload = json_payload.encode("utf-8")
+                if self.codec:
+                    payload = self.codec.encode(data)
+                else:
+                    payload = json.dumps(data).encode("utf-8")
                 self.lora.send(payload)
-                logger.info(f"Sent payload: {json_payload}")
+                self.uplink_counter += 1
+                self.save_uplink_counter()
+                self.read_downlinks()
+                logger.info(f"Sent {len(payload)}-byte payload: {payload.hex() if self.codec else payload.decode('utf-8')}")
                 return
             except Exception as e:
                 logger.error(f"Error sending LoRa data (Attempt {attempt + 1}/{MAX_RETRIES}): {e}")
+                self.configured = False
                 if attempt < MAX_RETRIES - 1:
                     logger.info(f"Retrying in {RETRY_DELAY} seconds...")
                     time.sleep(RETRY_DELAY)
+                    # A failed send leaves the module in an unknown state
+                    self.setup_lora()
                 else:
                     logger.error("Max retries reached. Unable to send LoRa data.")
                     raise
 
+    def read_downlinks(self):
+        # Class A: the network can only answer in the receive windows after an uplink
+        try:
+            for _ in range(self.lora.nb_downlinks):
+                downlink = self.lora.get_downlink()
+                if downlink:
+                    logger.info(f"Received downlink on port {downlink.get('port')}: {bytes(downlink.get('data') or b'').hex()}")
+                    self.downlinks.append(downlink)
+        except Exception as e:
+            logger.warning(f"Could not read LoRa downlinks: {e}")
+
+    def pop_downlinks(self):
+        downlinks, self.downlinks = self.downlinks, []
+        return downlinks
+
+    def reset(self):
+        if self.lora:
+            try:
+                self.lora.close()
+            except Exception as e:
+                logger.warning(f"Error closing LoRa connection: {e}")
+        self.lora = None
+        self.configured = False
+
     def close(self):
         if self.lora:
             try:
@@ -69,11 +208,39 @@ class LoRaManager:
                 logger.info("LoRa connection closed successfully")
             except Exception as e:
                 logger.error(f"Error closing LoRa connection: {e}")
+        self.lora = None
+        self.configured = False
 
-def send_lora_data(data, config, sensor_metadata, clip_floats=False):
-    logger.info("Initializing LoRa data transmission")
-    logger.debug(f"Original data to be sent: {json.dumps(data, default=str)}")
+def hash_lora_data(data, sensor_metadata, clip_floats=False):
+    hashed_data, unmapped = hash_record(data, SensorRegistry.build(sensor_metadata), clip_floats)
+    if unmapped:
+        logger.debug(f"Columns without a sensor hash: {', '.join(unmapped)}")
+    logger.debug(f"Hashed data: {json.dumps(hashed_data, default=str)}")
+    return hashed_data
+
+def log_packing_plan(plan, packer, description):
+    logger.info(
+        f"Packed {description} into {len(plan['chunks'])} packets for {packer.region} DR{packer.data_rate}: "
+        f"{plan['total_bytes']} bytes, {plan['total_airtime'] * 1000:.1f} ms expected airtime "
+        f"(sizes {plan['sizes']}, max {packer.max_size})"
+    )
+
+def build_lora_chunks(data, sensor_metadata, clip_floats=False, values_per_chunk=DEFAULT_VALUES_PER_PACKET, packer=None, delta_filter=None):
+    hashed_data = hash_lora_data(data, sensor_metadata, clip_floats)
 
+    if delta_filter:
+        hashed_data = delta_filter.apply(hashed_data)
+
+    if packer:
+        plan = packer.pack(hashed_data)
+        log_packing_plan(plan, packer, f"{len(hashed_data)} fields")
+        return plan['chunks']
+
+    chunks = split_record(hashed_data, values_per_chunk)
+    logger.info(f"Data split into {len(chunks)} chunks")
+    return chunks
+
+def validate_lora_config(config):
     required_keys = ['lora', 'schedule']
     for key in required_keys:
         if key not in config:
@@ -82,60 +249,166 @@ def send_lora_data(data, config, sensor_metadata, clip_floats=False):
     if 'transmission_window' not in config['schedule'] or 'min_interval' not in config['schedule']:
         raise KeyError("'transmission_window' and 'min_interval' must be specified in the 'schedule' configuration")
 
-    lora_manager = LoRaManager(config['lora'])
+def get_payload_codec(config, sensor_metadata):
+    payload_format = config['lora'].get('payload_format', 'json')
+    if payload_format == 'binary':
+        return PayloadCodec(sensor_metadata)
+    if payload_format != 'json':
+        raise ValueError(f"Unknown LoRa payload_format '{payload_format}'; expected 'binary' or 'json'")
+    return None
 
-    try:
-        lora_manager.setup_lora()
+def get_packet_packer(config, codec=None):
+    lora_config = config['lora']
+    encode = codec.encode if codec else encode_json
+    return PacketPacker(
+        lora_config['region'],
+        lora_config['data_rate'],
+        encode,
+        max_values=lora_config.get('values_per_packet'),
+    )
 
-        hashed_data = {
-            get_sensor_hash(k, sensor_metadata): v
-            for k, v in data.items()
-            if get_sensor_hash(k, sensor_metadata) and k != "TIMESTAMP"
-        }
-        
-        hashed_data["time"] = data["TIMESTAMP"].strftime("%Y%m%d%H%M%S")
-        
-        if "BatV" in data:
-            hashed_data["BatV"] = data["BatV"]
+def create_lora_session(config, sensor_metadata):
+    return LoRaManager(
+        config['lora'],
+        get_payload_codec(config, sensor_metadata),
+        state_db=config['database']['name'],
+    )
+
+def drain_outbox(outbox, config, codec=None, lora_manager=None):
+    packets = outbox.next_batch()
+    if not packets:
+        logger.info("LoRa outbox is empty")
+        return 0
 
-        if clip_floats:
-            hashed_data = {k: round(v, 2) if isinstance(v, float) else v for k, v in hashed_data.items()}
+    backlog = outbox.backlog_size()
+    logger.info(f"Draining {len(packets)} of {backlog} queued LoRa packets")
 
-        logger.debug(f"Hashed data: {json.dumps(hashed_data, default=str)}")
+    transmission_window = config['schedule']['transmission_window']
+    scheduler = AirtimeScheduler(config['database']['name'], config['lora'], config['schedule'])
+    encode = codec.encode if codec else encode_json
+    sizes = [len(encode(packet['payload'])) for packet in packets]
 
-        chunks = [dict(list(hashed_data.items())[i:i+6]) for i in range(0, len(hashed_data), 6)]
-        logger.info(f"Data split into {len(chunks)} chunks")
+    admitted, rejected = scheduler.admit(sizes)
+    for i, reason in rejected:
+        # Retrying cannot shorten the packet, so it is dropped on the first rejection
+        logger.error(f"Dropping packet {packets[i]['id']}: {reason}")
+        outbox.mark_rejected(packets[i]['id'], reason)
+    if not admitted:
+        scheduler.log_utilization()
+        return 0
 
-        transmission_window = config['schedule']['transmission_window']
-        min_interval = config['schedule']['min_interval']
+    airtimes = [scheduler.airtime(sizes[i]) for i in admitted]
+    offsets = scheduler.plan(airtimes)
+    admitted = admitted[:len(offsets)]
 
-        max_delay = (transmission_window - (len(chunks) - 1) * min_interval) / len(chunks)
+    # Without a long-lived session the radio is set up for this drain and closed after it
+    owns_session = lora_manager is None
+    if owns_session:
+        lora_manager = LoRaManager(config['lora'], codec)
+    sent = 0
 
+    try:
+        lora_manager.ensure_session()
         start_time = time.time()
 
-        for i, chunk in enumerate(chunks):
-            if "time" not in chunk:
-                chunk["time"] = hashed_data["time"]
-            
-            if i > 0 and "BatV" in chunk:
-                del chunk["BatV"]
-            
-            logger.debug(f"Sending chunk {i+1}: {json.dumps(chunk, default=str)}")
-            lora_manager.send_data(chunk)
-            
-            if i < len(chunks) - 1:
-                delay = random.uniform(min_interval, max_delay)
+        for i, offset in zip(admitted, offsets):
+            packet = packets[i]
+            delay = start_time + offset - time.time()
+            if delay > 0:
                 logger.info(f"Waiting {delay:.2f} seconds before sending next chunk")
                 time.sleep(delay)
 
+            logger.debug(f"Sending packet {sent+1} (record {packet['record_timestamp']}, chunk {packet['chunk_index']}): {json.dumps(packet['payload'], default=str)}")
+            try:
+                lora_manager.send_data(packet['payload'])
+            except Exception as e:
+                # The radio is most likely down; keep the rest queued for the next cycle
+                outbox.mark_failed(packet['id'], e)
+                raise
+            scheduler.record(sizes[i])
+            outbox.mark_sent(packet['id'])
+            sent += 1
+
         total_time = time.time() - start_time
-        logger.info(f"Successfully sent {len(chunks)} LoRa packets in {total_time:.2f} seconds")
+        logger.info(f"Successfully sent {sent} LoRa packets in {total_time:.2f} seconds ({backlog - sent} still queued)")
         
         if total_time > transmission_window:
             logger.warning(f"Total transmission time exceeded window by {total_time - transmission_window:.2f} seconds")
-        
+
+        outbox.purge_sent()
+        return sent
     except Exception as e:
-        logger.error(f"Error in send_lora_data: {e}")
+        logger.error(f"Error draining LoRa outbox after {sent} packets: {e}")
+        lora_manager.reset()
         raise
     finally:
-        lora_manager.close()
+        scheduler.log_utilization()
+        if owns_session:
+            lora_manager.close()
+
+def schedule_repairs(downlinks, config, sensor_metadata, packer, outbox, clip_floats=False):
+    ranges = parse_repair_requests(downlinks)
+    if not ranges:
+        return 0
+
+    repair_config = config.get('repair') or {}
+    records = select_repair_records(
+        config['database']['name'],
+        ranges,
+        config['schedule']['interval_minutes'],
+        repair_config.get('max_records', 48),
+        # With drain_order "newest" the forwarder sees records out of order and asks
+        # for ones the node has not sent yet
+        exclude=outbox.pending_record_times(),
+    )
+    logger.info(f"Repair request for {len(ranges)} ranges matches {len(records)} stored records not already queued")
+    if not records:
+        return 0
+
+    # Resent records share uplinks like a batch, so a repair costs a fraction of the original airtime
+    hashed = [hash_lora_data(record, sensor_metadata, clip_floats) for record in records]
+    plan = packer.pack_batch(hashed)
+    log_packing_plan(plan, packer, f"{len(records)} repaired records")
+    outbox.enqueue(records[-1]["TIMESTAMP"], plan['chunks'], replace=True, kind=KIND_REPAIR)
+    return len(records)
+
+def send_lora_data(data, config, sensor_metadata, clip_floats=False, lora_manager=None):
+    logger.info("Initializing LoRa data transmission")
+    logger.debug(f"Original data to be sent: {json.dumps(data, default=str)}")
+
+    validate_lora_config(config)
+
+    # Packets go through the persistent outbox so anything not sent now is replayed later
+    outbox = LoRaOutbox(config['database']['name'], config.get('outbox'))
+    codec = lora_manager.codec if lora_manager else get_payload_codec(config, sensor_metadata)
+    # Packet boundaries follow the maximum payload of the configured region/data rate
+    packer = get_packet_packer(config, codec)
+
+    batch_config = config.get('batch') or {}
+    if batch_config.get('enabled'):
+        # Several cycles share one uplink; delta filtering does not apply to batched records
+        batcher = RecordBatcher(config['database']['name'], batch_config)
+        records = batcher.add(hash_lora_data(data, sensor_metadata, clip_floats))
+        if records:
+            plan = packer.pack_batch(records)
+            log_packing_plan(plan, packer, f"a batch of {len(records)} records")
+            outbox.enqueue(data["TIMESTAMP"], plan['chunks'])
+            batcher.clear(records)
+    else:
+        delta_config = config.get('delta') or {}
+        delta_filter = DeltaFilter(config['database']['name'], delta_config, sensor_metadata) if delta_config.get('enabled') else None
+        chunks = build_lora_chunks(data, sensor_metadata, clip_floats, packer=packer, delta_filter=delta_filter)
+        outbox.enqueue(data["TIMESTAMP"], chunks)
+
+    # The manager is needed after the drain to read the downlinks it received
+    owns_session = lora_manager is None
+    if owns_session:
+        lora_manager = LoRaManager(config['lora'], codec)
+    try:
+        sent = drain_outbox(outbox, config, codec, lora_manager)
+        # Repair requests are queued now and go out with the next drain
+        schedule_repairs(lora_manager.pop_downlinks(), config, sensor_metadata, packer, outbox, clip_floats)
+        return sent
+    finally:
+        if owns_session:
+            lora_manager.close()
@@ -0,0 +1,173 @@
+import json
+from datetime import datetime, timedelta
+from .utils import setup_logger
+from .database_functions import get_node_database, to_db_value
+from lora_payload import parse_time
+
+logger = setup_logger("outbox_functions", "outbox_functions.log")
+
+STATUS_PENDING = "pending"
+STATUS_SENT = "sent"
+STATUS_FAILED = "failed"
+STATUS_REJECTED = "rejected"  # can never be sent as encoded (e.g. longer than the dwell limit)
+DONE_STATUSES = (STATUS_SENT, STATUS_REJECTED)
+
+KIND_RECORD = "record"
+KIND_REPAIR = "repair"  # records resent for a gap repair request
+
+DEFAULT_MAX_PACKETS_PER_CYCLE = 12
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_DRAIN_ORDER = "newest"
+DEFAULT_SENT_RETENTION_DAYS = 7
+
+class LoRaOutbox:
+    # Persistent store-and-forward queue of LoRa packets in the node database.
+    # Every packet is written here before transmission and marked sent or failed
+    # afterwards, so packets lost to a radio outage are replayed on later cycles.
+    def __init__(self, db_name, outbox_config=None):
+        self.db = get_node_database(db_name)
+        self.config = outbox_config or {}
+        self.setup()
+
+    def setup(self):
+        conn = self.db.connect()
+        if self.db.table_exists("lora_outbox"):
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(lora_outbox)").fetchall()]
+            if "kind" not in columns:
+                self.migrate_legacy_table()
+        with conn:
+            self.create_table(conn, "lora_outbox")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_lora_outbox_status ON lora_outbox (status, record_timestamp)"
+            )
+
+    def create_table(self, conn, table_name):
+        # Repair packets have their own kind, so they never replace or share a key with regular ones
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table_name} ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            f"kind TEXT NOT NULL DEFAULT '{KIND_RECORD}', "
+            "record_timestamp TEXT NOT NULL, "
+            "chunk_index INTEGER NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "created_at TEXT, "
+            "last_attempt_at TEXT, "
+            "last_error TEXT, "
+            "UNIQUE (kind, record_timestamp, chunk_index))"
+        )
+
+    def migrate_legacy_table(self):
+        # Outboxes created before repair packets had a kind are keyed by (record_timestamp,
+        # chunk_index) alone; rebuild them keyed by kind, every existing row a record packet
+        conn = self.db.connect()
+        columns = "id, record_timestamp, chunk_index, payload, status, attempts, created_at, last_attempt_at, last_error"
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DROP TABLE IF EXISTS lora_outbox_migrating")
+            self.create_table(conn, "lora_outbox_migrating")
+            conn.execute(f"INSERT INTO lora_outbox_migrating ({columns}) SELECT {columns} FROM lora_outbox")
+            conn.execute("DROP TABLE lora_outbox")
+            conn.execute("ALTER TABLE lora_outbox_migrating RENAME TO lora_outbox")
+        logger.info(f"Migrated lora_outbox in {self.db.db_name} to the kind-keyed schema")
+
+    def enqueue(self, record_timestamp, chunks, replace=False, kind=KIND_RECORD):
+        # replace=True re-queues packets of the same kind already in the outbox (e.g. an
+        # earlier repair of the same records)
+        now = datetime.now().isoformat()
+        conflict = (
+            "ON CONFLICT (kind, record_timestamp, chunk_index) DO UPDATE SET payload = excluded.payload, "
+            "status = excluded.status, attempts = 0, created_at = excluded.created_at, last_error = NULL"
+            if replace
+            else "ON CONFLICT (kind, record_timestamp, chunk_index) DO NOTHING"
+        )
+        with self.db.connect() as conn:
+            conn.executemany(
+                "INSERT INTO lora_outbox (kind, record_timestamp, chunk_index, payload, status, created_at) "
+                f"VALUES (?, ?, ?, ?, ?, ?) {conflict}",
+                (
+                    (kind, to_db_value(record_timestamp), i, json.dumps(chunk, default=str), STATUS_PENDING, now)
+                    for i, chunk in enumerate(chunks)
+                ),
+            )
+        logger.info(f"Queued {len(chunks)} {kind} packets for record {record_timestamp}")
+
+    def pending_record_times(self):
+        # Logger times of every record still waiting to be sent, including the
+        # records inside batch and repair packets
+        max_attempts = self.config.get("max_attempts", DEFAULT_MAX_ATTEMPTS)
+        cursor = self.db.connect().execute(
+            "SELECT payload FROM lora_outbox WHERE status NOT IN (?, ?) AND attempts < ?", (*DONE_STATUSES, max_attempts)
+        )
+        times = set()
+        for (payload,) in cursor:
+            chunk = json.loads(payload)
+            for record in chunk.get("batch", [chunk]):
+                times.add(parse_time(record["time"]))
+        return times
+
+    def next_batch(self):
+        order = "DESC" if self.config.get("drain_order", DEFAULT_DRAIN_ORDER) == "newest" else "ASC"
+        limit = self.config.get("max_packets_per_cycle", DEFAULT_MAX_PACKETS_PER_CYCLE)
+        max_attempts = self.config.get("max_attempts", DEFAULT_MAX_ATTEMPTS)
+        cursor = self.db.connect().execute(
+            "SELECT id, record_timestamp, chunk_index, payload, attempts FROM lora_outbox "
+            "WHERE status NOT IN (?, ?) AND attempts < ? "
+            f"ORDER BY record_timestamp {order}, chunk_index ASC LIMIT ?",
+            (*DONE_STATUSES, max_attempts, limit),
+        )
+        return [
+            {
+                "id": row[0],
+                "record_timestamp": row[1],
+                "chunk_index": row[2],
+                "payload": json.loads(row[3]),
+                "attempts": row[4],
+            }
+            for row in cursor
+        ]
+
+    def mark_sent(self, packet_id):
+        with self.db.connect() as conn:
+            conn.execute(
+                "UPDATE lora_outbox SET status = ?, attempts = attempts + 1, last_attempt_at = ?, last_error = NULL "
+                "WHERE id = ?",
+                (STATUS_SENT, datetime.now().isoformat(), packet_id),
+            )
+
+    def mark_failed(self, packet_id, error):
+        with self.db.connect() as conn:
+            conn.execute(
+                "UPDATE lora_outbox SET status = ?, attempts = attempts + 1, last_attempt_at = ?, last_error = ? "
+                "WHERE id = ?",
+                (STATUS_FAILED, datetime.now().isoformat(), str(error), packet_id),
+            )
+
+    def mark_rejected(self, packet_id, error):
+        # Terminal: unlike a failed packet, a rejected one is not retried
+        with self.db.connect() as conn:
+            conn.execute(
+                "UPDATE lora_outbox SET status = ?, attempts = attempts + 1, last_attempt_at = ?, last_error = ? "
+                "WHERE id = ?",
+                (STATUS_REJECTED, datetime.now().isoformat(), str(error), packet_id),
+            )
+
+    def backlog_size(self):
+        max_attempts = self.config.get("max_attempts", DEFAULT_MAX_ATTEMPTS)
+        row = self.db.connect().execute(
+            "SELECT COUNT(*) FROM lora_outbox WHERE status NOT IN (?, ?) AND attempts < ?", (*DONE_STATUSES, max_attempts)
+        ).fetchone()
+        return row[0]
+
+    def purge_sent(self):
+        # Rejected packets are kept as long as sent ones, for diagnosis
+        retention_days = self.config.get("sent_retention_days", DEFAULT_SENT_RETENTION_DAYS)
+        cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat()
+        with self.db.connect() as conn:
+            deleted = conn.execute(
+                "DELETE FROM lora_outbox WHERE status IN (?, ?) AND last_attempt_at < ?", (*DONE_STATUSES, cutoff)
+            ).rowcount
+        if deleted:
+            logger.info(f"Purged {deleted} sent or rejected packets older than {retention_days} days from the outbox")
+        return deleted
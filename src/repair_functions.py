@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+from .utils import setup_logger
+from .database_functions import get_node_database
+from lora_payload import PayloadError, decode_repair_request
+
+logger = setup_logger("repair_functions", "repair_functions.log")
+
+DEFAULT_MAX_RECORDS = 48  # one day of 30-minute cycles per repair request
+
+def parse_repair_requests(downlinks):
+    # Downlinks are rak811 dicts ({"port": ..., "data": bytes, ...}); anything that
+    # is not a repair request is logged and skipped
+    ranges = []
+    for downlink in downlinks:
+        try:
+            ranges.extend(decode_repair_request(bytes(downlink.get("data") or b"")))
+        except PayloadError as e:
+            logger.warning(f"Ignoring downlink on port {downlink.get('port')}: {e}")
+    return ranges
+
+def select_repair_records(db_name, ranges, interval_minutes, max_records=DEFAULT_MAX_RECORDS, exclude=None):
+    # Records the node still holds for the requested ranges, thinned to one per
+    # collection interval, which is the rate they were originally uplinked at.
+    # Records timed in exclude (still queued in the outbox) are left out: they
+    # will reach the forwarder anyway.
+    exclude = exclude or set()
+    db = get_node_database(db_name)
+    if not db.table_exists("data_table"):
+        return []
+
+    interval = timedelta(minutes=interval_minutes)
+    selected = []
+    for start, stop in sorted(ranges):
+        last_kept = None
+        for row in db.fetch_range(start, stop):
+            timestamp = row["TIMESTAMP"]
+            if isinstance(timestamp, str):
+                timestamp = datetime.fromisoformat(timestamp)
+            if last_kept is not None and timestamp - last_kept < interval:
+                continue
+            if timestamp in exclude:
+                last_kept = timestamp
+                continue
+            row["TIMESTAMP"] = timestamp
+            selected.append(row)
+            last_kept = timestamp
+
+    if len(selected) > max_records:
+        logger.warning(f"Repair requests cover {len(selected)} records; resending the newest {max_records}")
+        selected = selected[-max_records:]
+    return selected
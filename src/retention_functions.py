@@ -0,0 +1,204 @@
+from datetime import datetime, timedelta
+import time
+from .utils import setup_logger
+from .database_functions import get_node_database, KEY_COLUMNS
+from .data_logger import NAN_REPLACEMENT
+
+logger = setup_logger("retention_functions", "retention_functions.log")
+
+ROLLUP_TABLES = {
+    "rollup_hourly": 13,  # TIMESTAMP prefix length: "YYYY-MM-DD HH"
+    "rollup_daily": 10,  # "YYYY-MM-DD"
+}
+ROLLUP_BATCH_SIZE = 1000
+DEFAULT_RAW_RETENTION_DAYS = 30
+DEFAULT_HOURLY_RETENTION_DAYS = 365
+DEFAULT_VACUUM_INTERVAL_HOURS = 24
+DEFAULT_VACUUM_MIN_FREE_RATIO = 0.1
+
+class RetentionManager:
+    # Keeps hourly/daily min/mean/max/count rollups of data_table current and bounds
+    # the size of the node database. Rollups are stored long-form (one row per bucket
+    # and column) so new datalogger columns need no schema change, and sum/count are
+    # kept instead of the mean so each new batch folds in without touching history.
+    def __init__(self, db_name, retention_config=None):
+        self.db = get_node_database(db_name)
+        self.config = retention_config or {}
+
+    def setup(self):
+        with self.db.connect() as conn:
+            for table in ROLLUP_TABLES:
+                conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} ("
+                    "bucket TEXT NOT NULL, "
+                    "column_name TEXT NOT NULL, "
+                    "min_value REAL, "
+                    "max_value REAL, "
+                    "sum_value REAL, "
+                    "count INTEGER, "
+                    "PRIMARY KEY (bucket, column_name))"
+                )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS retention_state (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def get_state(self, key):
+        row = self.db.connect().execute("SELECT value FROM retention_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, conn, key, value):
+        conn.execute("INSERT OR REPLACE INTO retention_state (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def update_rollups(self):
+        # Folds every data_table row newer than the last rolled-up TIMESTAMP into the
+        # aggregates. The high-water mark is committed with the aggregates, so a row is
+        # never counted twice even if a cycle is interrupted.
+        self.setup()
+        if not self.db.table_exists("data_table"):
+            return 0
+        if not self.db.has_unique_key():
+            # A legacy TEXT table is only migrated by the next setup_database; rolling it up
+            # now would skip its text values yet move the high-water mark past them
+            logger.info(f"Skipping rollups until data_table in {self.db.db_name} is migrated")
+            return 0
+
+        conn = self.db.connect()
+        last_rolled = self.get_state("rollup_timestamp") or ""
+        cursor = conn.execute(
+            "SELECT * FROM data_table WHERE TIMESTAMP > ? ORDER BY TIMESTAMP", (last_rolled,)
+        )
+        names = [description[0] for description in cursor.description]
+        value_columns = [(i, name) for i, name in enumerate(names) if name not in KEY_COLUMNS]
+        timestamp_index = names.index("TIMESTAMP")
+
+        rolled = 0
+        while True:
+            rows = cursor.fetchmany(ROLLUP_BATCH_SIZE)
+            if not rows:
+                break
+
+            aggregates = {table: {} for table in ROLLUP_TABLES}
+            for row in rows:
+                timestamp = str(row[timestamp_index])
+                for table, prefix_length in ROLLUP_TABLES.items():
+                    bucket = timestamp[:prefix_length]
+                    table_aggregates = aggregates[table]
+                    for i, name in value_columns:
+                        value = row[i]
+                        if value is None or value == NAN_REPLACEMENT or not isinstance(value, (int, float)):
+                            continue
+                        current = table_aggregates.get((bucket, name))
+                        if current is None:
+                            table_aggregates[(bucket, name)] = [value, value, value, 1]
+                        else:
+                            if value < current[0]:
+                                current[0] = value
+                            if value > current[1]:
+                                current[1] = value
+                            current[2] += value
+                            current[3] += 1
+
+            with conn:
+                for table, table_aggregates in aggregates.items():
+                    conn.executemany(
+                        f"INSERT INTO {table} (bucket, column_name, min_value, max_value, sum_value, count) "
+                        "VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (bucket, column_name) DO UPDATE SET "
+                        "min_value = min(min_value, excluded.min_value), "
+                        "max_value = max(max_value, excluded.max_value), "
+                        "sum_value = sum_value + excluded.sum_value, "
+                        "count = count + excluded.count",
+                        ((bucket, name, *values) for (bucket, name), values in table_aggregates.items()),
+                    )
+                self.set_state(conn, "rollup_timestamp", rows[-1][timestamp_index])
+            rolled += len(rows)
+
+        if rolled:
+            logger.info(f"Rolled {rolled} new rows into hourly and daily aggregates")
+        return rolled
+
+    def get_rollups(self, table, start_bucket, stop_bucket):
+        cursor = self.db.connect().execute(
+            f"SELECT bucket, column_name, min_value, sum_value / count, max_value, count FROM {table} "
+            "WHERE bucket >= ? AND bucket <= ? ORDER BY bucket, column_name",
+            (start_bucket, stop_bucket),
+        )
+        return [
+            {"bucket": row[0], "column": row[1], "min": row[2], "mean": row[3], "max": row[4], "count": row[5]}
+            for row in cursor
+        ]
+
+    def prune(self):
+        # Raw rows are only deleted once they are older than the retention window
+        # and already folded into the rollups.
+        conn = self.db.connect()
+        if not self.db.table_exists("data_table"):
+            return 0
+
+        latest = conn.execute("SELECT MAX(TIMESTAMP) FROM data_table").fetchone()[0]
+        last_rolled = self.get_state("rollup_timestamp")
+        if not latest or not last_rolled:
+            return 0
+
+        # Measured from the newest record rather than the Pi clock, which may be wrong after an outage
+        latest_time = datetime.fromisoformat(str(latest))
+        raw_days = self.config.get("raw_days", DEFAULT_RAW_RETENTION_DAYS)
+        hourly_days = self.config.get("hourly_days", DEFAULT_HOURLY_RETENTION_DAYS)
+        raw_cutoff = min((latest_time - timedelta(days=raw_days)).isoformat(sep=" "), str(last_rolled))
+        hourly_cutoff = (latest_time - timedelta(days=hourly_days)).isoformat(sep=" ")[:13]
+
+        with conn:
+            deleted = conn.execute("DELETE FROM data_table WHERE TIMESTAMP < ?", (raw_cutoff,)).rowcount
+            deleted_hourly = conn.execute("DELETE FROM rollup_hourly WHERE bucket < ?", (hourly_cutoff,)).rowcount
+
+        if deleted or deleted_hourly:
+            logger.info(
+                f"Pruned {deleted} raw rows older than {raw_cutoff} and {deleted_hourly} hourly rollups older than {hourly_cutoff}"
+            )
+        return deleted
+
+    def compact(self, force=False):
+        conn = self.db.connect()
+        interval_hours = self.config.get("vacuum_interval_hours", DEFAULT_VACUUM_INTERVAL_HOURS)
+        min_free_ratio = self.config.get("vacuum_min_free_ratio", DEFAULT_VACUUM_MIN_FREE_RATIO)
+
+        last_vacuum = self.get_state("last_vacuum")
+        if not force and last_vacuum and time.time() - float(last_vacuum) < interval_hours * 3600:
+            return False
+
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        free_ratio = freelist_count / page_count if page_count else 0.0
+
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if force or free_ratio >= min_free_ratio:
+            started = time.time()
+            conn.execute("VACUUM")
+            logger.info(
+                f"Vacuumed {self.db.db_name} ({free_ratio:.0%} free pages) in {time.time() - started:.1f} seconds"
+            )
+        else:
+            logger.debug(f"Skipping VACUUM of {self.db.db_name}; only {free_ratio:.0%} of pages are free")
+
+        with conn:
+            self.set_state(conn, "last_vacuum", time.time())
+        return True
+
+    def run_maintenance(self):
+        self.update_rollups()
+        self.prune()
+        self.compact()
+
+def update_rollups(db_name, retention_config=None):
+    try:
+        return RetentionManager(db_name, retention_config).update_rollups()
+    except Exception as e:
+        logger.error(f"Error updating rollups in {db_name}: {e}")
+        raise
+
+def run_maintenance(db_name, retention_config=None):
+    try:
+        RetentionManager(db_name, retention_config).run_maintenance()
+    except Exception as e:
+        logger.error(f"Error running database maintenance on {db_name}: {e}")
+        raise
@@ -5,6 +5,7 @@ import logging
 from logging.handlers import RotatingFileHandler
 import sys
 from datetime import datetime
+from lora_payload import SensorRegistry
 
 class CustomFormatter(logging.Formatter):
     grey = "\x1b[38;20m"
@@ -28,6 +29,11 @@ class CustomFormatter(logging.Formatter):
         return formatter.format(record)
 
 def setup_logger(name, log_file, level=logging.DEBUG):
+    logger = logging.getLogger(name)
+    if logger.handlers:
+        # Already configured; adding handlers again would duplicate every log line
+        return logger
+
     project_root = get_project_root()
     log_dir = os.path.join(project_root, "logs")
     if not os.path.exists(log_dir):
@@ -35,7 +41,6 @@ def setup_logger(name, log_file, level=logging.DEBUG):
 
     full_path = os.path.join(log_dir, log_file)
 
-    logger = logging.getLogger(name)
     logger.setLevel(level)
 
     file_handler = RotatingFileHandler(full_path, maxBytes=5*1024*1024, backupCount=5)
@@ -98,14 +103,18 @@ def load_sensor_metadata(sensor_file):
         logger.error(f"Error loading sensor metadata from {full_sensor_path}: {e}")
         raise
 
+def load_sensor_registry(sensor_file):
+    return SensorRegistry(load_sensor_metadata(sensor_file))
+
 def get_sensor_hash(sensor_id, sensor_metadata):
-    logger = setup_logger("utils", "utils.log")
-    for sensor in sensor_metadata:
-        if sensor["sensor_id"] == sensor_id:
-            logger.debug(f"Hash found for sensor_id: {sensor_id}")
-            return sensor["hash"]
-    logger.warning(f"No hash found for sensor_id: {sensor_id}")
-    return None
+    # O(1) with a SensorRegistry; a raw metadata list is still scanned
+    if isinstance(sensor_metadata, SensorRegistry):
+        sensor_hash = sensor_metadata.hash_for(sensor_id)
+    else:
+        sensor_hash = next((sensor["hash"] for sensor in sensor_metadata if sensor["sensor_id"] == sensor_id), None)
+    if sensor_hash is None:
+        setup_logger("utils", "utils.log").warning(f"No hash found for sensor_id: {sensor_id}")
+    return sensor_hash
 
 def get_reboot_counter_path():
     return os.path.join(get_project_root(), 'logs', 'reboot_counter.json')
@@ -0,0 +1,58 @@
+import os
+import sys
+import shutil
+import logging
+import importlib.util
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fakes import install_forwarder_fakes, FakePublisherClient
+
+
+@pytest.fixture(scope="session")
+def forwarder_module(tmp_path_factory):
+    # Loaded once with the Pub/Sub and MQTT fakes; the forwarder's paths under ~
+    # point at a temp dir and a root handler turns its logging.basicConfig into a no-op
+    install_forwarder_fakes(0)
+    home = tmp_path_factory.mktemp("forwarder_home")
+    logging.getLogger().addHandler(logging.NullHandler())
+    os.environ["HOME"] = str(home)
+    shutil.copy(os.path.join(ROOT, "config", "sensor_mapping.yaml"), home / "sensor_mapping.yaml")
+    spec = importlib.util.spec_from_file_location(
+        "emqx_to_pubsub", os.path.join(ROOT, "mqtt-forwarder-vm", "emqx_to_pubsub.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def forwarder(forwarder_module, monkeypatch, tmp_path):
+    # Fresh per-test state; publish_to_pubsub collects messages instead of publishing
+    forwarder = forwarder_module
+    FakePublisherClient.reset()
+    monkeypatch.setattr(forwarder, "DEDUP_CACHE", forwarder.DedupCache(3600, 1000))
+    monkeypatch.setattr(forwarder, "DELTA_DECODER", forwarder.PersistentDeltaDecoder())
+    monkeypatch.setattr(forwarder, "GAP_TRACKER", forwarder.GapTracker(
+        forwarder.COLLECTION_INTERVAL_MINUTES, forwarder.GAP_TOLERANCE
+    ))
+    monkeypatch.setattr(forwarder, "SPOOL_DIR", str(tmp_path / "spool"))
+    monkeypatch.setattr(forwarder, "_spool", None)
+    published = []
+    monkeypatch.setattr(forwarder, "publish_to_pubsub", published.append)
+    forwarder.published = published
+    yield forwarder
+    if forwarder._spool is not None:
+        forwarder._spool.close()
+
+
+@pytest.fixture
+def node_db(tmp_path):
+    # A node database in a temp dir, closed after the test
+    from src.database_functions import close_databases
+    yield str(tmp_path / "node.db")
+    close_databases()
@@ -0,0 +1,41 @@
+import random
+
+from src.airtime_functions import AirtimeScheduler
+
+SCHEDULE = {"transmission_window": 300, "min_interval": 10}
+NOW = 1_720_000_000.0
+
+
+def scheduler(node_db, **lora):
+    return AirtimeScheduler(node_db, dict({"region": "US915", "data_rate": 0}, **lora), SCHEDULE, rng=random.Random(1))
+
+
+def test_packets_over_the_dwell_limit_are_rejected(node_db):
+    # US915 DR0 (SF10): 11 bytes take 371 ms, 50 bytes 698 ms, over the 400 ms dwell limit
+    admitted, rejected = scheduler(node_db).admit([11, 50, 11], now=NOW)
+    assert admitted == [0, 2]
+    assert [i for i, _ in rejected] == [1] and "dwell limit" in rejected[0][1]
+
+
+def test_daily_budget_defers_the_rest_in_order(node_db):
+    airtime = scheduler(node_db).airtime(11)
+    limited = scheduler(node_db, daily_airtime_limit=airtime * 5.5)
+    for hours_ago in (20, 2):
+        limited.record(11, now=NOW - hours_ago * 3600)
+    # A send older than the ledger no longer counts
+    limited.record(11, now=NOW - 30 * 3600)
+
+    assert limited.admit([11] * 6, now=NOW) == ([0, 1, 2], [])
+    assert limited.utilization(now=NOW)["daily_budget_used"] == round(2 / 5.5, 4)
+
+
+def test_duty_cycle_spaces_packets_within_the_window(node_db):
+    eu = scheduler(node_db, region="EU868", data_rate=5)
+    airtimes = [eu.airtime(50)] * 4
+    offsets = eu.plan(airtimes)
+    assert len(offsets) == 4 and offsets[-1] + airtimes[-1] <= SCHEDULE["transmission_window"]
+    for previous, offset in zip(offsets, offsets[1:]):
+        assert offset - previous >= airtimes[0] * 100  # 1% duty cycle: 99x the airtime of silence
+
+    # With more packets than the window can space out, the rest wait for the next cycle
+    assert 1 <= len(eu.plan([1.0] * 10)) < 10
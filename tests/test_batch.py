@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+from src.batch_functions import RecordBatcher
+
+START = datetime(2024, 7, 1, 6, 0)
+
+
+def record(minutes):
+    return {"001": 0.25, "time": (START + timedelta(minutes=minutes)).strftime("%Y%m%d%H%M%S")}
+
+
+def test_batch_is_released_when_full_and_survives_a_restart(node_db):
+    batcher = RecordBatcher(node_db, {"records_per_uplink": 3})
+    assert batcher.add(record(0)) == []
+    assert batcher.add(record(30)) == []
+
+    batcher = RecordBatcher(node_db, {"records_per_uplink": 3})
+    released = batcher.add(record(60))
+    assert [r["time"] for r in released] == ["20240701060000", "20240701063000", "20240701070000"]
+    batcher.clear(released)
+    assert batcher.pending() == []
+
+
+def test_old_records_are_released_before_the_batch_fills(node_db):
+    batcher = RecordBatcher(node_db, {"records_per_uplink": 4, "max_age_hours": 1})
+    assert batcher.add(record(0)) == []
+    # Logger time, not wall time, decides the age; a resent record replaces its copy
+    assert batcher.add(record(30)) == []
+    assert batcher.add(record(30)) == []
+    assert len(batcher.add(record(60))) == 3
@@ -0,0 +1,244 @@
+"""
+Round-trip properties of the shared lora_payload codec, checked on random
+records for the sensors in config/sensor_mapping.yaml:
+
+  * decode(encode(chunk)) gives back every reading within half a fixed-point
+    step of its scale, or saturated at the int16 limit, or -9999 when missing.
+    It also gives back the time, BatV (within 0.005 V, or -9999 when the
+    node had no battery reading) and the delta flag.
+  * A batch decodes to its records, oldest first. Sensors a record lacked
+    come back as -9999.
+  * A logger row goes through hash_record, then split_record or a
+    PacketPacker, then encode, decode and expand_uplink. Merging the
+    resulting records gives back the row: every mapped reading, the time,
+    and BatV exactly once.
+  * JSON chunks round-trip exactly.
+  * Random bytes, and truncated or corrupted valid payloads, either decode or
+    raise PayloadError. They never raise anything else.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import math
+import random
+from datetime import datetime, timedelta
+
+import yaml
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lora_payload import (
+    PayloadCodec,
+    PayloadError,
+    PacketPacker,
+    DeltaDecoder,
+    SensorRegistry,
+    REGION_DATA_RATES,
+    encode_json,
+    format_time,
+    hash_record,
+    split_record,
+    expand_uplink,
+)
+from lora_payload.codec import EPOCH, INT16_MAX, NODE_MISSING_VALUE
+
+CASES = 1000  # random cases per property
+SEED = 1
+
+MAX_SECONDS = 0xFFFFFFFF - 0x10000  # leaves room for batch offsets
+
+
+class Fuzzer:
+    def __init__(self, registry, seed):
+        self.registry = registry
+        self.codec = PayloadCodec(registry)
+        self.rng = random.Random(seed)
+        self.hashes = [sensor["hash"] for sensor in registry]
+        self.failures = []
+
+    def fail(self, case, message):
+        self.failures.append(f"{case}: {message}")
+
+    def value(self, scale):
+        roll = self.rng.random()
+        if roll < 0.05:
+            return NODE_MISSING_VALUE
+        if roll < 0.07:
+            return float("nan")
+        if roll < 0.10:
+            # Beyond int16 at this scale; the codec saturates
+            return self.rng.choice((-1, 1)) * self.rng.uniform(INT16_MAX / scale, 10 * INT16_MAX / scale)
+        return self.rng.uniform(-INT16_MAX / scale, INT16_MAX / scale)
+
+    def time_value(self):
+        return format_time(EPOCH + timedelta(seconds=self.rng.randrange(MAX_SECONDS)))
+
+    def batv(self):
+        roll = self.rng.random()
+        if roll < 0.1:
+            return NODE_MISSING_VALUE
+        if roll < 0.13:
+            return float("nan")
+        return round(self.rng.uniform(0, 655.34), 2)
+
+    def record(self, min_sensors=1):
+        count = self.rng.randint(min_sensors, len(self.hashes))
+        record = {key: self.value(self.codec.scale_for(key)) for key in self.rng.sample(self.hashes, count)}
+        record["time"] = self.time_value()
+        if self.rng.random() < 0.8:
+            record["BatV"] = self.batv()
+        return record
+
+    def check_value(self, case, key, sent, got, scale):
+        if sent is None or sent == NODE_MISSING_VALUE or sent != sent:
+            if got != NODE_MISSING_VALUE:
+                self.fail(case, f"{key}: missing value decoded as {got}")
+        elif abs(sent * scale) > INT16_MAX:
+            if got != math.copysign(INT16_MAX, sent) / scale:
+                self.fail(case, f"{key}: {sent} should saturate, decoded as {got}")
+        elif abs(got - sent) > 0.5 / scale + 1e-9:
+            self.fail(case, f"{key}: {sent} decoded as {got}, beyond half a step of 1/{scale}")
+
+    def check_record(self, case, sent, got, keys=None):
+        for key in keys or [key for key in sent if key.isdigit()]:
+            if key not in got:
+                self.fail(case, f"{key} missing after decode")
+                continue
+            self.check_value(case, key, sent.get(key), got[key], self.codec.scale_for(key))
+        if got.get("time") != sent["time"]:
+            self.fail(case, f"time {sent['time']} decoded as {got.get('time')}")
+        batv = sent.get("BatV")
+        if batv is None or batv == NODE_MISSING_VALUE or batv != batv:
+            # Absent, or missing on the node; a batch fills records without one with -9999
+            if "BatV" in got and got["BatV"] != NODE_MISSING_VALUE:
+                self.fail(case, f"missing BatV {batv} decoded as {got['BatV']}")
+        elif abs(got.get("BatV", -1) - batv) > 0.005 + 1e-9:
+            self.fail(case, f"BatV {batv} decoded as {got.get('BatV')}")
+
+    def reading(self, case):
+        chunk = self.record(min_sensors=0)
+        if self.rng.random() < 0.3:
+            chunk["delta"] = True
+        decoded = self.codec.decode(self.codec.encode(chunk))
+        self.check_record(case, chunk, decoded)
+        if bool(decoded.get("delta")) != bool(chunk.get("delta")):
+            self.fail(case, "delta flag lost")
+        if chunk.get("delta") and decoded.get("parts") != 1:
+            self.fail(case, f"delta decoded as part of {decoded.get('parts')} packets, sent as 1")
+        extra = set(decoded) - set(chunk) - {"time", "parts"}
+        if extra:
+            self.fail(case, f"unexpected keys {sorted(extra)}")
+
+    def batch(self, case):
+        first = self.record()
+        start = datetime.strptime(first["time"], "%Y%m%d%H%M%S")
+        records = [first]
+        for _ in range(self.rng.randint(0, 11)):
+            record = self.record()
+            record["time"] = format_time(start + timedelta(seconds=self.rng.randrange(0x10000)))
+            records.append(record)
+        decoded = self.codec.decode(self.codec.encode({"batch": records}))
+        rows = expand_uplink(decoded)
+        if len(rows) != len(records):
+            self.fail(case, f"{len(records)} records decoded as {len(rows)}")
+            return
+        union = {key for record in records for key in record if key.isdigit()}
+        for sent, got in zip(sorted(records, key=lambda record: record["time"]), rows):
+            self.check_record(case, sent, got, keys=union)
+
+    def json_chunk(self, case):
+        chunk = {key: round(self.rng.uniform(-100, 100), 4) for key in self.rng.sample(self.hashes, 3)}
+        chunk["time"] = self.time_value()
+        if self.codec.decode(encode_json(chunk)) != chunk:
+            self.fail(case, "JSON chunk changed in the round trip")
+
+    def node_to_forwarder(self, case):
+        sensor_ids = [sensor["sensor_id"] for sensor in self.registry]
+        row = {sensor_id: self.value(self.codec.scale_for(self.registry.hash_for(sensor_id)))
+               for sensor_id in self.rng.sample(sensor_ids, self.rng.randint(1, len(sensor_ids)))}
+        row["TIMESTAMP"] = datetime.strptime(self.time_value(), "%Y%m%d%H%M%S")
+        row["BatV"] = self.batv()
+        row["PanelTempC"] = 25.0  # unmapped column, must not be sent
+        record, unmapped = hash_record(row, self.registry)
+        if unmapped != ["PanelTempC"]:
+            self.fail(case, f"unexpected unmapped columns {unmapped}")
+
+        if self.rng.random() < 0.5:
+            chunks = split_record(record, self.rng.randint(1, 12))
+        else:
+            region = self.rng.choice(sorted(REGION_DATA_RATES))
+            data_rate = self.rng.choice(sorted(REGION_DATA_RATES[region]))
+            try:
+                chunks = PacketPacker(region, data_rate, self.codec.encode).pack(record)["chunks"]
+            except PayloadError:
+                return  # a single reading does not fit this data rate; nothing to round-trip
+
+        merged = {}
+        batv_count = 0
+        for chunk in chunks:
+            for got in expand_uplink(self.codec.decode(self.codec.encode(chunk))):
+                batv_count += "BatV" in got
+                merged.update(got)
+        if batv_count != 1:
+            self.fail(case, f"BatV sent in {batv_count} packets")
+        self.check_record(case, record, merged)
+
+    def garbage(self, case, valid):
+        roll = self.rng.random()
+        if roll < 0.4:
+            payload = bytes(self.rng.randrange(256) for _ in range(self.rng.randrange(64)))
+        elif roll < 0.7:
+            payload = valid[:self.rng.randrange(len(valid))]
+        else:
+            corrupted = bytearray(valid)
+            corrupted[self.rng.randrange(len(corrupted))] = self.rng.randrange(256)
+            payload = bytes(corrupted)
+        try:
+            self.codec.decode(payload)
+        except PayloadError:
+            pass
+        except Exception as e:
+            self.fail(case, f"{payload.hex()} raised {type(e).__name__}: {e}")
+
+
+@pytest.fixture(scope="module")
+def registry():
+    with open(os.path.join(ROOT, "config", "sensor_mapping.yaml"), "r") as f:
+        return SensorRegistry(yaml.safe_load(f))
+
+
+@pytest.fixture
+def fuzzer(registry):
+    return Fuzzer(registry, SEED)
+
+
+@pytest.mark.parametrize("check", ["reading", "batch", "json_chunk", "node_to_forwarder"])
+def test_round_trip(fuzzer, check):
+    for i in range(CASES):
+        getattr(fuzzer, check)(f"{check} #{i}")
+    assert not fuzzer.failures, "\n".join(fuzzer.failures[:20])
+
+
+def test_garbage_only_raises_payload_error(fuzzer):
+    for i in range(CASES):
+        fuzzer.garbage(f"garbage #{i}", fuzzer.codec.encode(fuzzer.record()))
+    assert not fuzzer.failures, "\n".join(fuzzer.failures[:20])
+
+
+def test_split_delta_record_is_filled_once(registry):
+    # Carried-forward values go only to sensors no part of the record resent
+    codec = PayloadCodec(registry)
+    decoder = DeltaDecoder()
+    hashes = [sensor["hash"] for sensor in registry][:4]
+    keyframe = {key: 0.1 for key in hashes}
+    keyframe["time"] = "20240701000000"
+    for chunk in split_record(keyframe, 2):
+        decoder.rebuild("node", codec.decode(codec.encode(chunk)))
+
+    delta = {hashes[0]: 0.2, hashes[3]: 0.3, "time": "20240701003000", "delta": True}
+    rows = [decoder.rebuild("node", codec.decode(codec.encode(chunk))) for chunk in split_record(delta, 1)]
+    assert rows[0] == {hashes[0]: 0.2, "time": "20240701003000"}
+    assert rows[1] == {hashes[3]: 0.3, hashes[1]: 0.1, hashes[2]: 0.1, "time": "20240701003000"}
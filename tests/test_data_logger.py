@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from fakes import FakeCR1000
+from src import data_logger
+from src.database_functions import setup_watermark_table, update_watermark, get_node_database
+
+TABLE = FakeCR1000.table_name
+
+
+@pytest.fixture
+def datalogger():
+    # Two-minute records, one TDR and one IRT sensor
+    FakeCR1000.configure(["TDR5001C20624", "IRT5001C3xx24"], clock_start=datetime(2024, 7, 1, 12, 0), nan_ratio=0)
+    return FakeCR1000()
+
+
+def stored_times(db_name):
+    return [row[0] for row in get_node_database(db_name).connect().execute(
+        "SELECT TIMESTAMP FROM data_table ORDER BY TIMESTAMP"
+    )]
+
+
+def test_backfill_refetches_a_dense_window_in_halves(datalogger, node_db, monkeypatch):
+    setup_watermark_table(node_db)
+    update_watermark(TABLE.decode(), None, datetime(2024, 7, 1, 0, 0), node_db)
+    stored = []
+    insert = data_logger.insert_data_to_db
+    monkeypatch.setattr(data_logger, "insert_data_to_db", lambda rows, db: (stored.append(len(rows)), insert(rows, db)))
+
+    # 360-minute windows hold 180 records; none of them may be stored whole
+    stats = data_logger.backfill_data(datalogger, TABLE, node_db, FakeCR1000.clock_start,
+                                      chunk_minutes=360, max_chunk_records=50)
+
+    assert stored and max(stored) <= 50
+    assert stats["records"] == sum(stored) == 360  # 00:02 through 12:00
+    times = stored_times(node_db)
+    assert times[0] == "2024-07-01 00:02:00" and times[-1] == "2024-07-01 12:00:00"
+    assert len(set(times)) == len(times)
+
+
+def test_backfill_resumes_from_the_watermark(datalogger, node_db):
+    setup_watermark_table(node_db)
+    update_watermark(TABLE.decode(), None, datetime(2024, 7, 1, 11, 0), node_db)
+    data_logger.backfill_data(datalogger, TABLE, node_db, FakeCR1000.clock_start, chunk_minutes=20)
+
+    FakeCR1000.advance_clock(30)
+    stats = data_logger.backfill_data(datalogger, TABLE, node_db, FakeCR1000.clock_start, chunk_minutes=20)
+
+    assert stats["records"] == 15
+    assert get_node_database(node_db).get_watermark(TABLE.decode())["TIMESTAMP"] == "2024-07-01 12:30:00"
+    assert len(stored_times(node_db)) == 45
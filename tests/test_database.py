@@ -0,0 +1,99 @@
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from src.database_functions import setup_database, insert_data_to_db, get_node_database
+
+T0 = datetime(2024, 7, 1, 12, 0)
+T1 = datetime(2024, 7, 1, 12, 30)
+
+
+def table_rows(db_name):
+    cursor = get_node_database(db_name).connect().execute("SELECT * FROM data_table ORDER BY TIMESTAMP")
+    names = [description[0] for description in cursor.description]
+    return [dict(zip(names, row)) for row in cursor]
+
+
+def column_types(db_name):
+    return {row[1]: row[2] for row in get_node_database(db_name).connect().execute("PRAGMA table_info(data_table)")}
+
+
+def store(db_name, rows):
+    setup_database(rows[0].keys(), db_name, rows)
+    insert_data_to_db(rows, db_name)
+
+
+def test_legacy_table_is_migrated_to_typed_keyed_schema(node_db):
+    conn = sqlite3.connect(node_db)
+    conn.execute("CREATE TABLE data_table (TIMESTAMP TEXT, RecNbr TEXT, BatV TEXT, TDR5001C20624 TEXT)")
+    conn.executemany("INSERT INTO data_table VALUES (?, ?, ?, ?)", [
+        ("2024-07-01 12:00:00", "1", "12.5", "0.21"),
+        ("2024-07-01 12:00:00", "1", "12.5", "0.21"),  # duplicated by an overlapping collection window
+        ("2024-07-01 12:30:00", "2", "12.6", "0.22"),
+    ])
+    conn.commit()
+    conn.close()
+
+    store(node_db, [{"TIMESTAMP": datetime(2024, 7, 1, 13), "RecNbr": 3, "BatV": 12.7, "TDR5001C20624": 0.23}])
+
+    assert column_types(node_db) == {"TIMESTAMP": "TEXT", "RecNbr": "INTEGER", "BatV": "REAL", "TDR5001C20624": "REAL"}
+    rows = table_rows(node_db)
+    assert [row["RecNbr"] for row in rows] == [1, 2, 3]
+    assert rows[0]["BatV"] == 12.5 and isinstance(rows[0]["TDR5001C20624"], float)
+
+
+def test_upsert_is_idempotent(node_db):
+    rows = [{"TIMESTAMP": T0, "RecNbr": 1, "BatV": 12.5}, {"TIMESTAMP": T1, "RecNbr": 2, "BatV": 12.6}]
+    store(node_db, rows)
+    store(node_db, rows)
+    assert table_rows(node_db) == [
+        {"TIMESTAMP": "2024-07-01 12:00:00", "RecNbr": 1, "BatV": 12.5},
+        {"TIMESTAMP": "2024-07-01 12:30:00", "RecNbr": 2, "BatV": 12.6},
+    ]
+
+
+def test_partial_row_keeps_stored_values(node_db):
+    store(node_db, [{"TIMESTAMP": T0, "RecNbr": 1, "BatV": 12.5, "TDR5001C20624": 0.21}])
+    # Resent in a batch whose other row has every column, so BatV is part of the statement
+    store(node_db, [
+        {"TIMESTAMP": T1, "RecNbr": 2, "BatV": 12.6, "TDR5001C20624": 0.22},
+        {"TIMESTAMP": T0, "RecNbr": 1, "TDR5001C20624": 0.25},
+    ])
+    assert table_rows(node_db)[0] == {"TIMESTAMP": "2024-07-01 12:00:00", "RecNbr": 1, "BatV": 12.5, "TDR5001C20624": 0.25}
+
+
+def test_new_logger_column_is_added_with_its_type(node_db):
+    store(node_db, [{"TIMESTAMP": T0, "RecNbr": 1, "BatV": 12.5}])
+    store(node_db, [{"TIMESTAMP": T1, "RecNbr": 2, "BatV": 12.6, "IRT5001C3xx24": 24.5, "Flag": 1}])
+
+    types = column_types(node_db)
+    assert types["IRT5001C3xx24"] == "REAL" and types["Flag"] == "INTEGER"
+    rows = table_rows(node_db)
+    assert rows[0]["IRT5001C3xx24"] is None and rows[1]["IRT5001C3xx24"] == 24.5
+
+
+def test_failed_insert_rolls_back_added_columns(node_db):
+    store(node_db, [{"TIMESTAMP": T0, "RecNbr": 1, "BatV": 12.5}])
+    # The second row cannot be bound, after NewCol was added in the same transaction
+    bad = [{"TIMESTAMP": T1, "RecNbr": 2, "BatV": 12.6, "NewCol": 1.0}, {"TIMESTAMP": T1, "RecNbr": 3, "NewCol": object()}]
+    with pytest.raises(sqlite3.Error):
+        insert_data_to_db(bad, node_db)
+    assert "NewCol" not in column_types(node_db)
+    assert len(table_rows(node_db)) == 1
+
+
+def test_timestamp_range_queries_use_the_unique_key_index(node_db):
+    # UNIQUE (TIMESTAMP, RecNbr) leads with TIMESTAMP, so range scans and MAX need no separate index
+    store(node_db, [{"TIMESTAMP": T0, "RecNbr": 1, "BatV": 12.5}])
+    conn = get_node_database(node_db).connect()
+    for query in (
+        "SELECT * FROM data_table WHERE TIMESTAMP >= ? AND TIMESTAMP <= ? ORDER BY TIMESTAMP",  # fetch_range
+        "SELECT * FROM data_table WHERE TIMESTAMP > ? ORDER BY TIMESTAMP",  # update_rollups
+        "DELETE FROM data_table WHERE TIMESTAMP < ?",  # prune
+    ):
+        plan = " ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", ("2024-07-01",) * query.count("?")))
+        assert "USING INDEX sqlite_autoindex_data_table_1 (TIMESTAMP" in plan, plan
+        assert "TEMP B-TREE" not in plan
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT MAX(TIMESTAMP) FROM data_table").fetchall()
+    assert "COVERING INDEX sqlite_autoindex_data_table_1" in plan[0][3]
@@ -0,0 +1,103 @@
+import json
+import time
+import base64
+
+from fakes import FakeMQTTMessage
+
+
+def uplink(payload, device="LINEAR_CORN_A", received="2024-07-10T12:00:00Z"):
+    envelope = {
+        "deviceName": device,
+        "devEUI": "0000000000000001",
+        "time": received,
+        "data": base64.b64encode(payload).decode("ascii"),
+    }
+    return FakeMQTTMessage("device/data/uplink", json.dumps(envelope).encode("utf-8"))
+
+
+def test_record_time_is_published_as_utc(forwarder):
+    # Logger time is US Central: CDT in summer, CST in winter
+    assert forwarder.record_time_iso({"time": "20240704132200"}) == "2024-07-04T18:22:00+00:00"
+    assert forwarder.record_time_iso({"time": "20240115080000"}) == "2024-01-15T14:00:00+00:00"
+
+
+def test_gap_repair_lands_at_the_record_times(forwarder, node_db):
+    # Node side: three stored records are repaired into JSON packets; forwarder
+    # side: every published row must carry its record's time, not the receive time
+    from datetime import datetime, timedelta
+    from lora_payload import PacketPacker, encode_json, encode_repair_request, REPAIR_FPORT
+    from src.database_functions import setup_database, insert_data_to_db
+    from src.outbox_functions import LoRaOutbox
+    from src.lora_functions import schedule_repairs
+
+    registry = forwarder.SENSOR_REGISTRY
+    sensors = registry.node_sensors("LINEAR_CORN", "C")
+    start = datetime(2024, 7, 1, 6, 0)
+    rows = [
+        dict({sensor["sensor_id"]: 0.2 + i for sensor in sensors}, TIMESTAMP=start + timedelta(minutes=30 * i), RecNbr=i, BatV=12.8)
+        for i in range(3)
+    ]
+    setup_database(rows[0].keys(), node_db, rows)
+    insert_data_to_db(rows, node_db)
+
+    config = {"database": {"name": node_db}, "schedule": {"interval_minutes": 30}}
+    outbox = LoRaOutbox(node_db)
+    downlink = {"port": REPAIR_FPORT, "data": encode_repair_request([(start, start + timedelta(hours=1))])}
+    packer = PacketPacker("US915", 3, encode_json)
+    assert schedule_repairs([downlink], config, registry, packer, outbox) == 3
+
+    for packet in outbox.next_batch():
+        forwarder.process_message(uplink(encode_json(packet["payload"]), device="LINEAR_CORN_C"))
+
+    published = {message["timestamp"] for message in forwarder.published}
+    assert published == {"2024-07-01T11:00:00+00:00", "2024-07-01T11:30:00+00:00", "2024-07-01T12:00:00+00:00"}
+    assert len(forwarder.published) == 3 * len(sensors)
+
+
+def test_outbox_backlog_replayed_newest_first_keeps_record_times(forwarder, node_db):
+    # Records queued through an outage drain newest first, hours after they were logged
+    from datetime import datetime, timedelta
+    from lora_payload import PayloadCodec, split_record
+    from src.outbox_functions import LoRaOutbox
+
+    codec = PayloadCodec(forwarder.SENSOR_REGISTRY)
+    sensors = forwarder.SENSOR_REGISTRY.node_sensors("LINEAR_CORN", "C")
+    outbox = LoRaOutbox(node_db, {"drain_order": "newest", "max_packets_per_cycle": 100})
+    start = datetime(2024, 7, 1, 6, 0)
+    for i in range(4):
+        record_time = start + timedelta(minutes=30 * i)
+        record = {sensor["hash"]: 0.1 * i for sensor in sensors}
+        record["time"] = record_time.strftime("%Y%m%d%H%M%S")
+        outbox.enqueue(record_time, split_record(record, 5))
+
+    packets = outbox.next_batch()
+    assert [packet["record_timestamp"] for packet in packets][0] == "2024-07-01 07:30:00"
+    for packet in packets:
+        forwarder.process_message(uplink(codec.encode(packet["payload"]), device="LINEAR_CORN_C",
+                                         received="2024-07-02T09:00:00Z"))
+        outbox.mark_sent(packet["id"])
+
+    by_time = {}
+    for message in forwarder.published:
+        by_time.setdefault(message["timestamp"], set()).add(message["value"])
+    assert sorted(by_time) == [f"2024-07-01T{hour}:{minute}:00+00:00" for hour, minute in
+                               (("11", "00"), ("11", "30"), ("12", "00"), ("12", "30"))]
+    assert by_time["2024-07-01T12:30:00+00:00"] == {0.3}
+    assert outbox.backlog_size() == 0
+
+
+def test_dedup_cache_expires_evicts_and_reloads(forwarder, tmp_path):
+    cache = forwarder.DedupCache(ttl_seconds=60, max_entries=2, path=str(tmp_path / "dedup.json"))
+    # load() expires against the wall clock, so the test runs on it too
+    now = time.time()
+    assert not cache.seen("a", now)
+    assert cache.seen("a", now + 30)
+    # Expired after the TTL, so seen again as new
+    assert not cache.seen("a", now + 61)
+    assert not cache.seen("b", now + 62)
+    assert not cache.seen("c", now + 63)
+    assert cache.stats["evictions"] == 1 and "a" not in cache.entries
+
+    cache.save()
+    reloaded = forwarder.DedupCache(ttl_seconds=60, max_entries=2, path=str(tmp_path / "dedup.json"))
+    assert list(reloaded.entries) == list(cache.entries)
@@ -0,0 +1,36 @@
+import pytest
+
+from fakes import install_fakes, FakeRak811
+from src.lora_functions import LoRaManager
+
+LORA_CONFIG = {"region": "US915", "dev_addr": "26011111", "apps_key": "00" * 16, "nwks_key": "00" * 16, "data_rate": 3}
+
+
+@pytest.fixture
+def rak811():
+    install_fakes(0)
+    FakeRak811.joined = False
+    FakeRak811.uplink_counter = 0
+    FakeRak811.fail_sends = 0
+    FakeRak811.packets = []
+    FakeRak811.pending_downlinks = []
+    return FakeRak811
+
+
+def test_module_reset_gets_the_stored_uplink_counter_back(rak811, node_db):
+    manager = LoRaManager(LORA_CONFIG, state_db=node_db)
+    manager.ensure_session()
+    for i in range(5):
+        manager.send_data({"i": i})
+    manager.close()
+
+    # The module restarts with its counter at zero; a new process reconfigures it
+    rak811.joined, rak811.uplink_counter = False, 0
+    manager = LoRaManager(LORA_CONFIG, state_db=node_db)
+    assert manager.uplink_counter == 5
+    manager.ensure_session()
+
+    assert rak811.uplink_counter == 5
+    manager.send_data({"i": 5})
+    assert rak811.uplink_counter == manager.uplink_counter == 6
+    assert LoRaManager(LORA_CONFIG, state_db=node_db).uplink_counter == 6
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+
+from src.outbox_functions import LoRaOutbox, KIND_REPAIR
+from src.database_functions import get_node_database
+
+START = datetime(2024, 7, 1, 6, 0)
+
+
+def chunks(record_time, count=2):
+    time_value = record_time.strftime("%Y%m%d%H%M%S")
+    return [{f"00{i + 1}": 0.1 * i, "time": time_value} for i in range(count)]
+
+
+def queue_records(outbox, count, packets=2):
+    for i in range(count):
+        record_time = START + timedelta(minutes=30 * i)
+        outbox.enqueue(record_time, chunks(record_time, packets))
+
+
+def test_drain_order_and_limit(node_db):
+    newest = LoRaOutbox(node_db, {"max_packets_per_cycle": 3})
+    queue_records(newest, 3)
+    assert [(p["record_timestamp"], p["chunk_index"]) for p in newest.next_batch()] == [
+        ("2024-07-01 07:00:00", 0), ("2024-07-01 07:00:00", 1), ("2024-07-01 06:30:00", 0),
+    ]
+    oldest = LoRaOutbox(node_db, {"drain_order": "oldest", "max_packets_per_cycle": 3})
+    assert [p["record_timestamp"] for p in oldest.next_batch()][0] == "2024-07-01 06:00:00"
+
+
+def test_failed_packets_retry_until_max_attempts_and_rejected_never(node_db):
+    outbox = LoRaOutbox(node_db, {"max_attempts": 2})
+    queue_records(outbox, 1)
+    first, second = outbox.next_batch()
+
+    outbox.mark_failed(first["id"], "timeout")
+    outbox.mark_rejected(second["id"], "exceeds the dwell limit")
+    assert [p["id"] for p in outbox.next_batch()] == [first["id"]]
+    assert outbox.next_batch()[0]["attempts"] == 1
+
+    outbox.mark_failed(first["id"], "timeout")
+    assert outbox.next_batch() == [] and outbox.backlog_size() == 0
+
+
+def test_enqueue_keeps_queued_packets_unless_replaced(node_db):
+    outbox = LoRaOutbox(node_db)
+    queue_records(outbox, 1)
+    sent = outbox.next_batch()[0]
+    outbox.mark_sent(sent["id"])
+
+    # Re-queuing the same record leaves the sent packet alone; a repair is a separate kind
+    outbox.enqueue(START, chunks(START))
+    assert outbox.backlog_size() == 1
+    outbox.enqueue(START, chunks(START), kind=KIND_REPAIR)
+    assert outbox.backlog_size() == 3
+    assert sent["id"] not in [p["id"] for p in outbox.next_batch()]
+    # replace=True re-queues it with fresh attempts
+    outbox.enqueue(START, chunks(START, 1), replace=True)
+    assert outbox.backlog_size() == 4
+    assert [p["attempts"] for p in outbox.next_batch() if p["id"] == sent["id"]] == [0]
+
+
+def test_pending_record_times_include_batched_records(node_db):
+    outbox = LoRaOutbox(node_db)
+    later = [START + timedelta(minutes=30 * i) for i in range(1, 4)]
+    outbox.enqueue(later[-1], [{"batch": [chunks(t, 1)[0] for t in later]}])
+    queue_records(outbox, 1)
+    outbox.mark_sent(outbox.next_batch()[-1]["id"])
+    assert outbox.pending_record_times() == set(later) | {START}
+
+
+def test_legacy_outbox_is_migrated_with_its_packets(node_db):
+    with get_node_database(node_db).connect() as conn:
+        conn.execute(
+            "CREATE TABLE lora_outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, record_timestamp TEXT NOT NULL, "
+            "chunk_index INTEGER NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, created_at TEXT, last_attempt_at TEXT, last_error TEXT, "
+            "UNIQUE (record_timestamp, chunk_index))"
+        )
+        conn.execute(
+            "INSERT INTO lora_outbox (record_timestamp, chunk_index, payload, status) VALUES (?, 0, ?, 'pending')",
+            ("2024-07-01 06:00:00", '{"001": 0.1, "time": "20240701060000"}'),
+        )
+
+    outbox = LoRaOutbox(node_db)
+    assert [p["payload"]["001"] for p in outbox.next_batch()] == [0.1]
+    outbox.enqueue(START, chunks(START, 1), kind=KIND_REPAIR)
+    assert outbox.backlog_size() == 2
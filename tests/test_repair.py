@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+from lora_payload import GapTracker, encode_repair_request
+from src.database_functions import setup_database, insert_data_to_db
+from src.repair_functions import parse_repair_requests, select_repair_records
+
+START = datetime(2024, 7, 1, 6, 0)
+
+
+def store_records(db_name, count, minutes):
+    rows = [{"TIMESTAMP": START + timedelta(minutes=minutes * i), "RecNbr": i, "TDR5001C20624": 0.2} for i in range(count)]
+    setup_database(rows[0].keys(), db_name, rows)
+    insert_data_to_db(rows, db_name)
+
+
+def test_gap_tracker_opens_a_range_only_for_new_gaps():
+    tracker = GapTracker(interval_minutes=30, tolerance=1.5, max_gap_hours=2)
+    assert tracker.observe("A", "20240701060000") == []
+    assert tracker.observe("A", "20240701063000") == []
+    assert tracker.observe("A", "20240701080000") == [(datetime(2024, 7, 1, 6, 30, 1), datetime(2024, 7, 1, 7, 59, 59))]
+    # Repaired records arriving late never reopen the gap
+    assert tracker.observe("A", "20240701070000") == []
+    # A long outage is capped at max_gap_hours before the new record
+    assert tracker.observe("A", "20240701140000") == [(datetime(2024, 7, 1, 12, 0), datetime(2024, 7, 1, 13, 59, 59))]
+    assert tracker.observe("B", "20240701140000") == []
+
+
+def test_repair_requests_skip_other_downlinks():
+    request = encode_repair_request([(START, START + timedelta(hours=2))])
+    downlinks = [{"port": 2, "data": b"\x01\x02"}, {"port": 10, "data": request}]
+    assert parse_repair_requests(downlinks) == [(START, START + timedelta(hours=2))]
+
+
+def test_repair_selection_thins_excludes_and_caps(node_db):
+    # Records every 10 minutes, uplinked every 30
+    store_records(node_db, 13, 10)
+    ranges = [(START, START + timedelta(hours=2))]
+    selected = select_repair_records(node_db, ranges, 30)
+    assert [row["TIMESTAMP"] for row in selected] == [START + timedelta(minutes=30 * i) for i in range(5)]
+
+    queued = {START + timedelta(minutes=60)}
+    selected = select_repair_records(node_db, ranges, 30, exclude=queued)
+    assert START + timedelta(minutes=60) not in [row["TIMESTAMP"] for row in selected]
+    assert len(selected) == 4
+
+    newest = select_repair_records(node_db, ranges, 30, max_records=2)
+    assert [row["TIMESTAMP"] for row in newest] == [START + timedelta(minutes=90), START + timedelta(minutes=120)]
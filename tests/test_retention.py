@@ -0,0 +1,63 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+from src.database_functions import setup_database, insert_data_to_db, get_node_database
+from src.retention_functions import RetentionManager
+
+
+def rows(start, count, step_minutes=30):
+    return [
+        {"TIMESTAMP": start + timedelta(minutes=step_minutes * i), "RecNbr": i, "BatV": 12.0 + i, "TDR5001C20624": 0.2}
+        for i in range(count)
+    ]
+
+
+def create_legacy_table(db_name, records):
+    # How nodes created data_table before the typed, keyed schema: TEXT columns, no key
+    conn = sqlite3.connect(db_name)
+    conn.execute("CREATE TABLE data_table (TIMESTAMP TEXT, RecNbr TEXT, BatV TEXT, TDR5001C20624 TEXT)")
+    conn.executemany(
+        "INSERT INTO data_table VALUES (?, ?, ?, ?)",
+        [(str(r["TIMESTAMP"]), str(r["RecNbr"]), str(r["BatV"]), str(r["TDR5001C20624"])) for r in records],
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_legacy_table_is_rolled_up_only_after_migration(node_db):
+    legacy = rows(datetime(2024, 6, 1), 4)
+    create_legacy_table(node_db, legacy)
+    manager = RetentionManager(node_db)
+
+    assert manager.update_rollups() == 0
+    assert manager.get_state("rollup_timestamp") is None
+
+    new = rows(datetime(2024, 6, 1, 2), 2)
+    setup_database(new[0].keys(), node_db, new)
+    insert_data_to_db(new, node_db)
+    assert manager.update_rollups() == 6
+
+    daily = {row["column"]: row for row in manager.get_rollups("rollup_daily", "2024-06-01", "2024-06-01")}
+    assert daily["BatV"]["count"] == 6
+    assert daily["BatV"]["min"] == 12.0 and daily["BatV"]["max"] == 15.0
+
+
+def test_rollups_fold_in_new_rows_once_and_prune_keeps_unrolled_rows(node_db):
+    records = rows(datetime(2024, 6, 1), 48 * 40)  # 40 days of 30-minute rows
+    setup_database(records[0].keys(), node_db, records)
+    insert_data_to_db(records[:48 * 5], node_db)
+    manager = RetentionManager(node_db, {"raw_days": 30})
+    assert manager.update_rollups() == 48 * 5
+    insert_data_to_db(records[48 * 5:], node_db)
+
+    # Rows newer than the rollup mark survive pruning, however old
+    conn = get_node_database(node_db).connect()
+    manager.prune()
+    assert conn.execute("SELECT MIN(TIMESTAMP) FROM data_table").fetchone()[0] == "2024-06-05 23:30:00"
+
+    assert manager.update_rollups() == 48 * 35
+    assert manager.update_rollups() == 0
+    manager.prune()
+    assert conn.execute("SELECT MIN(TIMESTAMP) FROM data_table").fetchone()[0] == "2024-06-10 23:30:00"
+    hourly = manager.get_rollups("rollup_hourly", "2024-06-01 00", "2024-06-01 00")
+    assert {row["column"]: row["count"] for row in hourly} == {"BatV": 2, "TDR5001C20624": 2}
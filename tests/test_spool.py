@@ -0,0 +1,88 @@
+import threading
+
+
+def open_spool(forwarder, directory, segment_bytes=1 << 20):
+    # A long fsync interval keeps the background flusher out of the way
+    return forwarder.Spool(str(directory), segment_bytes, 1 << 30, 3600)
+
+
+def records(n, start=0):
+    return [{"kind": "message", "seq": i} for i in range(start, start + n)]
+
+
+def drain(spool, batch_size=10):
+    seen = []
+    while True:
+        batch = spool.read_batch(batch_size)
+        if not batch:
+            return seen
+        seen.extend(record.get("seq", record["kind"]) for record, _ in batch)
+        spool.commit(batch[-1][1])
+
+
+def test_batches_read_only_their_frames_and_resume_after_reopen(forwarder, tmp_path):
+    spool = open_spool(forwarder, tmp_path / "spool")
+    for record in records(500):
+        spool.append(record)
+
+    batch = spool.read_batch(10)
+    assert [record["seq"] for record, _ in batch] == list(range(10))
+    # The reader stops after the tenth frame instead of reading the segment to its end
+    assert spool.reader[1].tell() == batch[-1][1][1]
+    spool.commit(batch[-1][1])
+    assert [record["seq"] for record, _ in spool.read_batch(5)] == list(range(10, 15))
+    # Not committed: the next batch starts again from the committed offset
+    assert [record["seq"] for record, _ in spool.read_batch(5)] == list(range(10, 15))
+    spool.close()
+
+    # Small segments from here on: the rest is drained across segment rolls
+    reopened = open_spool(forwarder, tmp_path / "spool", segment_bytes=512)
+    for record in records(100, start=500):
+        reopened.append(record)
+    assert reopened.write_segment > reopened.read_segment
+    assert drain(reopened) == list(range(10, 600))
+    reopened.close()
+
+
+def test_corrupt_frame_skips_the_rest_of_its_segment(forwarder, tmp_path):
+    spool = open_spool(forwarder, tmp_path / "spool")
+    for record in records(3):
+        spool.append(record)
+    spool.sync()
+    with open(spool.segment_path(spool.write_segment), "r+b") as f:
+        f.seek(spool.FRAME.size + 2)
+        f.write(b"\xff")
+
+    assert drain(spool) == ["skip"]
+    spool.append({"kind": "message", "seq": 3})
+    assert drain(spool) == [3]
+    spool.close()
+
+
+def test_appends_do_not_wait_for_fsync(forwarder, tmp_path, monkeypatch):
+    spool = open_spool(forwarder, tmp_path / "spool")
+    spool.append({"kind": "message", "seq": 0})
+    in_fsync, release = threading.Event(), threading.Event()
+    fsync = forwarder.os.fsync
+
+    def slow_fsync(fd):
+        in_fsync.set()
+        release.wait(5)
+        fsync(fd)
+
+    monkeypatch.setattr(forwarder.os, "fsync", slow_fsync)
+    syncer = threading.Thread(target=spool.sync)
+    syncer.start()
+    assert in_fsync.wait(5)
+    appender = threading.Thread(target=spool.append, args=({"kind": "message", "seq": 1},))
+    appender.start()
+    appender.join(1)
+    blocked = appender.is_alive()
+    release.set()
+    syncer.join()
+    appender.join()
+    monkeypatch.setattr(forwarder.os, "fsync", fsync)
+
+    assert not blocked
+    assert drain(spool) == [0, 1]
+    spool.close()